@@ -5,7 +5,6 @@
     Module for views used by Fairdata Download Service.
 """
 import json
-import uuid
 import requests
 import urllib.parse
 import urllib3
@@ -20,16 +19,17 @@ from requests.exceptions import ConnectionError
 from ..services import task_service
 from ..services.cache import perform_housekeeping, purge_ghost_files, cleanup_package_cache, print_statistics, \
                              validate_package_cache, get_datasets_dir, get_mock_notifications_dir, flush_cache
-from ..services.db import get_download_record_by_token, get_request_scopes, get_task_id_for_package, \
-                          create_download_record, create_request_scope, create_subscription_row, create_task_rows, get_package, \
-                          finalize_download_record, extract_event, update_package_generation_timestamps, update_package_file_size
+from ..services.db import is_token_used, get_request_scopes, get_task_id_for_package, \
+                          create_download_record, create_request_scope, create_subscription_row, get_package, \
+                          get_packages_for_tasks, get_request_scopes_for_tasks, finalize_download_record, \
+                          extract_event, update_package_generation_timestamps, update_package_file_size
 from ..services.metax import get_matching_project_identifier_from_metax, \
                              DatasetNotFound, UnexpectedStatusCode, MissingFieldsInResponse, NoMatchingFilesFound
 from ..services.mq import reload_queue
 from ..utils import normalize_timestamp, ida_service_is_offline, authenticate_trusted_service
 from ..model.requests import AuthorizePostData, DownloadQuerySchema, \
                              RequestsPostData, RequestsQuerySchema, SubscribePostData, \
-                             MockNotifyPostData
+                             MockNotifyPostData, InvalidatePostData
 from ..events import construct_event_title
 
 
@@ -206,6 +206,12 @@ def get_request():
     response = {}
     response['dataset'] = dataset
 
+    # Load the packages and request scopes of all tasks at once rather than task by task
+    packages = get_packages_for_tasks(
+        task_row['task_id'] for task_row in task_rows if task_row['status'] == 'SUCCESS')
+    request_scopes = get_request_scopes_for_tasks(
+        task_row['task_id'] for task_row in task_rows if task_row['is_partial'])
+
     for task_row in task_rows:
         if not task_row['is_partial']:
             response['status'] = task_row['status']
@@ -216,7 +222,7 @@ def get_request():
             response['initiated'] = normalize_timestamp(task_row['initiated'])
 
             if task_row['status'] == 'SUCCESS':
-                package_row = get_package(task_row['task_id'])
+                package_row = packages[task_row['task_id']]
 
                 response['generated'] = normalize_timestamp(task_row['date_done'])
                 response['package'] = package_row['filename']
@@ -227,9 +233,9 @@ def get_request():
                 response['partial'] = []
 
             if task_row['status'] == 'SUCCESS':
-                package_row = get_package(task_row['task_id'])
+                package_row = packages[task_row['task_id']]
 
-            for request_scope in get_request_scopes(task_row['task_id']):
+            for request_scope in request_scopes.get(task_row['task_id'], []):
                 partial_task = {
                     'scope': list(request_scope),
                     'status': task_row['status'],
@@ -363,16 +369,15 @@ def post_request():
         # Originally, each new task was queued immediately, and the unique message ID generated
         # by Celery was used as the task_id value in the database tables, and the project idenifier
         # was provided to the call to Celery for inclusion in the message details; however, now that
-        # queuing is delayed, we need a way to both create a temporary task_id token as well as pass
+        # queuing is delayed, we need a way to both create a task_id token before queuing as well as
         # preserve the project identifier so that we don't have to fetch it again from Metax when the
         # task is eventually queued.
         #
-        # To achieve both, we create a temporary unique task_id token value which combines the project
-        # identifier with an opaque randomly generated string, and this temporary token is stored in
-        # the various task related database tables. When the task is eventually queued, the temporary
-        # token is parsed to extract the project identifier, the task is queued via Celery, and the
-        # temporary token replaced in all database tables with the actual message specific token
-        # generated by Celery as part of the queuing process.
+        # To achieve both, we create a unique task_id token value which combines the project identifier
+        # with an opaque randomly generated string, and this token is stored in the various task related
+        # database tables. When the task is eventually queued, the token is parsed to extract the project
+        # identifier, and the task is queued via Celery using the same token as the Celery task id, so
+        # the token is permanent and no database records need to be updated other than the task status.
         #
         # Finally, rather than immediately queueing the new task for the received generation request,
         # the function which re-populates the queue, if needed, is called. If the queue is not empty,
@@ -380,12 +385,7 @@ def post_request():
         # empty then the new task becomes immediately queued as before and there is thus no artificial
         # delay between receiving a generation request and processing pending requests.
 
-        task_id = "%s %s" % (project_identifier, uuid.uuid4())
-
-        task_row = create_task_rows(dataset, task_id, is_partial, generate_scope)
-
-        if is_partial:
-            create_request_scope(task_id, request_scope)
+        task_row = task_service.create_task(dataset, project_identifier, is_partial, generate_scope, request_scope)
 
         # If running automated tests, do not immediately update the worker queue, but let the
         # tests check first the results of the API query and reload the queue afterwards
@@ -810,10 +810,8 @@ def download():
     # Read auth token from request parameters
     auth_token = request_data.get('token')
 
-    download_row = get_download_record_by_token(auth_token)
-
-    if download_row is not None:
-        current_app.logger.debug("Token exists in db: %s" % download_row['token'])
+    if is_token_used(auth_token):
+        current_app.logger.debug("Token exists in db: %s" % auth_token)
         current_app.logger.info('Received download request with used token.')
         abort(401)
 
@@ -1035,6 +1033,54 @@ def stats_endpoint():
         return Response(str(e), mimetype='text/plain', status=500) 
 
 
+@download_api.route('/invalidate', methods=['POST'])
+def invalidate_endpoint():
+    """
+    Internally available end point used by trusted services to notify of the modification of a dataset,
+    invalidating the packages and tasks of the dataset which predate the modification.
+
+    :param dataset: ID of the modified dataset
+    :param modified: modification timestamp of the dataset, retrieved from Metax if not specified
+    :param regenerate: boolean indicating whether popular invalidated packages are to be regenerated
+    """
+
+    current_app.logger.debug("POST /invalidate: %s" % json.dumps(request.get_json()))
+
+    # Authenticate the trusted service making the request
+    try:
+        authenticate_trusted_service(current_app, request)
+    except PermissionError as err:
+        abort(401, str(err))
+
+    # Validate request
+    try:
+        request_data = InvalidatePostData().load(request.get_json())
+    except ValidationError as err:
+        abort(400, str(err.messages))
+
+    dataset = request_data.get('dataset')
+    modified = request_data.get('modified')
+
+    if modified:
+        try:
+            modified = normalize_timestamp(modified)
+        except ValueError:
+            abort(400, "Invalid modification timestamp: %s" % modified)
+
+    try:
+        status = task_service.invalidate_dataset(dataset, modified, request_data.get('regenerate', False))
+    except DatasetNotFound as err:
+        abort(404, err)
+    except ConnectionError:
+        abort(500)
+    except MissingFieldsInResponse:
+        abort(500)
+    except UnexpectedStatusCode:
+        abort(500)
+
+    return Response(status, mimetype='text/plain', status=200)
+
+
 @download_api.route('/update_package_timestamps', methods=['POST'])
 def update_package_timestamps():
     """
@@ -6,11 +6,12 @@
 """
 from datetime import datetime, timedelta
 
-from flask import Blueprint, abort, current_app, jsonify
+from flask import Blueprint, Response, abort, current_app, jsonify
 from celery.app.control import Inspect
 
 from ..services import mq
 from ..services.mq import UnableToConnectToMQ, get_mq
+from ..services.tracing import format_metrics
 
 healthcheck = Blueprint('healthcheck', __name__)
 
@@ -64,6 +65,21 @@ def get_health():
       'generator_status': generator_status
     })
 
+@healthcheck.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Internally available end point for metrics collection, in the Prometheus text exposition format.
+    ---
+    tags:
+      - Internal
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Database query duration histograms of the serving process, if query tracing is enabled
+    """
+    return Response(format_metrics(), mimetype='text/plain; version=0.0.4')
+
 @healthcheck.errorhandler(500)
 def internal_server_error(error):
     """Error handler for HTTP 500."""
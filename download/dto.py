@@ -1,15 +1,38 @@
-from dataclasses import dataclass, field
+from typing import NamedTuple
 
-from pendulum.datetime import DateTime
 
-
-@dataclass(order=True)
 class Package:
-    # ['filename', 'size_bytes', 'generated_at', 'last_downloaded', 'no_downloads']
-    filename: str = field(compare=False)
-    size_bytes: int = field(compare=False)
-    no_downloads: int = field(default=0, compare=False)
-    generated_at: DateTime = field(default=None, compare=False)
-    last_downloaded: DateTime = field(default=None, compare=False)
-    rank: int = field(default=0, compare=True)
-    expired: bool = field(default=False, compare=False)
+    # Compact record of a package in the cache, with the times when the package was generated and last downloaded
+    # as epoch seconds, the dataset of the package if known, and the measured duration of the generation of the
+    # package in seconds if known, ordered by rank
+    __slots__ = ('filename', 'size_bytes', 'no_downloads', 'generated_at', 'last_downloaded', 'rank', 'expired',
+                 'dataset_id', 'generation_seconds')
+
+    def __init__(self, filename, size_bytes, no_downloads=0, generated_at=None, last_downloaded=None, rank=0,
+                 expired=False, dataset_id=None, generation_seconds=None):
+        self.filename = filename
+        self.size_bytes = size_bytes
+        self.no_downloads = no_downloads
+        self.generated_at = generated_at
+        self.last_downloaded = last_downloaded
+        self.rank = rank
+        self.expired = expired
+        self.dataset_id = dataset_id
+        self.generation_seconds = generation_seconds
+
+    def __lt__(self, other):
+        return self.rank < other.rank
+
+    def __repr__(self):
+        return 'Package(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+    def asdict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class DatasetFile(NamedTuple):
+    # Compact record of the Metax file metadata fields used by the service, independent of Metax API version
+    pathname: str
+    project: str
+    size: int = None
+    checksum: str = None
@@ -22,5 +22,10 @@ class AuthorizePostData(Schema):
     package = fields.Str()
     filename = fields.Str(data_key='file')
 
+class InvalidatePostData(Schema):
+    dataset = fields.Str(required=True)
+    modified = fields.Str()
+    regenerate = fields.Boolean()
+
 class DownloadQuerySchema(Schema):
     token = fields.Str(required=True)
@@ -0,0 +1,394 @@
+"""
+download.backends
+~~~~~~~~~~~~~~~~~
+
+Database backends for Fairdata Download Service.
+
+The queries of the database module are written in SQL common to SQLite and PostgreSQL, with ? as the parameter
+placeholder. Each backend implements the operations which differ between the databases: connecting, schema
+initialization and versioning, inserting rows with generated ids, and iterating over large query results.
+
+SQLite is used by default, with the database in DATABASE_FILE. PostgreSQL is used if DATABASE_URL is defined as a
+postgresql:// connection URL, allowing multiple service and generator nodes to share the database, and requires the
+psycopg2 package to be installed.
+"""
+import re
+import time
+import uuid
+import sqlite3
+from flask import current_app
+
+# Number of rows fetched at a time by server-side cursors when iterating over large query results
+ITER_ROWS_FETCH_SIZE = 2000
+
+# Number of rows of each index sampled when updating the statistics of the SQLite query planner
+ANALYSIS_LIMIT = 1000
+
+# Number of free pages returned to the file system by each SQLite incremental vacuum statement
+VACUUM_BATCH_PAGES = 1000
+
+# Number of virtual machine instructions between checks of the deadline of SQLite maintenance statements
+MAINTENANCE_PROGRESS_INTERVAL = 1000
+
+# SQLite vacuum modes by their auto_vacuum pragma values
+VACUUM_MODES = ['none', 'full', 'incremental']
+
+
+def get_backend(app=None):
+    """
+    Returns the database backend configured for the specified application, or for the current application.
+    """
+    if app is None:
+        app = current_app
+    if PostgreSQLBackend.handles(app.config.get('DATABASE_URL')):
+        return postgresql_backend
+    return sqlite_backend
+
+
+class SQLiteBackend:
+    """Database backend storing all state in a single SQLite database file."""
+
+    sql_dir = 'sql'
+
+    def database(self, app):
+        """Returns the identifier of the database used by the specified application."""
+        return app.config['DATABASE_FILE']
+
+    def connect(self, app):
+        """
+        Opens a new connection to the database, configured for concurrent access by multiple threads and processes:
+        write-ahead logging so that readers and a writer do not block one another, a busy timeout so that writers
+        wait for one another rather than fail, and the configured memory mapping and page cache sizes. New databases
+        are created with incremental vacuuming, which can only be enabled before the database is first written to.
+        """
+        db_conn = sqlite3.connect(
+            app.config['DATABASE_FILE'],
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            **self.connect_args(app)
+        )
+        db_conn.row_factory = sqlite3.Row
+
+        db_conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db_conn.execute('PRAGMA journal_mode = WAL')
+        db_conn.execute('PRAGMA synchronous = NORMAL')
+        db_conn.execute('PRAGMA mmap_size = %d' % int(app.config.get('DATABASE_MMAP_SIZE', 268435456)))
+        db_conn.execute('PRAGMA cache_size = -%d' % int(app.config.get('DATABASE_CACHE_SIZE_KB', 16384)))
+
+        return db_conn
+
+    def connect_args(self, app):
+        """Returns the keyword arguments of connections to the database."""
+        return {'timeout': float(app.config.get('DATABASE_BUSY_TIMEOUT', 30))}
+
+    def get_schema_version(self, db_conn):
+        return db_conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def lock_schema(self, db_conn):
+        """Begins an exclusive write transaction for migrating the schema."""
+        db_conn.commit()
+        db_conn.execute('BEGIN IMMEDIATE')
+
+    def set_schema_version(self, db_conn, version):
+        db_conn.execute('PRAGMA user_version = %d' % version)
+
+    def split_statements(self, script):
+        """Splits the specified SQL script into its individual statements."""
+        statements = []
+        statement = ''
+        for line in script.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                statements.append(statement.strip())
+                statement = ''
+        if statement.strip():
+            statements.append(statement.strip())
+        return statements
+
+    def insert(self, db_cursor, sql, parameters):
+        """Executes the specified INSERT statement and returns the generated id of the inserted row."""
+        db_cursor.execute(sql, parameters)
+        return db_cursor.lastrowid
+
+    def epoch(self, expression):
+        """Returns an SQL expression converting the specified timestamp expression to integer epoch seconds."""
+        return "CAST(strftime('%%s', %s) AS INTEGER)" % expression
+
+    def explain(self, db_conn, sql, parameters=()):
+        """Returns the lines of the query plan of the specified statement."""
+        return [row[3] for row in db_conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters or ())]
+
+    def iter_rows(self, db_conn, sql, parameters=()):
+        """Yields the rows of the specified query as they are stepped through by the database."""
+        for row in db_conn.execute(sql, parameters):
+            yield row
+
+    def get_vacuum_mode(self, db_conn):
+        """Returns the vacuum mode of the database: none, full or incremental."""
+        return VACUUM_MODES[db_conn.execute('PRAGMA auto_vacuum').fetchone()[0]]
+
+    def convert_vacuum(self, db_conn):
+        """
+        Converts the database to incremental vacuuming, if not already converted, and returns the outcome. The
+        vacuum mode of an existing database only changes once the whole database is rewritten by VACUUM, which
+        holds an exclusive lock on the database until completed, so the conversion must only be run by an operator
+        during a service break.
+        """
+        if self.get_vacuum_mode(db_conn) == 'incremental':
+            return 'already incremental'
+        db_conn.commit()
+        db_conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db_conn.execute('VACUUM')
+        return 'converted to %s' % self.get_vacuum_mode(db_conn)
+
+    def maintain(self, db_conn, deadline):
+        """
+        Performs routine maintenance of the database, yielding the name and outcome of each step once completed:
+        updating the statistics of the query planner from a sample of the rows of each index, reporting the vacuum
+        mode of the database, returning free pages to the file system if incremental vacuuming is enabled,
+        checkpointing the write-ahead log without waiting for readers or writers, and a quick integrity check.
+
+        Free pages are returned in batches of VACUUM_BATCH_PAGES pages, each in its own transaction, so that the
+        write lock is only held briefly at a time. A statement still running at the deadline, in time.monotonic()
+        seconds, is interrupted, and no further steps are performed.
+        """
+        def expired():
+            return time.monotonic() >= deadline
+
+        db_conn.commit()
+        db_conn.set_progress_handler(expired, MAINTENANCE_PROGRESS_INTERVAL)
+
+        try:
+            if expired():
+                return
+            db_conn.execute('PRAGMA analysis_limit = %d' % ANALYSIS_LIMIT)
+            db_conn.execute('ANALYZE')
+            yield 'analyze', 'ok'
+
+            vacuum_mode = self.get_vacuum_mode(db_conn)
+            yield 'auto_vacuum', vacuum_mode
+
+            freed = 0
+            free_pages = db_conn.execute('PRAGMA freelist_count').fetchone()[0]
+            while free_pages > 0 and vacuum_mode == 'incremental':
+                if expired():
+                    return
+                db_conn.execute('PRAGMA incremental_vacuum(%d)' % VACUUM_BATCH_PAGES).fetchall()
+                remaining = db_conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if remaining >= free_pages:
+                    break
+                freed += free_pages - remaining
+                free_pages = remaining
+            yield 'vacuum', '%d pages freed, %d free pages remaining' % (freed, free_pages)
+
+            if expired():
+                return
+            busy, log_pages, checkpointed = db_conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            yield 'checkpoint', '%d of %d write-ahead log pages checkpointed' % (max(checkpointed, 0), max(log_pages, 0))
+
+            if expired():
+                return
+            yield 'check', '; '.join(row[0] for row in db_conn.execute('PRAGMA quick_check'))
+
+        except sqlite3.OperationalError as error:
+            if 'interrupted' not in str(error):
+                raise
+            db_conn.rollback()
+
+        finally:
+            db_conn.set_progress_handler(None, 0)
+
+
+class PostgreSQLCursor:
+    """Cursor of a PostgreSQL connection, translating ? parameter placeholders to those used by psycopg2."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        if parameters:
+            self.cursor.execute(translate_placeholders(sql), parameters)
+        else:
+            self.cursor.execute(sql)
+        return self
+
+    def executemany(self, sql, parameters):
+        self.cursor.executemany(translate_placeholders(sql), parameters)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+    @property
+    def name(self):
+        return self.cursor.name
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+class PostgreSQLConnection:
+    """PostgreSQL connection providing the subset of the sqlite3 connection interface used by the database module."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, name=None):
+        """Returns a new cursor, or if named, a server-side cursor fetching ITER_ROWS_FETCH_SIZE rows at a time."""
+        from psycopg2.extras import DictCursor
+        cursor = self.connection.cursor(name=name, cursor_factory=DictCursor)
+        cursor.itersize = ITER_ROWS_FETCH_SIZE
+        return PostgreSQLCursor(cursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, script):
+        with self.connection.cursor() as cursor:
+            cursor.execute(script)
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+    @property
+    def in_transaction(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        return self.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE
+
+
+def translate_placeholders(sql):
+    """
+    Translates the ? parameter placeholders of the specified SQL statement to the %s placeholders used by psycopg2,
+    escaping any literal % characters, and leaving quoted string literals intact.
+    """
+    return re.sub(r"('(?:[^']|'')*')|\?", lambda match: match.group(1) or '%s', sql.replace('%', '%%'))
+
+
+class PostgreSQLBackend:
+    """Database backend storing all state in a PostgreSQL database shared by multiple nodes."""
+
+    sql_dir = 'sql/postgresql'
+
+    @staticmethod
+    def handles(url):
+        return bool(url) and url.split('://', 1)[0] in ('postgresql', 'postgres')
+
+    def database(self, app):
+        """Returns the identifier of the database used by the specified application, omitting any password."""
+        return re.sub(r'://([^:/@]+):[^@]*@', r'://\1@', app.config['DATABASE_URL'])
+
+    def connect(self, app):
+        """
+        Opens a new connection to the database, with timestamps in UTC as with SQLite, and with statements waiting
+        for locks held by other connections at most DATABASE_BUSY_TIMEOUT seconds.
+        """
+        import psycopg2
+
+        connection = psycopg2.connect(app.config['DATABASE_URL'], **self.connect_args(app))
+
+        return PostgreSQLConnection(connection)
+
+    def connect_args(self, app):
+        """Returns the keyword arguments of connections to the database."""
+        return {
+            'options': '-c timezone=UTC -c lock_timeout=%d' % (float(app.config.get('DATABASE_BUSY_TIMEOUT', 30)) * 1000)
+        }
+
+    def get_schema_version(self, db_conn):
+        return db_conn.execute('SELECT coalesce(max(version), 0) FROM schema_version').fetchone()[0]
+
+    def lock_schema(self, db_conn):
+        """Begins a transaction holding an exclusive lock for migrating the schema."""
+        db_conn.commit()
+        db_conn.execute('LOCK TABLE schema_version IN EXCLUSIVE MODE')
+
+    def set_schema_version(self, db_conn, version):
+        db_conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+
+    def split_statements(self, script):
+        """Returns the specified SQL script as a single statement, as psycopg2 executes multiple statements at once."""
+        return [script]
+
+    def insert(self, db_cursor, sql, parameters):
+        """Executes the specified INSERT statement and returns the generated id of the inserted row."""
+        return db_cursor.execute(sql + ' RETURNING id', parameters).fetchone()[0]
+
+    def epoch(self, expression):
+        """Returns an SQL expression converting the specified timestamp expression to integer epoch seconds."""
+        return 'CAST(extract(epoch FROM %s) AS BIGINT)' % expression
+
+    def explain(self, db_conn, sql, parameters=()):
+        """Returns the lines of the query plan of the specified statement."""
+        return [row[0] for row in db_conn.execute('EXPLAIN ' + sql, parameters or ())]
+
+    def iter_rows(self, db_conn, sql, parameters=()):
+        """Yields the rows of the specified query, fetched in batches with a server-side cursor."""
+        cursor = db_conn.cursor(name='download_%s' % uuid.uuid4().hex)
+        try:
+            for row in cursor.execute(sql, parameters):
+                yield row
+        finally:
+            cursor.close()
+
+    def convert_vacuum(self, db_conn):
+        """Returns the outcome of converting the database to incremental vacuuming, which does not apply to
+        PostgreSQL, as the space of deleted rows is marked for reuse by the VACUUM of routine maintenance."""
+        return 'not applicable'
+
+    def maintain(self, db_conn, deadline):
+        """
+        Performs routine maintenance of the database, yielding the name and outcome of each step once completed:
+        updating the statistics of the query planner and marking the space of deleted rows for reuse, neither of
+        which locks tables against reads or writes. Checkpoints are left to the server, as they also require
+        superuser privileges. A statement still running at the deadline, in time.monotonic() seconds, is cancelled,
+        and no further steps are performed.
+        """
+        from psycopg2.errors import QueryCanceled
+
+        connection = db_conn.connection
+        connection.commit()
+        connection.autocommit = True
+
+        try:
+            with connection.cursor() as cursor:
+                for step, statement in (('analyze', 'ANALYZE'), ('vacuum', 'VACUUM')):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    cursor.execute('SET statement_timeout = %d' % max(remaining * 1000, 1))
+                    try:
+                        cursor.execute(statement)
+                    except QueryCanceled:
+                        return
+                    finally:
+                        cursor.execute('RESET statement_timeout')
+                    yield step, 'ok'
+        finally:
+            connection.autocommit = False
+
+
+sqlite_backend = SQLiteBackend()
+postgresql_backend = PostgreSQLBackend()
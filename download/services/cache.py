@@ -12,8 +12,7 @@
     download, the service will check if the dataset modification timestamp is later than the package
     generation timestamp, and if so, the request will be refused with a 409 response
 
-    Each time before a new package file is generated, as part of the background process, the service
-    will perform its housekeeping operations, ensuring that:
+    The housekeeping operations of the service, run periodically as a cron job, ensure that:
 
     - no ghost files exist on disk which are not known to the database
     - no invalid / outdated packages exist which are older than the modification timestamp of their dataset
@@ -22,14 +21,20 @@
     In this way, the service will never report, authorize for download, nor return an invalid package
     that is older than the dataset.
 
-    Furthermore, no cron jobs have to be run to validate packages in the cache or check cache volume usage,
-    rather the cache is regularly managed as part of normal operations as new packages are generated.
-    Later, if we so choose, we could decouple the housekeeping from the package generation and run it
-    explicitly via a cron job, if that is later decided to be more optimal.
+    Each periodic housekeeping run is limited to CACHE_HOUSEKEEPING_TIME_LIMIT seconds. Packages are validated
+    in batches in the order of their filenames, and validation resumes from the package at which the previous
+    run stopped, so that all packages are validated over successive runs however large the cache grows.
+
+    Before each new package file is generated, as part of the background process, the service only checks
+    the cache volume usage, removing packages to cleanup space if the volume limit is exceeded, so that
+    the generation of packages is not delayed by the validation of the whole cache.
 """
 import os
-import pendulum
-from dataclasses import asdict
+import json
+import time
+import click
+import bisect
+import threading
 from typing import List
 from flask import current_app
 from flask.cli import AppGroup
@@ -40,15 +45,39 @@ from ..dto import Package
 from ..utils import normalize_timestamp, normalize_logging, BearerAuth
 
 GB = 1073741824
+DAY = 86400
+
+# Suffix of package files being written by the generator, renamed to their final names once complete
+PART_SUFFIX = '.part'
+
+# Number of packages validated with each bulk lookup of dataset modification timestamps
+VALIDATION_BATCH_SIZE = 100
+
+# Name of the housekeeping state recording the filename of the last validated package
+VALIDATION_POSITION = 'validation_position'
 
+# Maximum number of successive inflation values recorded by the GreedyDual cache eviction policies
+MAX_INFLATION_HISTORY = 1000
 
-def perform_housekeeping():
+
+def perform_housekeeping(time_limit=None):
+    """Performs all package cache housekeeping operations.
+
+    :param time_limit: Maximum duration of package validation in seconds, if specified, after which the
+                       validation is resumed by the next housekeeping run
+    """
     message = "Performing package cache housekeeping"
     current_app.logger.info(message)
     status = message
+    deadline = time.monotonic() + time_limit if time_limit is not None else None
     message = purge_ghost_files()
     status = status + "\n" + message
-    message = validate_package_cache()
+    removed = empty_trash(os.path.join(current_app.config['DOWNLOAD_CACHE_DIR'], 'trash'))
+    if removed > 0:
+        message = f"Removed {removed} package files from trash"
+        current_app.logger.info(message)
+        status = status + "\n" + message
+    message = validate_package_cache(deadline)
     status = status + "\n" + message
     message = cleanup_package_cache()
     status = status + "\n" + message
@@ -84,17 +113,30 @@ def flush_cache():
 
 
 def purge_ghost_files():
-    """Purge files from cache that cannot be found in the database."""
+    """Purge files from cache that cannot be found in the database.
+
+    Package files are written by the generator with the PART_SUFFIX suffix and recorded in the database only
+    after being renamed once complete, so files modified within the last CACHE_GHOST_GRACE_PERIOD seconds are
+    never purged, and partial package files are only purged once left behind by generators which have failed.
+    """
     message = "Purging ghost files from cache that cannot be found in the database"
     current_app.logger.info(message)
     status = message
-    source_root = os.path.join(current_app.config['DOWNLOAD_CACHE_DIR'], 'datasets')
+    grace_period_start = time.time() - int(current_app.config.get('CACHE_GHOST_GRACE_PERIOD', 3600))
+    package_filenames = db.get_package_filenames()
     removed = []
-    for root, dirs, files in os.walk(source_root):
-        for name in files:
-            if not db.exists_in_database(name):
-                os.remove(os.path.join(root, name))
-                removed.append(name)
+    with os.scandir(get_datasets_dir()) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or entry.name in package_filenames:
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= grace_period_start:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # The file was renamed or removed concurrently
+                continue
+            removed.append(entry.name)
     if len(removed) > 0:
         message = f"Removed {len(removed)} ghost files"
         current_app.logger.info(message)
@@ -109,16 +151,25 @@ def purge_ghost_files():
     return status
 
 
-def validate_package_cache():
+def validate_package_cache(deadline=None):
+    """Validates packages against their files and the modification timestamps of their datasets, removing
+    invalid packages.
+
+    :param deadline: Time, in time.monotonic() seconds, after which no further batches of packages are validated,
+                     if specified; validation is then resumed from the last validated package by the next call
+    """
     message = "Performing package cache validation against dataset modification timestamps"
     current_app.logger.info(message)
     status = message
-    active_packages = db.get_active_packages()
-    message = "Active packages retrieved from database:\n" + tabulate([asdict(i) for i in active_packages], headers="keys")
+    if deadline is None:
+        active_packages = db.get_active_packages()
+    else:
+        active_packages = get_packages_to_validate(deadline)
+    message = "Active packages retrieved from database:\n" + tabulate([i.asdict() for i in active_packages], headers="keys")
     current_app.logger.debug(message)
     remove = identify_invalid_packages(active_packages)
     if len(remove) > 0:
-        message = "Invalid packages to be removed from cache:\n" + tabulate([asdict(i) for i in remove], headers="keys")
+        message = "Invalid packages to be removed from cache:\n" + tabulate([i.asdict() for i in remove], headers="keys")
         status = status + "\n" + message
         current_app.logger.info(message)
         removed_files = remove_cache_files(remove)
@@ -130,6 +181,41 @@ def validate_package_cache():
     return status
 
 
+def get_packages_to_validate(deadline):
+    """Returns the packages to be validated by an incremental validation run, in batches of VALIDATION_BATCH_SIZE
+    packages starting after the last package validated by the previous run, until the deadline is reached. At
+    least one batch is always selected, so that every run makes progress.
+
+    The dataset modification timestamps of each batch are retrieved as the batch is selected, so that the
+    validation of the selected packages which follows uses the cached timestamps.
+
+    :param deadline: Time, in time.monotonic() seconds, after which no further batches are selected
+    """
+    position = db.get_housekeeping_state(VALIDATION_POSITION)
+    packages = []
+
+    while True:
+        batch = db.get_active_packages(after=position or '', limit=VALIDATION_BATCH_SIZE)
+        try:
+            metax.get_datasets_modified(set(package.dataset_id for package in batch))
+        except Exception as e:
+            current_app.logger.error("Error retrieving dataset modification timestamps: %s" % str(e))
+            break
+        packages.extend(batch)
+        if len(batch) < VALIDATION_BATCH_SIZE:
+            # All packages have been selected, so the next run starts from the beginning
+            position = None
+            break
+        position = batch[-1].filename
+        if time.monotonic() >= deadline:
+            current_app.logger.info("Package validation time limit reached, resuming after package %s" % position)
+            break
+
+    db.set_housekeeping_state(VALIDATION_POSITION, position)
+
+    return packages
+
+
 def cleanup_package_cache():
     message = "Performing package cache cleanup to increase available cache storage space"
     current_app.logger.info(message)
@@ -142,11 +228,11 @@ def cleanup_package_cache():
     if cache_usage_int > 0 and cache_usage_int > cache_purge_threshold:
         clear_size = cache_usage_int - cache_purge_target
         active_packages = db.get_active_packages()
-        message = "Active packages retrieved from database:\n" + tabulate([asdict(i) for i in active_packages], headers="keys")
+        message = "Active packages retrieved from database:\n" + tabulate([i.asdict() for i in active_packages], headers="keys")
         current_app.logger.debug(message)
-        remove, expired, ranked = select_packages_to_be_removed(clear_size, active_packages)
+        remove = get_eviction_policy(persistent=True).select(clear_size, active_packages)
         if len(remove) > 0:
-            message = "Packages to be removed from cache:\n" + tabulate([asdict(i) for i in remove], headers="keys")
+            message = "Packages to be removed from cache:\n" + tabulate([i.asdict() for i in remove], headers="keys")
             status = status + "\n" + message
             current_app.logger.info(message)
             remove_cache_files(remove)
@@ -162,10 +248,16 @@ def cleanup_package_cache():
 
 
 def identify_invalid_packages(active_packages: List[Package]):
-    """Selects packages that are older than the last modification timestamp of their dataset
+    """Selects packages that are older than the last modification timestamp of their dataset, or whose package
+    files are missing or empty.
+
+    The packages are validated grouped by dataset, with the modification timestamps of all their datasets
+    retrieved concurrently with a single bulk lookup, and the sizes of all package files retrieved with a
+    single listing of the cache directory.
 
     :param active_packages: List of data about the packages in the cache. Includes filename, size in bytes, timestamps
-                            when the package was generated and last downloaded, and the overall number of downloads.
+                            when the package was generated and last downloaded, the overall number of downloads, and
+                            the dataset of the package.
     """
 
     if current_app:
@@ -173,77 +265,101 @@ def identify_invalid_packages(active_packages: List[Package]):
 
     invalid_packages = []
 
+    # Group the packages by dataset, looking up the datasets of any packages not retrieved with their dataset
+    packages_by_dataset = {}
     for package in active_packages:
+        dataset_id = package.dataset_id or db.get_dataset_id_for_package(package.filename)
+        packages_by_dataset.setdefault(dataset_id, []).append(package)
+
+    # Retrieve the modification timestamps of the datasets of all packages with a single bulk lookup
+    try:
+        dataset_modified_timestamps = metax.get_datasets_modified(
+            dataset_id for dataset_id in packages_by_dataset if dataset_id)
+    except Exception as e:
+        if current_app:
+            current_app.logger.error("Error retrieving dataset modification timestamps: %s" % str(e))
+        dataset_modified_timestamps = {}
 
-        package_cache_pathname = os.path.join(get_datasets_dir(), package.filename)
+    # Retrieve the sizes of all package files on disk with a single directory listing
+    package_file_sizes = get_package_file_sizes()
 
-        # Check for packages which are missing the package file on disk
-        # (ghost package files on disk with no database record are handled separately)
-        if current_app:
-            current_app.logger.debug("verify package file exists")
-        try:
-            # check package file exists on disk
-            if not os.path.exists(package_cache_pathname):
+    for dataset_id, packages in packages_by_dataset.items():
+
+        dataset_modified = dataset_modified_timestamps.get(dataset_id)
+
+        for package in packages:
+
+            # Check for packages which are missing the package file on disk
+            # (ghost package files on disk with no database record are handled separately)
+            package_file_size = package_file_sizes.get(package.filename)
+            if package_file_size is None:
                 if current_app:
                     current_app.logger.info("Package %s is invalid: package file missing from file system" % package.filename)
                 invalid_packages.append(package)
-        except Exception as e:
-            if current_app:
-                current_app.logger.error("Error checking file exists for package %s: %s" % (package.filename, str(e)))
+                continue
 
-        # Check for packages which have zero file size either in database or on disk
-        if current_app:
-            current_app.logger.debug("verify package file size is not zero")
-        try:
-            # check package record file size not zero
+            # Check for packages which have zero file size either in database or on disk
             if package.size_bytes == 0:
                 if current_app:
                     current_app.logger.warn("Package %s is invalid: package file size recorded in database has zero size" % package.filename)
                 invalid_packages.append(package)
-            # check package file size on disk not zero
-            if os.path.exists(package_cache_pathname) and os.path.getsize(package_cache_pathname) == 0:
+                continue
+            if package_file_size == 0:
                 if current_app:
                     current_app.logger.warn("Package %s is invalid: package file in file system has zero size" % package.filename)
                 invalid_packages.append(package)
-        except Exception as e:
-            if current_app:
-                current_app.logger.error("Error checking file size for package %s: %s" % (package.filename, str(e)))
-
-        # Check for packages which are older than the dataset modification timestamp
-        if current_app:
-            current_app.logger.debug("verify package not older than dataset modification timestamp")
-        try:
-            dataset_id = db.get_dataset_id_for_package(package.filename)
-            package_generated = normalize_timestamp(package.generated_at)
-            dataset_modified = metax.get_dataset_modified_from_metax(dataset_id)
-            if current_app:
-                current_app.logger.debug("Package generated: %s Dataset modified: %s" % (package_generated, dataset_modified))
-            if package_generated < dataset_modified:
+                continue
+
+            # Check for packages which are older than the dataset modification timestamp
+            try:
+                package_generated = normalize_timestamp(package.generated_at)
+                if dataset_id and dataset_id not in dataset_modified_timestamps:
+                    raise Exception("Modification timestamp of dataset %s could not be retrieved" % dataset_id)
+                if dataset_modified is None:
+                    raise metax.DatasetNotFound(dataset_id)
+                if current_app:
+                    current_app.logger.debug("Package generated: %s Dataset modified: %s" % (package_generated, dataset_modified))
+                if package_generated < dataset_modified:
+                    if current_app:
+                        current_app.logger.warn("Package %s is invalid: package generated earlier (%s) than the dataset %s was last modified (%s)" % (
+                            package.filename,
+                            package_generated,
+                            dataset_id,
+                            dataset_modified
+                        ))
+                    invalid_packages.append(package)
+            except metax.DatasetNotFound:
                 if current_app:
-                    current_app.logger.warn("Package %s is invalid: package generated earlier (%s) than the dataset %s was last modified (%s)" % (
-                        package.filename,
-                        package_generated,
-                        dataset_id,
-                        dataset_modified
-                    ))
+                    current_app.logger.warn("Package %s is invalid: dataset not found in Metax" % package.filename)
                 invalid_packages.append(package)
-        except metax.DatasetNotFound:
-            if current_app:
-                current_app.logger.warn("Package %s is invalid: dataset not found in Metax" % package.filename)
-            invalid_packages.append(package)
-        except Exception as e:
-            if current_app:
-                current_app.logger.error("Error checking modification timestamps for package %s: %s" % (package.filename, str(e)))
+            except Exception as e:
+                if current_app:
+                    current_app.logger.error("Error checking modification timestamps for package %s: %s" % (package.filename, str(e)))
 
     return invalid_packages
 
 
-def select_packages_to_be_removed(clear_size: int, active_packages: List[Package]):
+def get_package_file_sizes():
+    """Returns the sizes of all package files in the cache, keyed by filename, from a single directory listing."""
+    package_file_sizes = {}
+    with os.scandir(get_datasets_dir()) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    package_file_sizes[entry.name] = entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                # The file was removed concurrently
+                continue
+    return package_file_sizes
+
+
+def select_packages_to_be_removed(clear_size: int, active_packages: List[Package], now: int = None):
     """Selects packages that will be pruned from the cache volume due to cache volume limits.
 
     :param clear_size: Amount of storage in bytes that needs be cleared
     :param active_packages: List of data about the packages in the cache. Includes filename, size in bytes, timestamps
                             when the package was generated and last downloaded, and the overall number of downloads.
+    :param now: Current time as epoch seconds, if other than the actual current time
     """
 
     if current_app:
@@ -254,7 +370,8 @@ def select_packages_to_be_removed(clear_size: int, active_packages: List[Package
     removable_packages = []
 
     # constants
-    now = pendulum.now()
+    if now is None:
+        now = int(time.time())
     expired_bytes = 0
 
     for package in active_packages:
@@ -263,11 +380,11 @@ def select_packages_to_be_removed(clear_size: int, active_packages: List[Package
         # If the package is not already expired, and either is older than 7 days with no no downloads,
         # or its last download is more than than 30 days ago, mark as expired
         if not package.expired:
-            if package.generated_at.diff(now).in_days() > 7 and package.no_downloads == 0:
+            if (now - package.generated_at) // DAY > 7 and package.no_downloads == 0:
                 if current_app:
                     current_app.logger.info("Package %s expired as it is older than 7 days with no downloads" % package.filename)
                 package.expired = True
-            elif package.last_downloaded and package.last_downloaded.diff(now).in_days() > 30:
+            elif package.last_downloaded and (now - package.last_downloaded) // DAY > 30:
                 if current_app:
                     current_app.logger.info("Package %s expired as its last download is more than 30 days ago" % package.filename)
                 package.expired = True
@@ -289,7 +406,7 @@ def select_packages_to_be_removed(clear_size: int, active_packages: List[Package
                 and package.last_downloaded
             ):
                 rank = package.no_downloads * 10
-                rank += 30 - package.last_downloaded.diff(now).in_days()
+                rank += 30 - (now - package.last_downloaded) // DAY
                 if package.size_bytes <= GB:
                     rank += 50
 
@@ -313,6 +430,207 @@ def select_packages_to_be_removed(clear_size: int, active_packages: List[Package
     return removable_packages, expired_packages, ranked_packages
 
 
+class EvictionPolicy:
+    """Cache eviction policy, selecting the packages to be removed from the cache to clear the required space.
+
+    Unless the selection is overridden, packages are removed in the order of their priority, lowest first,
+    until the removed packages are large enough to clear the required space.
+    """
+
+    name = None
+
+    def __init__(self, persistent: bool = False):
+        """
+        :param persistent: Whether any state of the policy is recorded in the database between selections
+        """
+        self.persistent = persistent
+
+    def priority(self, package: Package, now: int):
+        raise NotImplementedError()
+
+    def prepare(self, active_packages: List[Package]):
+        """Prepares the policy for the selection of packages from the specified packages."""
+        pass
+
+    def select(self, clear_size: int, active_packages: List[Package], now: int = None):
+        """Selects the packages to be removed from the cache.
+
+        :param clear_size: Amount of storage in bytes that needs be cleared
+        :param active_packages: List of data about the packages in the cache
+        :param now: Current time as epoch seconds, if other than the actual current time
+        """
+        if now is None:
+            now = int(time.time())
+        self.prepare(active_packages)
+        for package in active_packages:
+            package.rank = self.priority(package, now)
+        removable_packages = []
+        cleared_bytes = 0
+        for package in sorted(active_packages):
+            if cleared_bytes >= clear_size:
+                break
+            removable_packages.append(package)
+            cleared_bytes += package.size_bytes
+        return removable_packages
+
+
+def get_last_access(package: Package):
+    """Returns the time when the package was last downloaded, or generated if never downloaded, as epoch seconds."""
+    return max(package.last_downloaded or 0, package.generated_at or 0)
+
+
+class HeuristicPolicy(EvictionPolicy):
+    """Removes packages which have expired, being older than 7 days with no downloads or last downloaded more than
+    30 days ago, and then packages ranked by their number of downloads, age of their last download and size.
+    """
+
+    name = 'heuristic'
+
+    def select(self, clear_size: int, active_packages: List[Package], now: int = None):
+        removable_packages, expired_packages, ranked_packages = select_packages_to_be_removed(clear_size, active_packages, now)
+        return removable_packages
+
+
+class LRUPolicy(EvictionPolicy):
+    """Removes the least recently used packages first."""
+
+    name = 'lru'
+
+    def priority(self, package: Package, now: int):
+        return get_last_access(package)
+
+
+class LFUPolicy(EvictionPolicy):
+    """Removes the least frequently downloaded packages first, the least recently used first among equals."""
+
+    name = 'lfu'
+
+    def priority(self, package: Package, now: int):
+        return (package.no_downloads, get_last_access(package))
+
+
+class GDSFPolicy(EvictionPolicy):
+    """GreedyDual-Size-Frequency: removes packages with the lowest frequency relative to their size first, so that
+    many small popular packages are kept at the expense of few large ones, with the cost of regenerating each
+    package taken to be the same.
+
+    The priority of each package includes the inflation value of the policy at the time of the last access of the
+    package, being the highest priority of the packages removed by the policy before then, so that packages
+    remaining in the cache without being accessed age relative to those accessed since. The policy keeps the
+    history of its inflation values with the times from which they apply, which, if the policy is persistent, is
+    recorded in the database as a housekeeping state, so that packages age across successive cache cleanups.
+    """
+
+    name = 'gdsf'
+
+    def __init__(self, persistent: bool = False):
+        super().__init__(persistent)
+        # Inflation values and the times as epoch seconds from which they apply, in the order of the times
+        self.inflation_times = []
+        self.inflations = []
+
+    @property
+    def state_name(self):
+        return '%s_inflation' % self.name
+
+    @property
+    def inflation(self):
+        return self.inflations[-1] if len(self.inflations) > 0 else 0.0
+
+    def inflation_at(self, timestamp: int):
+        """Returns the inflation value of the policy at the specified time as epoch seconds."""
+        index = bisect.bisect_right(self.inflation_times, timestamp)
+        return self.inflations[index - 1] if index > 0 else 0.0
+
+    def prepare(self, active_packages: List[Package]):
+        if self.persistent:
+            history = db.get_housekeeping_state(self.state_name)
+            if history:
+                self.inflation_times, self.inflations = (list(values) for values in zip(*json.loads(history)))
+
+    def cost(self, package: Package):
+        return 1.0
+
+    def priority(self, package: Package, now: int):
+        return (self.inflation_at(get_last_access(package))
+                + (package.no_downloads + 1) * self.cost(package) / max(package.size_bytes, 1))
+
+    def select(self, clear_size: int, active_packages: List[Package], now: int = None):
+        if now is None:
+            now = int(time.time())
+        removable_packages = super().select(clear_size, active_packages, now)
+        inflation = max([self.inflation] + [package.rank for package in removable_packages])
+        if inflation > self.inflation:
+            if len(self.inflation_times) > 0 and self.inflation_times[-1] == now:
+                self.inflation_times.pop()
+                self.inflations.pop()
+            self.inflation_times.append(now)
+            self.inflations.append(inflation)
+            # The inflation values preceding the value at the earliest last access of the packages remaining in
+            # the cache are no longer needed, and at most MAX_INFLATION_HISTORY values are kept in any case
+            removed = set(package.filename for package in removable_packages)
+            last_accesses = [get_last_access(package) for package in active_packages if package.filename not in removed]
+            first = max(bisect.bisect_right(self.inflation_times, min(last_accesses + [now])) - 1,
+                        len(self.inflations) - MAX_INFLATION_HISTORY, 0)
+            del self.inflation_times[:first]
+            del self.inflations[:first]
+            if self.persistent:
+                db.set_housekeeping_state(self.state_name, json.dumps(list(zip(self.inflation_times, self.inflations))))
+        return removable_packages
+
+
+class CostAwarePolicy(GDSFPolicy):
+    """GreedyDual-Size-Frequency with the cost of regenerating each package taken to be its measured generation
+    time, so that packages which are slow to generate relative to their size are kept in preference. The cost
+    of packages whose generation time was not measured is estimated from the average generation time per byte
+    of the packages whose generation time was measured.
+    """
+
+    name = 'cost'
+
+    # Generation seconds per byte assumed if the generation time of no package has been measured
+    DEFAULT_SECONDS_PER_BYTE = 1e-8
+
+    def prepare(self, active_packages: List[Package]):
+        super().prepare(active_packages)
+        measured = [package for package in active_packages if package.generation_seconds and package.size_bytes]
+        if len(measured) > 0:
+            self.seconds_per_byte = (
+                sum(package.generation_seconds for package in measured) / sum(package.size_bytes for package in measured))
+        else:
+            self.seconds_per_byte = self.DEFAULT_SECONDS_PER_BYTE
+
+    def cost(self, package: Package):
+        if package.generation_seconds:
+            return package.generation_seconds
+        return max(package.size_bytes, 1) * self.seconds_per_byte
+
+
+EVICTION_POLICIES = dict((policy.name, policy) for policy in [
+    HeuristicPolicy,
+    LRUPolicy,
+    LFUPolicy,
+    GDSFPolicy,
+    CostAwarePolicy
+])
+
+
+def get_eviction_policy(name: str = None, persistent: bool = False):
+    """Returns a new instance of the specified cache eviction policy, or of the policy configured with
+    CACHE_EVICTION_POLICY.
+
+    :param name: Name of the policy: heuristic (default), lru, lfu, gdsf or cost
+    :param persistent: Whether any state of the policy is recorded in the database between selections
+    :raises ValueError: The policy is not known
+    """
+    if name is None:
+        name = current_app.config.get('CACHE_EVICTION_POLICY', 'heuristic')
+    policy = EVICTION_POLICIES.get(name.lower())
+    if policy is None:
+        raise ValueError("Unknown cache eviction policy '%s'" % name)
+    return policy(persistent)
+
+
 def print_statistics():
     cache_stats = db.get_cache_stats()
     table_headers = [
@@ -338,21 +656,33 @@ def remove_cache_files(files_list: List[Package] = None):
 
         removed_files = []
 
-        # Remove all package records for the specified package filenames
+        datasets_dir = get_datasets_dir()
 
-        db.delete_package_rows(file_names)
+        # If enabled, package files are moved to the trash directory, from which they are removed in the
+        # background, so that the removal of large files does not delay the caller
 
-        # Remove the actual package files, if they exist
+        trash_dir = get_trash_dir() if current_app.config.get("CACHE_TRASH", False) else None
 
-        source_root = os.path.join(current_app.config["DOWNLOAD_CACHE_DIR"], "datasets")
+        # Remove the package records and the actual package files, if they exist, in batches, removing the
+        # records of each batch in the same transaction as its files
 
-        for root, dirs, files in os.walk(source_root):
-            for name in files:
-                if name in file_names:
-                    package_cache_pathname = os.path.join(root, name)
-                    if os.path.exists(package_cache_pathname):
+        for i in range(0, len(file_names), db.MAX_QUERY_PARAMETERS):
+            batch = file_names[i:i + db.MAX_QUERY_PARAMETERS]
+            db.delete_package_rows(batch, commit=False)
+            for name in batch:
+                package_cache_pathname = os.path.join(datasets_dir, name)
+                try:
+                    if trash_dir:
+                        os.replace(package_cache_pathname, os.path.join(trash_dir, name))
+                    else:
                         os.remove(package_cache_pathname)
-                        removed_files.append(name)
+                except FileNotFoundError:
+                    continue
+                removed_files.append(name)
+            db.get_db().commit()
+
+        if trash_dir and len(removed_files) > 0:
+            threading.Thread(target=empty_trash, args=(trash_dir,), daemon=True).start()
 
         current_app.logger.info(f"Removed {len(file_names)} package records")
         current_app.logger.info(f"Removed {len(removed_files)} package files")
@@ -369,6 +699,33 @@ def get_datasets_dir():
     return cache_dir
 
 
+def get_trash_dir():
+    trash_dir = os.path.join(current_app.config['DOWNLOAD_CACHE_DIR'], 'trash')
+    if not os.path.exists(trash_dir):
+        os.makedirs(trash_dir)
+    return trash_dir
+
+
+def empty_trash(trash_dir):
+    """Removes all files from the trash directory of the cache, if it exists.
+
+    :param trash_dir: Pathname of the trash directory
+    :returns: Number of removed files
+    """
+    removed = 0
+    if not os.path.isdir(trash_dir):
+        return removed
+    with os.scandir(trash_dir) as entries:
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                # The file was removed concurrently
+                continue
+    return removed
+
+
 def get_mock_notifications_dir():
     mock_notifications_dir = os.path.join(current_app.config['DOWNLOAD_CACHE_DIR'], 'mock_notifications')
 
@@ -384,9 +741,13 @@ cache_cli = AppGroup(
 
 
 @cache_cli.command("housekeep")
-def housekeep_command():
+@click.option("--time-limit", type=float, default=None,
+              help="Maximum duration of package validation in seconds (default CACHE_HOUSEKEEPING_TIME_LIMIT).")
+def housekeep_command(time_limit):
     """Execute cache housekeeping operation."""
-    print(perform_housekeeping())
+    if time_limit is None:
+        time_limit = float(current_app.config.get("CACHE_HOUSEKEEPING_TIME_LIMIT", 300))
+    print(perform_housekeeping(time_limit))
 
 
 @cache_cli.command("validate")
@@ -413,6 +774,54 @@ def purge_command():
     print(purge_ghost_files())
 
 
+@cache_cli.command("invalidate")
+@click.argument("dataset")
+@click.option("--modified", help="Modification timestamp of the dataset, retrieved from Metax if not specified.")
+@click.option("--regenerate", is_flag=True, help="Regenerate popular invalidated packages.")
+def invalidate_command(dataset, modified, regenerate):
+    """Invalidate packages and tasks predating the modification of a dataset."""
+    from .task_service import invalidate_dataset
+    print(invalidate_dataset(dataset, modified, regenerate))
+
+
+@cache_cli.command("simulate")
+@click.option("--database", type=click.Path(exists=True, dir_okay=False),
+              help="SQLite database snapshot whose download history is replayed (default DATABASE_FILE).")
+@click.option("--events", type=click.Path(exists=True, dir_okay=False), multiple=True,
+              help="Legacy metrics event file whose download events are replayed, instead of a database snapshot.")
+@click.option("--policy", multiple=True,
+              help="Eviction policy simulated; may be repeated (default all policies).")
+@click.option("--threshold", type=int, multiple=True,
+              help="Cache purge threshold in bytes; may be repeated (default CACHE_PURGE_THRESHOLD).")
+@click.option("--target", type=int, multiple=True,
+              help="Cache purge target in bytes, one per threshold (default 75% of each threshold).")
+@click.option("--package-size", type=int, default=GB, show_default=True,
+              help="Size in bytes assumed for packages of unknown size.")
+def simulate_command(database, events, policy, threshold, target, package_size):
+    """Simulate cache eviction policies and volume limits by replaying download history."""
+    from .simulation import load_database_trace, load_event_trace, simulate
+    if events:
+        trace = load_event_trace(events, package_size)
+    else:
+        trace = load_database_trace(database or current_app.config["DATABASE_FILE"], package_size)
+    policies = policy or list(EVICTION_POLICIES)
+    thresholds = threshold or [int(current_app.config["CACHE_PURGE_THRESHOLD"])]
+    if target and len(target) != len(thresholds):
+        raise click.BadParameter("One target must be specified for each threshold.", param_hint="--target")
+    if not target:
+        if threshold:
+            target = [i * 3 // 4 for i in thresholds]
+        else:
+            target = [int(current_app.config["CACHE_PURGE_TARGET"])]
+    results = [
+        simulate(trace, policy_name, policy_threshold, policy_target)
+        for policy_threshold, policy_target in zip(thresholds, target)
+        for policy_name in policies
+    ]
+    print("Replayed %d requests for %d packages" % (len(trace.times), len(trace.keys)))
+    print(tabulate(results, headers="keys"))
+
+
 @cache_cli.command("stats")
 def stats_command():
     """Print general cache volume usage statistics."""
@@ -423,5 +832,12 @@ def init_app(app):
     """Hooks cache module to given Flask application.
 
     :param app: Flask application to hook module into.
+    :raises ValueError: The configured cache eviction policy is not known
     """
+    # Validate the configured cache eviction policy when the application starts, rather than when the cache is
+    # first cleaned up by the generator, which only logs the errors of cache cleanups
+    policy_name = app.config.get('CACHE_EVICTION_POLICY', 'heuristic')
+    if policy_name.lower() not in EVICTION_POLICIES:
+        raise ValueError("Unknown cache eviction policy '%s' configured with CACHE_EVICTION_POLICY" % policy_name)
+
     app.cli.add_command(cache_cli)
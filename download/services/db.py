@@ -5,39 +5,108 @@ download.db
 Database module for Fairdata Download Service.
 """
 import os
-import sqlite3
+import threading
 import json
+import zlib
+import gzip
+import time
+import hashlib
 import click
-import pendulum
 import dateutil.parser
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import current_app, g
 from flask.cli import AppGroup
-from jwt import decode
+from jwt import decode, DecodeError
 from ..dto import Package
 from ..utils import normalize_timestamp
+from .backends import get_backend
+from .tracing import tracing_enabled, TracedConnection
+
+# Maximum number of values bound in a single IN (...) clause, below the SQLite default variable limit
+MAX_QUERY_PARAMETERS = 500
+
+# Separator of filepaths in compressed generate scopes, which cannot occur in any filepath
+SCOPE_SEPARATOR = '\0'
+
+# Maximum number of bytes decompressed at a time when iterating over a compressed generate scope
+SCOPE_CHUNK_SIZE = 65536
+
+# Maximum number of download records archived in a single compressed archive row
+ARCHIVE_BATCH_SIZE = 10000
+
+# Databases to which pending migrations have been applied by this process
+migrated_databases = set()
+
+# Pooled database connections of the current thread, keyed by database
+pool = threading.local()
+
+# Pooled connections inherited from a parent process, which must never be used nor closed by a forked child
+# process, as closing them would release the locks held by the parent process
+inherited_connections = []
+
+
+def get_pooled_db():
+    """
+    Returns the pooled database connection of the current thread and process, connecting to the database if no
+    connection is pooled yet.
+    """
+    connections = getattr(pool, 'connections', None)
+
+    if connections is None or pool.pid != os.getpid():
+        if connections:
+            inherited_connections.extend(connections.values())
+        connections = pool.connections = {}
+        pool.pid = os.getpid()
+
+    backend = get_backend()
+    database = backend.database(current_app)
+
+    db_conn = connections.get(database)
+
+    if db_conn is None:
+
+        current_app.logger.debug('Connecting to database %s' % (database, ))
+
+        db_conn = backend.connect(current_app)
+
+        if tracing_enabled(current_app):
+            db_conn = TracedConnection(db_conn)
+
+        connections[database] = db_conn
+
+        current_app.logger.debug('Connected to database %s' % (database, ))
+
+    return db_conn
+
+
+def close_pooled_db():
+    """
+    Closes and removes all pooled database connections of the current thread.
+    """
+    connections = getattr(pool, 'connections', None)
+
+    if connections and pool.pid == os.getpid():
+        for db_conn in connections.values():
+            db_conn.close()
+
+    pool.connections = {}
+    pool.pid = os.getpid()
 
 
 def get_db():
     """
-    Returns database connection from global scope, or connects to database if no conection is already established.
+    Returns database connection from global scope, or takes the pooled connection of the current thread into use
+    if no connection is already established.
     """
     init_schema = False
 
     if 'db' not in g:
 
-        current_app.logger.debug('Connecting to database %s' % (current_app.config['DATABASE_FILE'], ))
-
-        if not os.path.isfile(current_app.config['DATABASE_FILE']):
+        # Initialize the schema, applying any pending migrations, on the first connection by this process
+        if get_backend().database(current_app) not in migrated_databases:
             init_schema = True
 
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE_FILE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
-
-        current_app.logger.debug('Connected to database %s' % (current_app.config['DATABASE_FILE'], ))
+        g.db = get_pooled_db()
 
     if init_schema:
         init_db()
@@ -47,30 +116,108 @@ def get_db():
 
 def close_db(e=None):
     """
-    Removes database connection from global scope and disconnects from database.
+    Removes database connection from global scope, rolling back any uncommitted transaction before the connection
+    is returned to the pool.
     """
     db_conn = g.pop('db', None)
 
     if db_conn is not None:
-        db_conn.close()
+        if db_conn.in_transaction:
+            db_conn.rollback()
 
         current_app.logger.debug(
-            'Disconnected from database on %s' %
-            (current_app.config['DATABASE_FILE'], ))
+            'Released connection to database on %s' %
+            (get_backend().database(current_app), ))
 
 
 def init_db():
     """
-    Initializes database by creating tables that don't exist.
+    Initializes database by creating tables that don't exist and applying all pending migrations.
     """
     db_conn = get_db()
+    backend = get_backend()
 
-    with current_app.open_resource('sql/create_tables.sql') as migration_file:
+    with current_app.open_resource('%s/create_tables.sql' % backend.sql_dir) as migration_file:
         db_conn.executescript(migration_file.read().decode('utf8'))
 
+    migrate_db()
+
     current_app.logger.debug(
         'Initialized database on %s' %
-        (current_app.config['DATABASE_FILE'], ))
+        (backend.database(current_app), ))
+
+
+def get_migrations():
+    """
+    Returns a list of (version, filename) tuples of all schema migrations of the configured database backend,
+    ordered by version.
+
+    Migrations are SQL files in the migrations directory of the backend, e.g. sql/migrations, named with a numeric
+    version prefix, e.g. 0001_description.sql, applied on top of the tables created by create_tables.sql of the
+    backend. The same version numbers are used for equivalent migrations of all backends.
+    """
+    migrations_dir = os.path.join(current_app.root_path, get_backend().sql_dir, 'migrations')
+
+    migrations = []
+    if os.path.isdir(migrations_dir):
+        for filename in os.listdir(migrations_dir):
+            if filename.endswith('.sql'):
+                migrations.append((int(filename.split('_', 1)[0]), filename))
+
+    return sorted(migrations)
+
+
+def get_schema_version():
+    """
+    Returns the version of the last schema migration applied to the database.
+    """
+    return get_backend().get_schema_version(get_db())
+
+
+def migrate_db():
+    """
+    Applies all schema migrations with a version greater than the current schema version of the database. Each
+    migration and the update of the schema version are applied in a single exclusive write transaction in which
+    the schema version is re-checked, so processes starting concurrently never apply the same migration twice.
+
+    :returns: List of filenames of the applied migrations
+    """
+    db_conn = get_db()
+    backend = get_backend()
+
+    applied = []
+
+    for version, filename in get_migrations():
+
+        if version <= backend.get_schema_version(db_conn):
+            continue
+
+        with current_app.open_resource('%s/migrations/%s' % (backend.sql_dir, filename)) as migration_file:
+            migration = migration_file.read().decode('utf8')
+
+        backend.lock_schema(db_conn)
+
+        try:
+            if version <= backend.get_schema_version(db_conn):
+                db_conn.rollback()
+                continue
+            for statement in backend.split_statements(migration):
+                db_conn.execute(statement)
+            backend.set_schema_version(db_conn, version)
+            db_conn.commit()
+        except Exception:
+            db_conn.rollback()
+            raise
+
+        applied.append(filename)
+
+        current_app.logger.info(
+            'Applied migration %s to database %s' %
+            (filename, backend.database(current_app)))
+
+    migrated_databases.add(backend.database(current_app))
+
+    return applied
 
 
 def get_download_record_by_token(token):
@@ -88,6 +235,32 @@ def get_download_record_by_token(token):
     ).fetchone()
 
 
+def get_token_hash(token):
+    """
+    Returns the hash by which a used authentication token is recorded once its download record is archived.
+
+    :param token: JWT encoded authentication token
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def is_token_used(token):
+    """
+    Returns whether the specified authentication token has already been used, either by a download record
+    or, once the download record has been archived, by its recorded hash.
+
+    :param token: JWT encoded authentication token
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    return db_cursor.execute(
+        'SELECT 1 WHERE EXISTS (SELECT 1 FROM download WHERE token = ?) '
+        'OR EXISTS (SELECT 1 FROM used_token WHERE token_hash = ?)',
+        (token, get_token_hash(token))
+    ).fetchone() is not None
+
+
 def get_download_record_by_id(download_id):
     """
     Returns a row from download table for a given record id
@@ -109,51 +282,72 @@ def get_request_scopes(task_id):
 
     :param task_id: ID of the partial file generation task
     """
+    return get_request_scopes_for_tasks([task_id]).get(task_id, [])
+
+
+def get_request_scopes_for_tasks(task_ids):
+    """
+    Returns the sets of scopes that have been requested and are fulfilled by each of the specified partial file
+    generation tasks, with a single query per MAX_QUERY_PARAMETERS tasks.
+
+    :param task_ids: IDs of the partial file generation tasks
+    :returns: Dict of lists of sets of scopes keyed by task id, omitting tasks with no requests
+    """
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    generate_requests = db_cursor.execute(
-        'SELECT id FROM generate_request WHERE task_id = ?',
-        (task_id,)
-    ).fetchall()
-
-    request_scopes = []
-    for generate_request in generate_requests:
-        request_scope = db_cursor.execute(
-            'SELECT prefix FROM generate_request_scope WHERE request_id = ?',
-            (generate_request['id'],)
+    task_ids = list(task_ids)
+    request_scopes = {}
+
+    for i in range(0, len(task_ids), MAX_QUERY_PARAMETERS):
+        chunk = task_ids[i:i + MAX_QUERY_PARAMETERS]
+        rows = db_cursor.execute(
+            'SELECT r.task_id, r.id, s.prefix '
+            'FROM generate_request r '
+            'LEFT JOIN generate_request_scope s ON s.request_id = r.id '
+            'WHERE r.task_id IN (%s) '
+            'ORDER BY r.id' % ', '.join('?' * len(chunk)),
+            chunk
         ).fetchall()
 
-        request_scopes.append(
-            set(map(lambda scope_row: scope_row['prefix'], request_scope)))
+        request_ids = {}
+        for row in rows:
+            if row['id'] not in request_ids:
+                request_ids[row['id']] = set()
+                request_scopes.setdefault(row['task_id'], []).append(request_ids[row['id']])
+            if row['prefix'] is not None:
+                request_ids[row['id']].add(row['prefix'])
 
     return request_scopes
 
 
-def update_task_id(old_task_id, new_task_id):
+def get_packages_for_tasks(task_ids):
     """
-    Updates task id in all records of tables containing them, replacing the old task id with the new task id
-    (used to replace a temporary id of a new task with the actual id of a queued task)
+    Returns the package records of the specified tasks, with a single query per MAX_QUERY_PARAMETERS tasks.
 
-    :param old_task_id: the old task id to be replaced
-    :param new_task_id: the new task id to be recorded
+    :param task_ids: IDs of the tasks that initiated the package generation
+    :returns: Dict of package records keyed by task id, omitting tasks with no package
     """
-
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    db_cursor.execute("UPDATE generate_task    SET task_id = ? WHERE task_id = ?", (new_task_id, old_task_id))
-    db_cursor.execute("UPDATE generate_scope   SET task_id = ? WHERE task_id = ?", (new_task_id, old_task_id))
-    db_cursor.execute("UPDATE generate_request SET task_id = ? WHERE task_id = ?", (new_task_id, old_task_id))
-    db_cursor.execute("UPDATE subscription     SET task_id = ? WHERE task_id = ?", (new_task_id, old_task_id))
+    task_ids = list(task_ids)
+    packages = {}
 
-    db_conn.commit()
+    for i in range(0, len(task_ids), MAX_QUERY_PARAMETERS):
+        chunk = task_ids[i:i + MAX_QUERY_PARAMETERS]
+        for row in db_cursor.execute(
+                'SELECT * FROM package WHERE generated_by IN (%s)' % ', '.join('?' * len(chunk)), chunk):
+            packages[row['generated_by']] = row
+
+    return packages
 
 
 def update_task_status(task_id, status):
     """
-    Updates the task matching the specified task_id with the specified status.
-    (used to replace the temporary NEW status of a new task with PENDING when the task is queued)
+    Updates the task matching the specified task_id with the specified status, unless the task has been marked
+    as outdated.
+    (used to replace the NEW status of a new task with PENDING when the task is queued)
 
     :param task_id: the task id of the task
     :param status: the task status to be recorded
@@ -162,17 +356,84 @@ def update_task_status(task_id, status):
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    db_cursor.execute("UPDATE generate_task    SET status = ? WHERE task_id = ?", (status, task_id))
+    db_cursor.execute(
+        "UPDATE generate_task SET status = ? WHERE task_id = ? AND coalesce(status, '') != 'OUTDATED'", (status, task_id))
+
+    db_conn.commit()
+
+
+def update_task_done(task_id, status, traceback=None):
+    """
+    Records the completion of the task matching the specified task_id with the specified final status,
+    as reported by the generator, with the current time as the completion time. A task marked as outdated while
+    being generated keeps its status.
+
+    :param task_id: the task id of the task
+    :param status: the final task status, SUCCESS or FAILURE
+    :param traceback: traceback of the exception with which the task failed, if any
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    db_cursor.execute(
+        "UPDATE generate_task SET status = ?, date_done = CURRENT_TIMESTAMP, traceback = ? "
+        "WHERE task_id = ? AND coalesce(status, '') != 'OUTDATED'",
+        (status, traceback, task_id))
+
+    db_conn.commit()
+
+    current_app.logger.info("Set status of task '%s' to '%s'" % (task_id, status))
+
+
+def update_task_retry(task_id):
+    """
+    Records the task matching the specified task_id as waiting to be retried, as reported by the generator.
+
+    :param task_id: the task id of the task
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    db_cursor.execute(
+        "UPDATE generate_task SET status = 'RETRY', retries = coalesce(retries, 0) + 1 "
+        "WHERE task_id = ? AND coalesce(status, '') != 'OUTDATED'",
+        (task_id,))
+
+    db_conn.commit()
+
+
+def get_scope_hash(generate_scope):
+    """
+    Returns a canonical digest of a generate scope, independent of the order of its filepaths.
+
+    :param generate_scope: Iterable of all the filepaths included in a package
+    """
+    return hashlib.sha256(json.dumps(sorted(generate_scope)).encode('utf-8')).hexdigest()
+
+
+def update_task_scope_hash(task_id, scope_hash):
+    """
+    Records the scope hash of a task created before scope hashes were recorded for new tasks.
+
+    :param task_id: the task id of the task
+    :param scope_hash: the digest of the generate scope of the task
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    db_cursor.execute("UPDATE generate_task SET scope_hash = ? WHERE task_id = ?", (scope_hash, task_id))
 
     db_conn.commit()
 
 
-def get_task_rows(dataset_id, initiated_after):
+def get_task_rows(dataset_id, initiated_after, scope_hash=None):
     """
     Returns rows from file_generate table for a dataset, or for all datasets of no dataset id specified. 
 
     :param dataset_id: ID of dataset for which task rows are fetched, if specified
     :param initiated_after: timestamp after which fetched tasks may have been initialized, ignored if no dataset_id specified
+    :param scope_hash: digest of generate scope of fetched tasks, if specified, ignored if no dataset_id specified;
+                       tasks with no recorded scope hash are always included
     """
 
     db_conn = get_db()
@@ -190,15 +451,30 @@ def get_task_rows(dataset_id, initiated_after):
         elif not isinstance(initiated_after, datetime):
             raise Exception("Invalid timestamp value")
 
+        if scope_hash:
+            return db_cursor.execute(
+                'SELECT dataset_id, initiated, date_done, task_id, status, is_partial, scope_hash '
+                'FROM generate_task t '
+                'LEFT JOIN package p '
+                'ON t.task_id = p.generated_by '
+                'WHERE t.dataset_id = ? '
+                'AND (t.scope_hash = ? OR t.scope_hash IS NULL) '
+                'AND t.initiated > ? '
+                "AND ((t.status = 'SUCCESS' and p.filename is not null) "
+                "  OR (coalesce(t.status, '') not in ('SUCCESS', 'FAILURE', 'OUTDATED'))) "
+                'ORDER BY t.id ASC ',
+                (dataset_id, scope_hash, initiated_after)
+            ).fetchall()
+
         return db_cursor.execute(
-            'SELECT initiated, date_done, task_id, status, is_partial '
+            'SELECT dataset_id, initiated, date_done, task_id, status, is_partial, scope_hash '
             'FROM generate_task t '
             'LEFT JOIN package p '
             'ON t.task_id = p.generated_by '
             'WHERE t.dataset_id = ? '
             'AND t.initiated > ? '
-            'AND ((t.status is "SUCCESS" and p.filename is not null) '
-            '  OR (t.status is not "SUCCESS" and t.status is not "FAILURE")) '
+            "AND ((t.status = 'SUCCESS' and p.filename is not null) "
+            "  OR (coalesce(t.status, '') not in ('SUCCESS', 'FAILURE', 'OUTDATED'))) "
             'ORDER BY t.id ASC ',
             (dataset_id, initiated_after)
         ).fetchall()
@@ -208,8 +484,8 @@ def get_task_rows(dataset_id, initiated_after):
             'FROM generate_task t '
             'LEFT JOIN package p '
             'ON t.task_id = p.generated_by '
-            'WHERE ((t.status is "SUCCESS" and p.filename is not null) '
-            '    OR (t.status is not "SUCCESS" and t.status is not "FAILURE")) '
+            "WHERE ((t.status = 'SUCCESS' and p.filename is not null) "
+            "    OR (coalesce(t.status, '') not in ('SUCCESS', 'FAILURE', 'OUTDATED'))) "
             'ORDER BY t.id ASC '
         ).fetchall()
 
@@ -227,7 +503,7 @@ def get_task_rows_for_status(status):
     return db_cursor.execute(
         'SELECT * '
         'FROM generate_task '
-        'WHERE status is ? '
+        'WHERE status = ? '
         'ORDER BY id ASC ',
         (status,)
     ).fetchall()
@@ -291,7 +567,8 @@ def create_download_record(token, filename):
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    db_cursor.execute(
+    download_id = get_backend().insert(
+        db_cursor,
         'INSERT INTO download (token, filename) VALUES (?, ?)',
         (token, filename)
     )
@@ -302,7 +579,7 @@ def create_download_record(token, filename):
         "Created a new download record for package '%s' with token '%s'"
         % (filename, token))
 
-    return db_cursor.lastrowid
+    return download_id
 
 
 def finalize_download_record(download_id, successful=True):
@@ -318,13 +595,188 @@ def finalize_download_record(download_id, successful=True):
 
     status = 'SUCCESSFUL' if successful else 'FAILED'
 
-    db_cursor.execute('UPDATE download SET status = ?, finished = DATETIME() WHERE id = ?', (status, download_id))
+    db_cursor.execute('UPDATE download SET status = ?, finished = CURRENT_TIMESTAMP WHERE id = ?', (status, download_id))
+
+    # Maintain the usage statistics of the package, if a package was downloaded, so that cache management
+    # never needs to aggregate the download history
+    if successful:
+        db_cursor.execute(
+            'INSERT INTO package_stats (filename, no_downloads, last_downloaded, bytes_served) '
+            'SELECT p.filename, 1, ?, coalesce(p.size_bytes, 0) '
+            'FROM download d JOIN package p ON p.filename = d.filename '
+            'WHERE d.id = ? '
+            'ON CONFLICT (filename) DO UPDATE SET no_downloads = package_stats.no_downloads + 1, '
+            'last_downloaded = excluded.last_downloaded, '
+            'bytes_served = package_stats.bytes_served + excluded.bytes_served',
+            (int(time.time()), download_id))
 
     db_conn.commit()
 
     current_app.logger.debug("Set status of download '%s' to '%s'" % (download_id, status))
 
 
+def decode_token_claims(token):
+    """
+    Returns the claims of the specified authentication token regardless of whether the token has expired,
+    or None if the token cannot be decoded.
+
+    :param token: JWT encoded authentication token
+    """
+    try:
+        return decode(
+            token,
+            current_app.config['JWT_SECRET'],
+            algorithms=[current_app.config['JWT_ALGORITHM']],
+            options={'verify_exp': False})
+    except DecodeError:
+        return None
+
+
+def archive_download_records(retention_days):
+    """
+    Moves download records which finished, or were started if never finished, more than the specified number of
+    days ago from the download table to compressed JSON lines in the download_archive table, keeping the download
+    table and its token index small.
+
+    The tokens of archived records are no longer stored in full. The hashes of tokens which have not yet expired
+    are recorded in the used_token table, to still enforce the single use of the tokens, and are removed once
+    the tokens have expired, after which the tokens are rejected as expired in any case. Archived records retain
+    the claims of their tokens, so that download events can still be extracted from them.
+
+    :param retention_days: Number of days for which finished download records are retained
+    :returns: Tuple of the numbers of archived download records and of removed expired token hashes
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    now = int(time.time())
+
+    archived = 0
+
+    while True:
+        rows = db_cursor.execute(
+            'SELECT * FROM download '
+            'WHERE finished < ? OR (finished IS NULL AND started < ?) '
+            'ORDER BY id LIMIT ?',
+            (cutoff, cutoff, ARCHIVE_BATCH_SIZE)
+        ).fetchall()
+
+        if len(rows) == 0:
+            break
+
+        records = []
+        used_tokens = []
+        for row in rows:
+            claims = decode_token_claims(row['token'])
+            if claims and claims.get('exp', 0) > now:
+                used_tokens.append((get_token_hash(row['token']), claims['exp']))
+            records.append(json.dumps({
+                'id': row['id'],
+                'filename': row['filename'],
+                'status': row['status'],
+                'started': normalize_timestamp(row['started']) if row['started'] else None,
+                'finished': normalize_timestamp(row['finished']) if row['finished'] else None,
+                'claims': claims
+            }))
+
+        db_cursor.execute(
+            'INSERT INTO download_archive (first_id, last_id, row_count, records) VALUES (?, ?, ?, ?)',
+            (rows[0]['id'], rows[-1]['id'], len(rows), gzip.compress('\n'.join(records).encode('utf-8'))))
+
+        db_cursor.executemany(
+            'INSERT INTO used_token (token_hash, expires) VALUES (?, ?) ON CONFLICT (token_hash) DO NOTHING',
+            used_tokens)
+
+        ids = [row['id'] for row in rows]
+        for i in range(0, len(ids), MAX_QUERY_PARAMETERS):
+            chunk = ids[i:i + MAX_QUERY_PARAMETERS]
+            db_cursor.execute('DELETE FROM download WHERE id IN (%s)' % ', '.join('?' * len(chunk)), chunk)
+
+        db_conn.commit()
+
+        archived += len(rows)
+
+    db_cursor.execute('DELETE FROM used_token WHERE expires <= ?', (now,))
+    purged = db_cursor.rowcount
+
+    db_conn.commit()
+
+    current_app.logger.info(
+        "Archived %d download records finished before %s and removed %d expired token hashes"
+        % (archived, cutoff, purged))
+
+    return archived, purged
+
+
+def maintain_db(time_limit):
+    """
+    Performs routine maintenance of the database, as implemented by the configured backend, such as updating the
+    statistics of the query planner and returning free pages to the file system, within the specified time limit.
+    Steps still running at the time limit are interrupted, and the remaining steps are left for the next run.
+
+    :param time_limit: Maximum duration of the maintenance in seconds
+    :returns: List of (step, outcome) tuples of the completed maintenance steps
+    """
+    db_conn = get_db()
+    backend = get_backend()
+
+    deadline = time.monotonic() + time_limit
+
+    completed = []
+
+    for step, outcome in backend.maintain(db_conn, deadline):
+        completed.append((step, outcome))
+        if step == 'check' and outcome != 'ok':
+            current_app.logger.error("Integrity check of database %s failed: %s" % (backend.database(current_app), outcome))
+        elif step == 'auto_vacuum' and outcome != 'incremental':
+            current_app.logger.warning(
+                "Incremental vacuuming is not enabled for database %s, so free pages are not returned to the file "
+                "system until converted with 'flask db maintain --convert-vacuum'" % backend.database(current_app))
+        else:
+            current_app.logger.info("Database maintenance step %s: %s" % (step, outcome))
+
+    if time.monotonic() >= deadline:
+        current_app.logger.warning(
+            "Database maintenance reached the time limit of %s seconds after %d steps" % (time_limit, len(completed)))
+
+    return completed
+
+
+def convert_db_vacuum():
+    """
+    Converts the database to incremental vacuuming, as implemented by the configured backend, rewriting the whole
+    database while holding an exclusive lock on it.
+
+    :returns: Outcome of the conversion
+    """
+    db_conn = get_db()
+    backend = get_backend()
+
+    current_app.logger.info("Converting database %s to incremental vacuuming" % backend.database(current_app))
+
+    outcome = backend.convert_vacuum(db_conn)
+
+    current_app.logger.info("Conversion of database %s to incremental vacuuming: %s" % (backend.database(current_app), outcome))
+
+    return outcome
+
+
+def iter_archived_download_records():
+    """
+    Yields all archived download records as dicts, in the order in which they were created, decompressing one
+    archive row at a time.
+    """
+    db_conn = get_db()
+
+    archive_ids = [row['id'] for row in db_conn.execute('SELECT id FROM download_archive ORDER BY first_id')]
+
+    for archive_id in archive_ids:
+        row = db_conn.execute('SELECT records FROM download_archive WHERE id = ?', (archive_id,)).fetchone()
+        for line in gzip.decompress(bytes(row['records'])).decode('utf-8').split('\n'):
+            yield json.loads(line)
+
+
 def create_request_scope(task_id, request_scope):
     """
     Creates database rows for a file generation request that is fulfilled by given task.
@@ -335,27 +787,25 @@ def create_request_scope(task_id, request_scope):
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    db_cursor.execute(
-        'INSERT INTO generate_request (task_id) VALUES (?)', (task_id,))
-
-    request_id = db_cursor.lastrowid
+    request_id = get_backend().insert(
+        db_cursor, 'INSERT INTO generate_request (task_id) VALUES (?)', (task_id,))
 
-    for prefix in request_scope:
-        db_cursor.execute(
-            'INSERT INTO generate_request_scope (request_id, prefix) VALUES (?, ?)',
-            (request_id, prefix))
+    db_cursor.executemany(
+        'INSERT INTO generate_request_scope (request_id, prefix) VALUES (?, ?)',
+        [(request_id, prefix) for prefix in request_scope])
 
     db_conn.commit()
 
     current_app.logger.info(
         "Created a new file generation request with task_id '%s' and scope "
-        "'%s'"
-        % (task_id, request_scope))
+        "of %d prefixes"
+        % (task_id, len(request_scope)))
+    current_app.logger.debug("Scope of file generation request for task_id '%s': %s" % (task_id, request_scope))
 
 
 def create_task_rows(dataset_id, task_id, is_partial, generate_scope):
     """
-    Creates all the appropriate rows to generate_task and generate_scope tables for a given file generation task.
+    Creates all the appropriate rows to generate_task and generate_scope_compact tables for a given file generation task.
 
     :param dataset_id: ID of the dataset that the files belong to
     :param task_id: ID of the generation task
@@ -366,22 +816,21 @@ def create_task_rows(dataset_id, task_id, is_partial, generate_scope):
     db_cursor = db_conn.cursor()
 
     db_cursor.execute(
-        "INSERT INTO generate_task (dataset_id, task_id, status, is_partial) "
-        "VALUES (?, ?, 'NEW', ?)",
-        (dataset_id, task_id, is_partial))
+        "INSERT INTO generate_task (dataset_id, task_id, status, is_partial, scope_hash) "
+        "VALUES (?, ?, 'NEW', ?, ?)",
+        (dataset_id, task_id, is_partial, get_scope_hash(generate_scope)))
 
-    for filepath in generate_scope:
-        db_cursor.execute(
-            "INSERT INTO generate_scope (task_id, filepath)"
-            "VALUES (?, ?)",
-            (task_id, filepath))
+    db_cursor.execute(
+        "INSERT INTO generate_scope_compact (task_id, file_count, scope) "
+        "VALUES (?, ?, ?)",
+        (task_id, len(generate_scope), compress_generate_scope(generate_scope)))
 
     db_conn.commit()
 
     current_app.logger.info(
-        "Created a new file generation task with id '%s' and scope '%s' "
+        "Created a new file generation task with id '%s' and scope of %d files "
         "for dataset '%s'"
-        % (task_id, generate_scope, dataset_id))
+        % (task_id, len(generate_scope), dataset_id))
 
     return db_cursor.execute(
         'SELECT initiated, task_id, status, date_done '
@@ -391,6 +840,15 @@ def create_task_rows(dataset_id, task_id, is_partial, generate_scope):
     ).fetchone()
 
 
+def get_package_filenames():
+    """
+    Returns the set of the filenames of all packages in the database.
+    """
+    db_conn = get_db()
+
+    return set(row['filename'] for row in get_backend().iter_rows(db_conn, 'SELECT filename FROM package'))
+
+
 def exists_in_database(filename):
     """
     Returns true if a package with a given filename can be found in the database.
@@ -406,6 +864,143 @@ def exists_in_database(filename):
     ).fetchone() is not None
 
 
+def get_cached_dataset_modified_timestamps(dataset_ids, checked_after, pushed_after=None):
+    """
+    Returns the cached modification timestamps of the specified datasets which were checked from Metax
+    at or after the specified time, or which were pushed by a trusted service at or after the specified
+    time, as a dict keyed by dataset ID.
+
+    :param dataset_ids: List of dataset IDs
+    :param checked_after: Epoch seconds before which checked timestamps are ignored, if specified
+    :param pushed_after: Epoch seconds before which pushed timestamps are ignored, if specified
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    conditions = []
+    parameters = []
+    if checked_after is not None:
+        conditions.append('checked >= ?')
+        parameters.append(checked_after)
+    if pushed_after is not None:
+        conditions.append('pushed >= ?')
+        parameters.append(pushed_after)
+
+    dataset_modified_timestamps = {}
+
+    if len(conditions) == 0:
+        return dataset_modified_timestamps
+
+    for i in range(0, len(dataset_ids), MAX_QUERY_PARAMETERS):
+        chunk = dataset_ids[i:i + MAX_QUERY_PARAMETERS]
+        rows = db_cursor.execute(
+            'SELECT dataset_id, modified FROM dataset_modified '
+            'WHERE (%s) AND dataset_id IN (%s)' % (' OR '.join(conditions), ', '.join('?' * len(chunk))),
+            parameters + list(chunk)
+        ).fetchall()
+        for row in rows:
+            dataset_modified_timestamps[row['dataset_id']] = row['modified']
+
+    return dataset_modified_timestamps
+
+
+def cache_dataset_modified_timestamps(dataset_modified_timestamps, checked):
+    """
+    Records the specified dataset modification timestamps, as checked from Metax at the specified time.
+
+    :param dataset_modified_timestamps: Dict of normalized modification timestamps keyed by dataset ID
+    :param checked: Epoch seconds when the timestamps were checked
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    db_cursor.executemany(
+        'INSERT INTO dataset_modified (dataset_id, modified, checked) VALUES (?, ?, ?) '
+        'ON CONFLICT (dataset_id) DO UPDATE SET modified = excluded.modified, checked = excluded.checked',
+        [(dataset_id, modified, checked) for dataset_id, modified in dataset_modified_timestamps.items()]
+    )
+
+    db_conn.commit()
+
+
+def push_dataset_modified_timestamp(dataset_id, modified, pushed):
+    """
+    Records the specified dataset modification timestamp, as pushed by a trusted service at the specified time.
+    A later recorded modification timestamp is never replaced with an earlier one.
+
+    :param dataset_id: ID of the dataset
+    :param modified: Normalized modification timestamp of the dataset
+    :param pushed: Epoch seconds when the timestamp was pushed
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    db_cursor.execute(
+        'INSERT INTO dataset_modified (dataset_id, modified, checked, pushed) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (dataset_id) DO UPDATE SET modified = CASE WHEN excluded.modified > dataset_modified.modified '
+        'THEN excluded.modified ELSE dataset_modified.modified END, '
+        'checked = excluded.checked, pushed = excluded.pushed',
+        (dataset_id, modified, pushed, pushed)
+    )
+
+    db_conn.commit()
+
+
+def outdate_task_rows(dataset_id, modified):
+    """
+    Marks all tasks of the specified dataset which are not yet completed and were initiated before the specified
+    modification timestamp as outdated, so that they will never be queued for generation, and so that the packages
+    of tasks already queued or being generated are discarded by the generator once generated.
+
+    :param dataset_id: ID of the dataset
+    :param modified: Normalized modification timestamp of the dataset
+    :returns: Number of tasks marked as outdated
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    modified = datetime.utcfromtimestamp(dateutil.parser.parse(modified).timestamp())
+
+    db_cursor.execute(
+        "UPDATE generate_task SET status = 'OUTDATED' "
+        "WHERE dataset_id = ? AND status IN ('NEW', 'PENDING', 'STARTED', 'RETRY') AND initiated < ?",
+        (dataset_id, modified)
+    )
+
+    db_conn.commit()
+
+    return db_cursor.rowcount
+
+
+def is_task_outdated(task_id):
+    """
+    Returns whether the task matching the specified task_id has been marked as outdated, or was initiated before a
+    modification of its dataset pushed by a trusted service, as the status of a task being generated may be
+    overwritten by the generator.
+
+    :param task_id: the task id of the task
+    """
+    db_conn = get_db()
+    db_cursor = db_conn.cursor()
+
+    pushed = db_cursor.execute(
+        "SELECT m.modified FROM generate_task t JOIN dataset_modified m ON m.dataset_id = t.dataset_id "
+        "WHERE t.task_id = ? AND m.pushed IS NOT NULL",
+        (task_id,)
+    ).fetchone()
+
+    if pushed is not None:
+        modified = datetime.utcfromtimestamp(dateutil.parser.parse(pushed['modified']).timestamp())
+        return db_cursor.execute(
+            "SELECT 1 FROM generate_task WHERE task_id = ? AND (status = 'OUTDATED' OR initiated < ?)",
+            (task_id, modified)
+        ).fetchone() is not None
+
+    return db_cursor.execute(
+        "SELECT 1 FROM generate_task WHERE task_id = ? AND status = 'OUTDATED'", (task_id,)
+    ).fetchone() is not None
+
+
 def get_cache_stats():
     db_conn = get_db()
     db_cursor = db_conn.cursor()
@@ -419,42 +1014,78 @@ def get_cache_stats():
     ).fetchone()
 
 
-def get_active_packages():
+def get_active_packages(dataset_id=None, after=None, limit=None):
+    """
+    Returns all packages in the cache, or only the packages of the specified dataset, with their datasets and their
+    generation and last download times as epoch seconds. If a starting filename or a limit is specified, the packages are returned
+    in the order of their filenames, so that all packages can be processed in batches.
+
+    :param dataset_id: ID of the dataset, if specified
+    :param after: Filename after which packages are returned, if specified
+    :param limit: Maximum number of packages returned, if specified
+    """
     db_conn = get_db()
-    db_cursor = db_conn.cursor()
+    backend = get_backend()
 
-    q = db_cursor.execute(
+    # The generation time of packages recorded before it was stored falls back to the completion time of their task
+    sql = (
         "SELECT p.filename as filename, "
         "       p.size_bytes as size_bytes, "
-        "       t.date_done as generated_at, "
-        "       max(d.finished) as last_downloaded, "
-        "       count(d.finished) as no_downloads "
+        "       coalesce(p.generated, %s) as generated_at, "
+        "       s.last_downloaded as last_downloaded, "
+        "       coalesce(s.no_downloads, 0) as no_downloads, "
+        "       t.dataset_id as dataset_id, "
+        "       p.generation_seconds as generation_seconds "
         "FROM package p "
         "JOIN generate_task t ON p.generated_by = t.task_id "
-        "LEFT JOIN download d ON p.filename = d.filename AND d.status = 'SUCCESSFUL' "
-        "GROUP BY p.filename"
-    ).fetchall()
+        "LEFT JOIN package_stats s ON p.filename = s.filename "
+        "WHERE (? IS NULL OR t.dataset_id = ?) " % backend.epoch('t.date_done'))
+    parameters = [dataset_id, dataset_id]
 
-    packages = []
-    for row in q:
-        filename = str(row['filename'])
-        size_bytes = int(row['size_bytes'])
-        no_downloads = int(row['no_downloads'])
-        generated_at = row['generated_at']
-        last_downloaded = row['last_downloaded']
-        datetimes = {'generated_at': generated_at, 'last_downloaded': last_downloaded}
-        converted = {}
-        for k, v in datetimes.items():
-            if isinstance(v, str):
-                if '.' in v:
-                    a = v.split('.')
-                    v = a[0]
-                converted[k] = pendulum.from_format(v, 'YYYY-MM-DD HH:mm:ss')
-            elif isinstance(v, int):
-                # legacy value
-                converted[k] = pendulum.from_timestamp(v / 1e3)  # sqlite millisecond timestamp
-        packages.append(Package(filename, size_bytes, no_downloads, **converted))
-    return packages
+    if after is not None or limit is not None:
+        sql += "AND p.filename > ? ORDER BY p.filename "
+        parameters.append(after or '')
+        if limit is not None:
+            sql += "LIMIT %d" % limit
+
+    q = backend.iter_rows(db_conn, sql, parameters)
+
+    return [
+        Package(row['filename'], row['size_bytes'], row['no_downloads'], row['generated_at'], row['last_downloaded'],
+                dataset_id=row['dataset_id'], generation_seconds=row['generation_seconds'])
+        for row in q
+    ]
+
+
+def get_housekeeping_state(name):
+    """
+    Returns the recorded value of the specified housekeeping state, such as the position at which an incremental
+    housekeeping operation stopped, or None if not recorded.
+
+    :param name: Name of the housekeeping state
+    """
+    db_conn = get_db()
+
+    row = db_conn.execute('SELECT value FROM housekeeping_state WHERE name = ?', (name,)).fetchone()
+
+    return row['value'] if row else None
+
+
+def set_housekeeping_state(name, value):
+    """
+    Records the value of the specified housekeeping state.
+
+    :param name: Name of the housekeeping state
+    :param value: Value of the housekeeping state, or None to clear it
+    """
+    db_conn = get_db()
+
+    db_conn.execute(
+        'INSERT INTO housekeeping_state (name, value, updated) VALUES (?, ?, ?) '
+        'ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated = excluded.updated',
+        (name, value, int(time.time())))
+
+    db_conn.commit()
 
 
 def flush_cache_rows():
@@ -465,38 +1096,56 @@ def flush_cache_rows():
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    for table in [
+    tables = [
         'package',
+        'package_stats',
+        'housekeeping_state',
         'generate_task',
         'generate_scope',
+        'generate_scope_compact',
         'generate_taskgroup',
         'generate_request',
         'generate_request_scope',
         'subscription'
-        ]:
+        ]
 
+    for table in tables:
         db_cursor.execute("DELETE FROM %s" % table)
 
-        current_app.logger.info("Truncated all rows from table %s" % table)
-
     db_conn.commit()
 
+    current_app.logger.info("Truncated all rows from tables %s" % ", ".join(tables))
+
 
-def delete_package_rows(filenames):
+def delete_package_rows(filenames, commit=True):
     """
     Delete package rows for packages with the specified file names
+
+    :param filenames: Iterable of the filenames of the packages
+    :param commit: Whether the deletion is committed, else it is committed by the caller
     """
 
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    for filename in filenames:
-        db_cursor.execute('DELETE FROM package WHERE filename = ?', (filename,))
-        current_app.logger.info("Deleted package row for filename %s" % filename)
+    filenames = list(filenames)
+    deleted = 0
 
-    db_conn.commit()
+    for i in range(0, len(filenames), MAX_QUERY_PARAMETERS):
+        chunk = filenames[i:i + MAX_QUERY_PARAMETERS]
+        db_cursor.execute(
+            'DELETE FROM package WHERE filename IN (%s)' % ', '.join('?' * len(chunk)),
+            chunk)
+        deleted += db_cursor.rowcount
+        db_cursor.execute(
+            'DELETE FROM package_stats WHERE filename IN (%s)' % ', '.join('?' * len(chunk)),
+            chunk)
+
+    if commit:
+        db_conn.commit()
 
-    current_app.logger.info("Deleted %s package rows" % len(filenames))
+    current_app.logger.info("Deleted %d package rows" % deleted)
+    current_app.logger.debug("Deleted package rows for filenames %s" % ", ".join(filenames))
 
 
 def get_package(task_id):
@@ -511,18 +1160,61 @@ def get_package(task_id):
     return db_cursor.execute('SELECT * FROM package WHERE generated_by = ?', (task_id,)).fetchone()
 
 
-def get_generate_scope_filepaths(task_id):
+def compress_generate_scope(generate_scope):
+    """
+    Returns the filepaths of a generate scope, sorted and compressed into a single blob.
+
+    :param generate_scope: Iterable of all the filepaths included in a package
     """
-    Returns list of filepaths included in specified task scope.
+    compressor = zlib.compressobj()
+    chunks = []
+    for filepath in sorted(generate_scope):
+        chunks.append(compressor.compress((filepath + SCOPE_SEPARATOR).encode('utf-8')))
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def iter_generate_scope_filepaths(task_id):
+    """
+    Yields filepaths included in specified task scope, in sorted order, decompressing the scope incrementally.
+    Falls back to the individual generate_scope rows of tasks created before scopes were stored compressed.
 
     :param task_id: ID of the task whose scope is to be fetched
     """
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    scope_rows = db_cursor.execute('SELECT filepath FROM generate_scope WHERE task_id = ?', (task_id,)).fetchall()
+    scope_row = db_cursor.execute('SELECT scope FROM generate_scope_compact WHERE task_id = ?', (task_id,)).fetchone()
+
+    if scope_row is None:
+        for scope_row in get_backend().iter_rows(
+                db_conn, 'SELECT filepath FROM generate_scope WHERE task_id = ?', (task_id,)):
+            yield scope_row['filepath']
+        return
+
+    decompressor = zlib.decompressobj()
+    data = scope_row['scope']
+    pending = b''
+    while True:
+        pending += decompressor.decompress(data, SCOPE_CHUNK_SIZE)
+        data = decompressor.unconsumed_tail
+        if not data:
+            pending += decompressor.flush()
+        filepaths = pending.split(SCOPE_SEPARATOR.encode('utf-8'))
+        pending = filepaths.pop()
+        for filepath in filepaths:
+            yield filepath.decode('utf-8')
+        if not data:
+            break
 
-    return set(map(lambda scope_row: scope_row['filepath'], scope_rows))
+
+def get_generate_scope_filepaths(task_id):
+    """
+    Returns set of filepaths included in specified task scope.
+
+    :param task_id: ID of the task whose scope is to be fetched
+    """
+    return set(iter_generate_scope_filepaths(task_id))
 
 
 def get_task_id_for_package(package):
@@ -593,6 +1285,8 @@ def update_package_generation_timestamps(package, timestamp):
 
     db_cursor.execute('UPDATE generate_task SET initiated = ?, date_done = ? WHERE task_id = ?',
                       (sqlite_timestamp, sqlite_timestamp, task_id))
+    db_cursor.execute('UPDATE package SET generated = ? WHERE filename = ?',
+                      (int(dateutil.parser.parse(timestamp).timestamp()), package))
     db_conn.commit()
 
 
@@ -618,14 +1312,13 @@ def get_scope(task_id):
     db = get_db()
     db_cursor = db.cursor()
 
-    generate_request = db_cursor.execute('SELECT id FROM generate_request WHERE task_id = ? ORDER BY id DESC LIMIT 1', (task_id,)).fetchone()
-
-    scope = []
+    rows = db_cursor.execute(
+        'SELECT prefix FROM generate_request_scope '
+        'WHERE request_id = (SELECT max(id) FROM generate_request WHERE task_id = ?)',
+        (task_id,)
+    ).fetchall()
 
-    if generate_request:
-        rows = db_cursor.execute('SELECT prefix FROM generate_request_scope WHERE request_id = ?', (generate_request['id'],)).fetchall()
-        for row in rows:
-            scope.append(str(row["prefix"]))
+    scope = [str(row["prefix"]) for row in rows]
 
     if len(scope) > 0:
         return scope
@@ -633,11 +1326,51 @@ def get_scope(task_id):
     return None
 
 
+def get_task_with_scope(package, task_id=None):
+    """
+    Retrieves the task record associated with the specified task_id, if provided, else with the specified package
+    filename, together with the scope of the latest request fulfilled by the task if it is partial, with a single
+    query.
+
+    :returns: Tuple of task record and scope, which is None if the task is not partial or has no requests,
+              or None if no task is found
+    """
+    db = get_db()
+    db_cursor = db.cursor()
+
+    rows = db_cursor.execute(
+        'SELECT t.*, s.prefix AS request_prefix '
+        'FROM generate_task t '
+        'LEFT JOIN generate_request_scope s '
+        'ON t.is_partial != 0 '
+        'AND s.request_id = (SELECT max(r.id) FROM generate_request r WHERE r.task_id = t.task_id) '
+        'WHERE t.task_id = coalesce(?, (SELECT generated_by FROM package WHERE filename = ?))',
+        (task_id or None, package)
+    ).fetchall()
+
+    if len(rows) == 0:
+        return None
+
+    scope = [str(row['request_prefix']) for row in rows if row['request_prefix'] is not None]
+
+    return rows[0], scope or None
+
+
 def extract_event(download_id):
     current_app.logger.debug("Extracting event for download id %s" % download_id)
     download = get_download_record_by_id(download_id)
-    event = {}
     token = decode(download["token"], current_app.config["JWT_SECRET"], algorithms=[current_app.config["JWT_ALGORITHM"]])
+    event = extract_download_event(download, token)
+    current_app.logger.debug("Extracted event for download id %s: %s" % (download_id, json.dumps(event)))
+    return event
+
+
+def extract_download_event(download, token):
+    """
+    Returns the download event of the specified download record, or archived download record, given the decoded
+    claims of its token.
+    """
+    event = {}
     dataset = token["dataset"]
     event["dataset"] = dataset
     file = token.get("file")
@@ -646,12 +1379,11 @@ def extract_event(download_id):
         event["file"] = file
     else:
         package = token["package"]
-        task = get_task(package, token.get("generated_by"))
+        task, scope = get_task_with_scope(package, token.get("generated_by")) or (None, None)
         if task:
             if task["is_partial"] == 0:
                 event["type"] = "COMPLETE"
             else:
-                scope = get_scope(task["task_id"])
                 if scope:
                     event["type"] = "PARTIAL"
                     event["scope"] = scope
@@ -663,8 +1395,7 @@ def extract_event(download_id):
     else:
         event["status"] = "FAILURE"
     event["started"] = normalize_timestamp(download["started"])
-    event["finished"] = normalize_timestamp(download["finished"])
-    current_app.logger.debug("Extracted event for download id %s: %s" % (download_id, json.dumps(event)))
+    event["finished"] = normalize_timestamp(download["finished"]) if download["finished"] else None
     return event
 
 
@@ -678,6 +1409,44 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@db_cli.command('migrate')
+def migrate_db_command():
+    """Apply all pending database schema migrations."""
+    applied = migrate_db()
+    for filename in applied:
+        click.echo('Applied migration %s' % filename)
+    click.echo('Database schema is at version %d.' % get_schema_version())
+
+
+@db_cli.command('archive')
+@click.option('--days', type=int, default=None,
+              help='Number of days for which finished download records are retained (default DOWNLOAD_RETENTION_DAYS).')
+def archive_db_command(days):
+    """Archive finished download records older than the retention period."""
+    if days is None:
+        days = int(current_app.config.get('DOWNLOAD_RETENTION_DAYS', 90))
+    archived, purged = archive_download_records(days)
+    click.echo('Archived %d download records and removed %d expired token hashes.' % (archived, purged))
+
+
+@db_cli.command('maintain')
+@click.option('--time-limit', type=float, default=None,
+              help='Maximum duration of the maintenance in seconds (default DATABASE_MAINTENANCE_TIME_LIMIT).')
+@click.option('--convert-vacuum', is_flag=True,
+              help='First convert the database to incremental vacuuming, locking it until completed.')
+def maintain_db_command(time_limit, convert_vacuum):
+    """Update query planner statistics, reclaim free space and check the integrity of the database."""
+    if convert_vacuum:
+        click.echo('convert_vacuum: %s' % convert_db_vacuum())
+    if time_limit is None:
+        time_limit = float(current_app.config.get('DATABASE_MAINTENANCE_TIME_LIMIT', 60))
+    completed = maintain_db(time_limit)
+    for step, outcome in completed:
+        click.echo('%s: %s' % (step, outcome))
+    if any(step == 'check' and outcome != 'ok' for step, outcome in completed):
+        raise click.ClickException('Database integrity check failed.')
+
+
 def init_app(app):
     """Hooks database extension to given Flask application.
 
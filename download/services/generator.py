@@ -14,8 +14,8 @@ from zipfile import ZipFile, ZIP_DEFLATED
 from click import option
 from flask import current_app
 from flask.cli import AppGroup
-from .cache import get_datasets_dir, perform_housekeeping
-from .db import get_db, get_subscription_rows, delete_subscription_rows
+from .cache import get_datasets_dir, cleanup_package_cache, PART_SUFFIX
+from .db import get_db, get_subscription_rows, delete_subscription_rows, is_task_outdated
 from ..utils import ida_service_is_offline, normalize_logging
 
 
@@ -29,15 +29,21 @@ def generate(dataset, project_identifier, scope, requestor_id):
     :param requestor_id: ID of task requesting file generation.
     """
 
-    output_filehandle, output_filename = tempfile.mkstemp(suffix='.zip', prefix=dataset + '_', dir=get_datasets_dir())
+    # The package file is written with a partial file suffix, and renamed once complete, so that it is not
+    # purged as a ghost file while being written
+    output_filehandle, partial_filename = tempfile.mkstemp(suffix='.zip' + PART_SUFFIX, prefix=dataset + '_', dir=get_datasets_dir())
+    os.close(output_filehandle)
+    output_filename = partial_filename[:-len(PART_SUFFIX)]
 
-    # Before generating new package file, perform housekeeping on package cache
+    # Before generating new package file, cleanup space in package cache if the volume limit is exceeded; the
+    # other housekeeping operations are performed periodically
     try:
-        perform_housekeeping()
+        cleanup_package_cache()
     except Exception as err:
-        current_app.logger.error("Error encountered while performing package cache housekeeping: %s" % str(err))
+        current_app.logger.error("Error encountered while performing package cache cleanup: %s" % str(err))
 
-    # Generate file
+    # Generate file, measuring the duration of the generation for cost-aware cache eviction
+    generation_start = time.monotonic()
     current_app.logger.info("Generating package file for dataset '%s' with %s scoped files" % (dataset, len(scope)))
 
     source_root = os.path.join(
@@ -46,7 +52,7 @@ def generate(dataset, project_identifier, scope, requestor_id):
         'files',
         project_identifier)
 
-    with ZipFile(output_filename, 'w', ZIP_DEFLATED) as myzip:
+    with ZipFile(partial_filename, 'w', ZIP_DEFLATED) as myzip:
         for root, dirs, files in os.walk(source_root):
             for name in files:
                 absolute_filename = os.path.join(root, name)
@@ -58,37 +64,49 @@ def generate(dataset, project_identifier, scope, requestor_id):
 
     # If the IDA service is offline (having gone offline since generation of the package began), discard
     # the generated package file (assume potentially corrupted)
+    output_filesize = os.path.getsize(partial_filename)
+
     if ida_service_is_offline(current_app):
         current_app.logger.warn("IDA service offline. Discarding package file '%s' of size %s bytes." % (os.path.basename(output_filename), output_filesize))
-        os.remove(output_filename)
+        os.remove(partial_filename)
         return
 
-    output_filesize = os.path.getsize(output_filename)
-
     # If the generated package file is zero sized, discard the generated package file
     if output_filesize == 0:
         current_app.logger.warn("Discarding empty package file '%s' of size %s bytes." % (os.path.basename(output_filename), output_filesize))
-        os.remove(output_filename)
+        os.remove(partial_filename)
         return
 
     current_app.logger.info("Generated package file '%s' of size %s bytes." % (os.path.basename(output_filename), output_filesize))
 
     # Generate package file checksum
     sha256_hash = hashlib.sha256()
-    with open(output_filename, "rb") as output_file:
+    with open(partial_filename, "rb") as output_file:
         current_app.logger.debug("Calculating checksum.")
         for byte_block in iter(lambda: output_file.read(4096), b""):
             sha256_hash.update(byte_block)
 
     output_checksum = 'sha256:' + sha256_hash.hexdigest()
 
+    generation_seconds = time.monotonic() - generation_start
+
+    # If the dataset was modified while the package was generated, as notified by a trusted service, the task
+    # has been outdated, so discard the generated package file
+    if is_task_outdated(requestor_id):
+        current_app.logger.warn("Task outdated. Discarding package file '%s' of size %s bytes." % (os.path.basename(output_filename), output_filesize))
+        os.remove(partial_filename)
+        return
+
+    os.rename(partial_filename, output_filename)
+
     # Insert package metadata into database
     db_conn = get_db()
     db_cursor = db_conn.cursor()
     db_cursor.execute(
-        "INSERT INTO package (filename, checksum, size_bytes, generated_by) "
-        "VALUES (?, ?, ?, ?) ",
-        (os.path.basename(output_filename), output_checksum, output_filesize, requestor_id)
+        "INSERT INTO package (filename, checksum, size_bytes, generated_by, generated, generation_seconds) "
+        "VALUES (?, ?, ?, ?, ?, ?) ",
+        (os.path.basename(output_filename), output_checksum, output_filesize, requestor_id, int(time.time()),
+         generation_seconds)
     )
     db_conn.commit()
 
@@ -6,17 +6,56 @@
 
     Supports both version 1 and 3 of the Metax API, determined by configuration.
 """
+import codecs
+import fcntl
+import hashlib
+import os
 import requests
 import json
+import sys
+import threading
+import time
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
 from requests.exceptions import ConnectionError
+from . import db
+from ..dto import DatasetFile
 from ..utils import normalize_timestamp, startswithpath
 
+# Size of the chunks in which file listings are read from streamed Metax API responses
+FILES_CHUNK_SIZE = 65536
+
+# Maximum number of datasets requested in a single Metax API dataset list query
+DATASETS_LIST_QUERY_SIZE = 100
+
+# Seconds between attempts to acquire a coalescing lock file held by another process
+COALESCE_LOCK_INTERVAL = 0.05
+
+# Fetches from Metax API currently in flight in this process, by coalescing key
+inflight_fetches = {}
+inflight_lock = threading.Lock()
+
+# Time as epoch seconds at which the METAX_COALESCE_DIR directory was last swept by this process
+coalesce_dir_swept = 0
+
 
 class UnexpectedStatusCode(Exception):
     pass
 
 
+class IncompleteFileListing(UnexpectedStatusCode):
+
+    def __init__(self, dataset, received, count):
+        self.dataset = dataset
+        self.received = received
+        self.count = count
+
+    def __str__(self):
+        return "Received %d of %d files of dataset '%s' from Metax API" % (self.received, self.count, self.dataset)
+
+
 class DatasetNotFound(Exception):
 
     def __init__(self, *args):
@@ -57,10 +96,23 @@ class NoMatchingFilesFound(Exception):
             return "No matching files for the dataset was found in Metax API"
 
 
-def get_metax(resource):
+def get_timeout():
+    """Returns the METAX_TIMEOUT in seconds within which Metax API must accept a connection and send each part of a
+    response, or None if requests to Metax API are not to time out."""
+    return float(current_app.config.get('METAX_TIMEOUT', 60) or 0) or None
+
+
+def get_coalesce_timeout():
+    """Returns the METAX_COALESCE_TIMEOUT in seconds for which a fetch waits for a coalesced fetch of the same
+    resource in flight in this or another process, before fetching the resource independently."""
+    return float(current_app.config.get('METAX_COALESCE_TIMEOUT', 120) or 0)
+
+
+def get_metax(resource, stream=False):
     """Retrieves resource from Metax API
 
     :param resource: resource to be requested from the API
+    :param stream: Whether the response body should be streamed rather than read into memory at once
     :raises ConnectionError: Application is unable to connect to Metax API
     """
 
@@ -80,10 +132,214 @@ def get_metax(resource):
         current_app.logger.debug("Requesting Metax API '%s'" % url)
         if metax_version >= 3:
             headers = { "Authorization": "Token %s" % current_app.config['METAX_PASS'] }
-            return requests.get(url, headers=headers)
+            return requests.get(url, headers=headers, stream=stream, timeout=get_timeout())
         else:
             auth = (current_app.config['METAX_USER'], current_app.config['METAX_PASS'])
-            return requests.get(url, auth=auth)
+            return requests.get(url, auth=auth, stream=stream, timeout=get_timeout())
+    except ConnectionError:
+        current_app.logger.error("Unable to connect to Metax API on '%s'" % url)
+        raise
+
+
+class InflightFetch(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def coalesce(key, fetch, across_processes=True):
+    """Executes the specified fetch, unless a fetch with the same key is already in flight in this process,
+    in which case waits for the in-flight fetch to complete and shares its result, or its exception.
+
+    If METAX_COALESCE_DIR is configured, fetches are also coalesced across processes, unless disabled for the
+    fetch: the fetching process holds a lock file for the key while fetching, and writes the result to a result
+    file in the directory, which processes that were waiting on the lock then read instead of fetching again.
+    Only small JSON serializable results should be coalesced across processes.
+
+    A fetch waits for a coalesced fetch for at most METAX_COALESCE_TIMEOUT seconds, after which it fetches the
+    resource independently, so that a stalled fetch does not block every request for the same resource.
+
+    :param key: String identifying the fetched resource
+    :param fetch: Function fetching the resource
+    :param across_processes: Whether the fetch may be coalesced across processes
+    """
+    with inflight_lock:
+        inflight = inflight_fetches.get(key)
+        leader = inflight is None
+        if leader:
+            inflight = InflightFetch()
+            inflight_fetches[key] = inflight
+
+    if not leader:
+        current_app.logger.debug("Waiting for in-flight Metax API fetch of %s" % key)
+        if not inflight.done.wait(get_coalesce_timeout()):
+            current_app.logger.warning("Timed out waiting for in-flight Metax API fetch of %s" % key)
+            return fetch()
+        if inflight.error is not None:
+            raise inflight.error
+        return inflight.result
+
+    try:
+        if across_processes:
+            inflight.result = coalesce_across_processes(key, fetch)
+        else:
+            inflight.result = fetch()
+        return inflight.result
+    except Exception as err:
+        inflight.error = err
+        raise
+    finally:
+        with inflight_lock:
+            del inflight_fetches[key]
+        inflight.done.set()
+
+
+def lock_coalesce_file(lock_pathname, deadline):
+    """Opens and exclusively locks the specified lock file, and returns the open lock file, or None if the lock
+    could not be acquired by the deadline. If the lock file is removed by a sweep while waiting for the lock, the
+    lock is retried on a new lock file.
+
+    :param lock_pathname: Pathname of the lock file
+    :param deadline: Time, in time.monotonic() seconds, after which the lock is no longer waited for
+    """
+    while True:
+        lock_file = open(lock_pathname, 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    lock_file.close()
+                    return None
+                time.sleep(COALESCE_LOCK_INTERVAL)
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_pathname).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def coalesce_across_processes(key, fetch):
+    """Executes the specified fetch while holding a lock file for the key, unless another process completed
+    the same fetch while this process was waiting for the lock, in which case its result is returned. If the lock
+    cannot be acquired within METAX_COALESCE_TIMEOUT seconds, the fetch is executed without the lock.
+
+    :param key: String identifying the fetched resource
+    :param fetch: Function fetching the resource, returning a JSON serializable value
+    """
+    coalesce_dir = current_app.config.get('METAX_COALESCE_DIR')
+
+    if not coalesce_dir:
+        return fetch()
+
+    os.makedirs(coalesce_dir, exist_ok=True)
+
+    basename = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    lock_pathname = os.path.join(coalesce_dir, '%s.lock' % basename)
+    result_pathname = os.path.join(coalesce_dir, '%s.json' % basename)
+
+    waiting_since = time.time()
+
+    lock_file = lock_coalesce_file(lock_pathname, time.monotonic() + get_coalesce_timeout())
+
+    if lock_file is None:
+        current_app.logger.warning("Timed out waiting for Metax API fetch of %s by another process" % key)
+        return fetch()
+
+    with lock_file:
+        try:
+            try:
+                if os.stat(result_pathname).st_mtime >= waiting_since:
+                    current_app.logger.debug("Using result of Metax API fetch of %s completed by another process" % key)
+                    with open(result_pathname, 'r') as result_file:
+                        return json.load(result_file)
+            except FileNotFoundError:
+                pass
+
+            result = fetch()
+
+            temp_pathname = '%s.%d' % (result_pathname, os.getpid())
+            with open(temp_pathname, 'w') as result_file:
+                json.dump(result, result_file)
+            os.replace(temp_pathname, result_pathname)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    sweep_coalesce_dir(coalesce_dir)
+
+    return result
+
+
+def sweep_coalesce_dir(coalesce_dir, now=None):
+    """Removes the lock and result files in the specified directory, including the temporary result files of
+    interrupted fetches, that have not been modified within the last METAX_COALESCE_TTL seconds. Result files are
+    only read by processes which were waiting for the fetch producing them, so they are of no use for longer than
+    the fetch takes. Lock files are only removed when not locked. The directory is swept at most once per
+    METAX_COALESCE_TTL seconds per process.
+
+    :param coalesce_dir: Directory of the lock and result files
+    :param now: Current time as epoch seconds, defaults to the current time
+    """
+    global coalesce_dir_swept
+
+    ttl = int(current_app.config.get('METAX_COALESCE_TTL', 300) or 0)
+    now = now or time.time()
+
+    if ttl <= 0 or coalesce_dir_swept > now - ttl:
+        return
+
+    coalesce_dir_swept = now
+
+    removed = 0
+
+    with os.scandir(coalesce_dir) as entries:
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False) or entry.stat().st_mtime >= now - ttl:
+                    continue
+                if entry.name.endswith('.lock'):
+                    with open(entry.path, 'a') as lock_file:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        # Processes waiting for the lock notice the removal and retry on a new lock file
+                        if os.fstat(lock_file.fileno()).st_ino == os.stat(entry.path).st_ino:
+                            os.remove(entry.path)
+                            removed += 1
+                else:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+
+    if removed > 0:
+        current_app.logger.debug("Removed %d expired files from %s" % (removed, coalesce_dir))
+
+
+def post_metax(resource, data):
+    """Posts JSON data to a resource of Metax API version 1 and returns the response
+
+    :param resource: resource to be requested from the API
+    :param data: JSON serializable data to be posted
+    :raises ConnectionError: Application is unable to connect to Metax API
+    """
+    metax_url = current_app.config['METAX_URL'].rstrip('/')
+    resource = resource.lstrip('/')
+
+    if '/rest/v1' in metax_url:
+        url = "%s/%s" % (metax_url, resource)
+    else:
+        url = "%s/rest/v1/%s" % (metax_url, resource)
+
+    try:
+        current_app.logger.debug("Posting to Metax API '%s'" % url)
+        auth = (current_app.config['METAX_USER'], current_app.config['METAX_PASS'])
+        return requests.post(url, auth=auth, json=data, timeout=get_timeout())
     except ConnectionError:
         current_app.logger.error("Unable to connect to Metax API on '%s'" % url)
         raise
@@ -92,6 +348,17 @@ def get_metax(resource):
 def get_dataset(dataset):
     """"Requests dataset metadata from Metax API.
 
+    Concurrent requests for the same dataset are coalesced into a single Metax API request.
+
+    :param dataset: ID of dataset which metadata is retrieved
+    :raises ConnectionError: Application is unable to connect to Metax API
+    """
+    return coalesce('datasets/%s' % dataset, lambda: fetch_dataset(dataset))
+
+
+def fetch_dataset(dataset):
+    """"Requests dataset metadata from Metax API.
+
     :param dataset: ID of dataset which metadata is retrieved
     :raises ConnectionError: Application is unable to connect to Metax API
     """
@@ -112,44 +379,317 @@ def get_dataset(dataset):
         raise
 
 
+def iter_json_array(chunks):
+    """Incrementally parses a JSON array from an iterable of text chunks, yielding each array element
+    as soon as it has been completely received, so that the whole array is never held in memory.
+
+    :param chunks: Iterable of strings which concatenated form a JSON array
+    :raises ValueError: The chunks do not form a valid JSON array
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    finished = False
+
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while not finished:
+            # Skip whitespace and element separators
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected JSON array but found '%s'" % buffer[pos])
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                finished = True
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element is not yet completely received
+                break
+            # A scalar element at the end of the buffer may still continue in the next chunk
+            if end >= len(buffer) and not isinstance(element, (dict, list)):
+                break
+            yield element
+            pos = end
+        buffer = buffer[pos:]
+
+    if not finished:
+        raise ValueError("Incomplete JSON array")
+
+
+def to_dataset_file(metax_file, metax_version):
+    """Projects a Metax file metadata record to a compact DatasetFile record.
+
+    :param metax_file: Dict of file metadata as returned by Metax API
+    :param metax_version: Version of the Metax API that returned the record
+    """
+    if metax_version >= 3:
+        pathname = metax_file['pathname']
+        project = metax_file.get('csc_project')
+        size = metax_file.get('size')
+        checksum = metax_file.get('checksum')
+    else:
+        pathname = metax_file['file_path']
+        project = metax_file.get('project_identifier')
+        size = metax_file.get('byte_size')
+        checksum = metax_file.get('checksum')
+        if isinstance(checksum, dict):
+            algorithm = str(checksum.get('algorithm', '')).lower().replace('-', '')
+            checksum = '%s:%s' % (algorithm, checksum.get('value'))
+
+    # Project identifiers are shared by all the files of a dataset, so keep only a single copy
+    if project is not None:
+        project = sys.intern(project)
+
+    return DatasetFile(pathname, project, size, checksum)
+
+
+def get_files_page_size(metax_version):
+    """Returns the configured page size for paginated retrieval of dataset file listings from the
+    specified version of Metax API, or zero if file listings should be retrieved in a single response.
+
+    :param metax_version: Version of the Metax API
+    """
+    return int(current_app.config.get('METAX_V%d_FILES_PAGE_SIZE' % metax_version, 0) or 0)
+
+
+def get_dataset_files_page(dataset, metax_version, offset, limit):
+    """Requests a single page of dataset files metadata from Metax API.
+
+    :param dataset: ID of dataset which files' metadata is retrieved
+    :param metax_version: Version of the Metax API
+    :param offset: Offset of the first file record on the page
+    :param limit: Maximum number of file records on the page
+    :raises ConnectionError: Application is unable to connect to Metax API
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    :returns: Tuple of the total count of dataset files and a list of DatasetFile records on the page
+    """
+    metax_response = get_metax('datasets/%s/files?pagination=true&offset=%d&limit=%d' % (dataset, offset, limit))
+
+    if metax_response.status_code != 200:
+        current_app.logger.error(
+            "Received unexpected status code '%s' from Metax API"
+            % metax_response.status_code)
+        raise UnexpectedStatusCode
+
+    page = metax_response.json()
+
+    # If pagination is not honoured by Metax API, the whole listing is returned as a single array
+    if isinstance(page, list):
+        return len(page), [to_dataset_file(metax_file, metax_version) for metax_file in page]
+
+    dataset_files = [to_dataset_file(metax_file, metax_version) for metax_file in page.get('results', [])]
+
+    return int(page.get('count', len(dataset_files))), dataset_files
+
+
+def iter_paginated_dataset_files(dataset, metax_version, page_size):
+    """Retrieves dataset files metadata from Metax API in pages, fetching the pages following the first page
+    concurrently with bounded parallelism, and yields the DatasetFile records in their original order.
+
+    If Metax API returns fewer records per page than requested, the length of the first page is used as the
+    page size, and the rest of any other page returned short is fetched sequentially.
+
+    :param dataset: ID of dataset which files' metadata is retrieved
+    :param metax_version: Version of the Metax API
+    :param page_size: Number of file records requested per page
+    :raises ConnectionError: Application is unable to connect to Metax API
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    :raises IncompleteFileListing: Fewer files than the reported count were received from Metax API
+    :returns: Iterator over DatasetFile records
+    """
+    count, first_page = get_dataset_files_page(dataset, metax_version, 0, page_size)
+
+    # Metax API may cap the number of records per page below the requested page size
+    if 0 < len(first_page) < min(page_size, count):
+        page_size = len(first_page)
+
+    app = current_app._get_current_object()
+    max_workers = max(1, int(app.config.get('METAX_FILES_PARALLEL_REQUESTS', 4)))
+
+    def fetch_page(offset):
+        with app.app_context():
+            expected = min(page_size, count - offset)
+            page = get_dataset_files_page(dataset, metax_version, offset, page_size)[1]
+            while len(page) < expected:
+                rest = get_dataset_files_page(dataset, metax_version, offset + len(page), expected - len(page))[1]
+                if len(rest) == 0:
+                    break
+                page.extend(rest)
+            return page
+
+    def iter_pages():
+        yield first_page
+        offsets = iter(range(len(first_page), count, page_size)) if len(first_page) > 0 else iter(())
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Keep a bounded number of pages in flight so that fetched pages do not pile up in memory
+            pending = deque()
+            for offset in offsets:
+                pending.append(executor.submit(fetch_page, offset))
+                if len(pending) >= max_workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    app.logger.debug("Retrieving %d files for dataset %s in pages of %d" % (count, dataset, page_size))
+
+    def iter_dataset_files():
+        received = 0
+        for page in iter_pages():
+            received += len(page)
+            for dataset_file in page:
+                yield dataset_file
+        if received != count:
+            app.logger.error(
+                "Received %d files for dataset %s from Metax API, expected %d" % (received, dataset, count))
+            raise IncompleteFileListing(dataset, received, count)
+        app.logger.debug("Successfully retrieved files for dataset %s" % dataset)
+
+    return iter_dataset_files()
+
+
 def get_dataset_files(dataset):
     """"Requests dataset files metadata from Metax API.
 
+    Concurrent requests in this process for the files of the same dataset are coalesced into a single retrieval
+    from Metax API, the resulting DatasetFile records being shared by all requestors, as long as the dataset has
+    at most METAX_COALESCE_MAX_FILES files. The files of larger datasets are streamed to each requestor by a
+    retrieval of its own, so that the memory used for a file listing remains bounded.
+
+    :param dataset: ID of dataset which files' metadata is retrieved
+    :raises ConnectionError: Application is unable to connect to Metax API
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    :returns: Iterator over DatasetFile records
+    """
+    max_files = int(current_app.config.get('METAX_COALESCE_MAX_FILES', 10000) or 0)
+
+    if max_files <= 0:
+        return fetch_dataset_files(dataset)
+
+    streamed = []
+
+    def fetch():
+        dataset_files = fetch_dataset_files(dataset)
+        buffered = list(islice(dataset_files, max_files + 1))
+        if len(buffered) <= max_files:
+            return buffered
+        # Too many files to be shared, so the fetching requestor streams the rest of the files for itself
+        streamed.append(chain(buffered, dataset_files))
+        return None
+
+    dataset_files = coalesce('datasets/%s/files' % dataset, fetch, across_processes=False)
+
+    if len(streamed) > 0:
+        return streamed[0]
+
+    if dataset_files is None:
+        return fetch_dataset_files(dataset)
+
+    return iter(dataset_files)
+
+
+def fetch_dataset_files(dataset):
+    """"Requests dataset files metadata from Metax API.
+
+    The response is streamed and parsed incrementally, and only the fields used by the service are
+    kept in memory, as compact DatasetFile records.
+
+    If a page size is configured for the Metax API version in use (METAX_V1_FILES_PAGE_SIZE or
+    METAX_V3_FILES_PAGE_SIZE), the files are instead retrieved in pages which are fetched concurrently,
+    with at most METAX_FILES_PARALLEL_REQUESTS requests in flight at a time.
+
     :param dataset: ID of dataset which files' metadata is retrieved
     :raises ConnectionError: Application is unable to connect to Metax API
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    :returns: Iterator over DatasetFile records
     """
     try:
         current_app.logger.debug("Retrieving files for dataset %s" % dataset)
 
-        if current_app.config.get('METAX_VERSION', 1) >= 3:
-            metax_response = get_metax('datasets/%s/files?pagination=false' % dataset)
+        metax_version = int(current_app.config.get('METAX_VERSION', 1))
+
+        page_size = get_files_page_size(metax_version)
+
+        if page_size > 0:
+            return iter_paginated_dataset_files(dataset, metax_version, page_size)
+
+        if metax_version >= 3:
+            metax_response = get_metax('datasets/%s/files?pagination=false' % dataset, stream=True)
         else:
-            metax_response = get_metax('datasets/%s/files' % dataset)
+            metax_response = get_metax('datasets/%s/files' % dataset, stream=True)
 
         if metax_response.status_code != 200:
             current_app.logger.error(
                 "Received unexpected status code '%s' from Metax API"
                 % metax_response.status_code)
+            metax_response.close()
             raise UnexpectedStatusCode
 
-        current_app.logger.debug("Successfully retrieved files for dataset %s" % dataset)
-
-        return metax_response.json()
-
     except ConnectionError:
         raise
 
+    def iter_dataset_files():
+        try:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            chunks = map(decoder.decode, metax_response.iter_content(chunk_size=FILES_CHUNK_SIZE))
+            for metax_file in iter_json_array(chunks):
+                yield to_dataset_file(metax_file, metax_version)
+            current_app.logger.debug("Successfully retrieved files for dataset %s" % dataset)
+        finally:
+            metax_response.close()
 
-def get_dataset_modified_from_metax(dataset_id):
-    try:
-        metax_response = get_dataset(dataset_id)
-    except ConnectionError:
-        raise
-    except DatasetNotFound:
-        raise
-    except UnexpectedStatusCode:
-        raise
+    return iter_dataset_files()
+
+
+def get_cached_datasets_modified(dataset_ids):
+    """Returns the dataset modification timestamps cached within the last METAX_CACHE_TTL seconds, or pushed by a
+    trusted service within the last METAX_PUSH_TTL seconds, for the specified datasets, as a dict keyed by dataset ID.
+
+    :param dataset_ids: List of dataset IDs
+    """
+    cache_ttl = int(current_app.config.get('METAX_CACHE_TTL', 0) or 0)
+    push_ttl = int(current_app.config.get('METAX_PUSH_TTL', 300) or 0)
+
+    if (cache_ttl <= 0 and push_ttl <= 0) or len(dataset_ids) == 0:
+        return {}
+
+    now = int(time.time())
+
+    return db.get_cached_dataset_modified_timestamps(
+        dataset_ids,
+        now - cache_ttl if cache_ttl > 0 else None,
+        now - push_ttl if push_ttl > 0 else None)
+
+
+def cache_datasets_modified(dataset_modified_timestamps):
+    """Records the specified dataset modification timestamps in the Metax cache, if caching is enabled.
 
+    :param dataset_modified_timestamps: Dict of normalized modification timestamps keyed by dataset ID
+    """
+    cache_ttl = int(current_app.config.get('METAX_CACHE_TTL', 0) or 0)
+
+    if cache_ttl <= 0 or len(dataset_modified_timestamps) == 0:
+        return
+
+    db.cache_dataset_modified_timestamps(dataset_modified_timestamps, int(time.time()))
+
+
+def get_dataset_modified(metax_response, dataset_id):
+    """Returns the normalized modification timestamp, or if not defined the creation timestamp, from the specified
+    dataset metadata.
+
+    :param metax_response: Dict of dataset metadata as returned by Metax API
+    :param dataset_id: ID of the dataset
+    :raises MissingFieldsInResponse: Neither timestamp is defined in the dataset metadata
+    """
     metax_version = current_app.config.get('METAX_VERSION', 1)
 
     if metax_version >= 3:
@@ -174,6 +714,118 @@ def get_dataset_modified_from_metax(dataset_id):
                 raise MissingFieldsInResponse(['date_modified', 'date_created'])
 
 
+def fetch_dataset_modified(dataset_id):
+    try:
+        metax_response = get_dataset(dataset_id)
+    except ConnectionError:
+        raise
+    except DatasetNotFound:
+        raise
+    except UnexpectedStatusCode:
+        raise
+
+    return get_dataset_modified(metax_response, dataset_id)
+
+
+def get_dataset_modified_from_metax(dataset_id):
+    """Returns the normalized modification timestamp of a dataset, from the Metax cache if cached recently
+    enough, else from Metax API.
+
+    :param dataset_id: ID of the dataset
+    :raises ConnectionError: Application is unable to connect to Metax API
+    :raises DatasetNotFound: Dataset was not found in Metax API
+    :raises MissingFieldsInResponse: Modification timestamp was not found in Metax API response
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    """
+    cached = get_cached_datasets_modified([dataset_id])
+
+    if dataset_id in cached:
+        return cached[dataset_id]
+
+    modified = fetch_dataset_modified(dataset_id)
+
+    cache_datasets_modified({dataset_id: modified})
+
+    return modified
+
+
+def fetch_datasets_modified_by_list(dataset_ids):
+    """Retrieves modification timestamps for multiple datasets with Metax API dataset list queries.
+
+    :param dataset_ids: List of dataset IDs
+    :returns: Dict of normalized modification timestamps keyed by dataset ID, None for datasets not found
+    """
+    dataset_modified_timestamps = dict.fromkeys(dataset_ids)
+
+    for i in range(0, len(dataset_ids), DATASETS_LIST_QUERY_SIZE):
+        chunk = dataset_ids[i:i + DATASETS_LIST_QUERY_SIZE]
+        metax_response = post_metax('datasets/list?pagination=false', chunk)
+
+        if metax_response.status_code != 200:
+            current_app.logger.error("Received unexpected status code '%s' from Metax API" % metax_response.status_code)
+            raise UnexpectedStatusCode
+
+        for dataset in metax_response.json():
+            dataset_id = dataset.get('identifier')
+            if dataset_id in dataset_modified_timestamps:
+                dataset_modified_timestamps[dataset_id] = get_dataset_modified(dataset, dataset_id)
+
+    return dataset_modified_timestamps
+
+
+def fetch_datasets_modified_concurrently(dataset_ids):
+    """Retrieves modification timestamps for multiple datasets from Metax API, with at most
+    METAX_PARALLEL_REQUESTS requests in flight at a time.
+
+    :param dataset_ids: List of dataset IDs
+    :returns: Dict of normalized modification timestamps keyed by dataset ID, None for datasets not found
+    """
+    app = current_app._get_current_object()
+    max_workers = max(1, int(app.config.get('METAX_PARALLEL_REQUESTS', 8)))
+
+    def fetch(dataset_id):
+        with app.app_context():
+            try:
+                return fetch_dataset_modified(dataset_id)
+            except DatasetNotFound:
+                return None
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dataset_ids))) as executor:
+        return dict(zip(dataset_ids, executor.map(fetch, dataset_ids)))
+
+
+def get_datasets_modified(dataset_ids):
+    """Returns the normalized modification timestamps of multiple datasets, from the Metax cache where cached
+    recently enough, else from Metax API, either with dataset list queries if enabled with
+    METAX_DATASETS_LIST_QUERY (Metax API version 1 only), or with concurrent requests per dataset.
+
+    :param dataset_ids: Iterable of dataset IDs
+    :raises ConnectionError: Application is unable to connect to Metax API
+    :raises MissingFieldsInResponse: Modification timestamp was not found in Metax API response
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    :returns: Dict of normalized modification timestamps keyed by dataset ID, None for datasets not found
+    """
+    dataset_ids = list(dict.fromkeys(dataset_ids))
+
+    dataset_modified_timestamps = get_cached_datasets_modified(dataset_ids)
+
+    missing = [dataset_id for dataset_id in dataset_ids if dataset_id not in dataset_modified_timestamps]
+
+    if len(missing) > 0:
+        current_app.logger.debug("Retrieving modification timestamps for %d datasets" % len(missing))
+
+        if int(current_app.config.get('METAX_VERSION', 1)) < 3 and current_app.config.get('METAX_DATASETS_LIST_QUERY', False):
+            fetched = fetch_datasets_modified_by_list(missing)
+        else:
+            fetched = fetch_datasets_modified_concurrently(missing)
+
+        cache_datasets_modified(dict((k, v) for k, v in fetched.items() if v is not None))
+
+        dataset_modified_timestamps.update(fetched)
+
+    return dataset_modified_timestamps
+
+
 def get_matching_project_identifier_from_metax(dataset_id, filepath):
     """
     This function serves two purposes. It both ensures that the specified file belongs
@@ -181,42 +833,43 @@ def get_matching_project_identifier_from_metax(dataset_id, filepath):
     project to which the file belongs.
     """
     try:
-        metax_files_response = get_dataset_files(dataset_id)
+        dataset_files = get_dataset_files(dataset_id)
     except ConnectionError:
         raise
     except UnexpectedStatusCode:
         raise
 
-    if current_app.config.get('METAX_VERSION', 1) >= 3:
-        matching_files = list(filter(lambda metax_file: metax_file['pathname'] == filepath, metax_files_response))
-    else:
-        matching_files = list(filter(lambda metax_file: metax_file['file_path'] == filepath, metax_files_response))
+    matching_file = None
 
-    if len(matching_files) == 0:
+    for dataset_file in dataset_files:
+        if dataset_file.pathname == filepath:
+            matching_file = dataset_file
+
+    if matching_file is None:
         raise NoMatchingFilesFound(dataset_id)
 
-    if current_app.config.get('METAX_VERSION', 1) >= 3:
-        return matching_files[-1].get('csc_project')
-    else:
-        return matching_files[-1].get('project_identifier')
+    return matching_file.project
 
 
 def get_matching_dataset_files_from_metax(dataset_id, scope):
     try:
-        metax_files_response = get_dataset_files(dataset_id)
+        dataset_files_iterator = get_dataset_files(dataset_id)
     except ConnectionError:
         raise
     except UnexpectedStatusCode:
         raise
 
-    if current_app.config.get('METAX_VERSION', 1) >= 3:
-        dataset_files = set(map(lambda metax_file: metax_file['pathname'], metax_files_response))
-    else:
-        dataset_files = set(map(lambda metax_file: metax_file['file_path'], metax_files_response))
+    dataset_files = set()
+    project_identifier = None
+
+    for dataset_file in dataset_files_iterator:
+        if project_identifier is None:
+            project_identifier = dataset_file.project
+        dataset_files.add(dataset_file.pathname)
 
     generate_scope = set(filter(
         lambda dataset_file: len(scope) == 0 or
-        len(set(filter(lambda scopefile: startswithpath(scopefile, dataset_file), scope))) > 0, dataset_files))
+        any(startswithpath(scopefile, dataset_file) for scopefile in scope), dataset_files))
 
     if len(generate_scope) == 0:
         current_app.logger.error("Could not find files matching request "
@@ -224,11 +877,6 @@ def get_matching_dataset_files_from_metax(dataset_id, scope):
                                  % (dataset_id, scope))
         raise NoMatchingFilesFound(dataset_id)
 
-    if current_app.config.get('METAX_VERSION', 1) >= 3:
-        project_identifier = list(map(lambda metax_file: metax_file['csc_project'], metax_files_response))[0]
-    else:
-        project_identifier = list(map(lambda metax_file: metax_file['project_identifier'], metax_files_response))[0]
-
     is_partial = 0 if generate_scope == dataset_files else 1
 
     return generate_scope, project_identifier, is_partial
@@ -11,7 +11,8 @@ from flask.cli import AppGroup
 from pika import BlockingConnection, ConnectionParameters, PlainCredentials
 from pika.exceptions import AMQPConnectionError
 from socket import gaierror
-from .db import get_task_rows_for_status, get_generate_scope_filepaths, update_task_id, update_task_status, get_request_scopes
+from .db import get_task_rows_for_status, iter_generate_scope_filepaths, update_task_status, \
+                get_request_scopes_for_tasks
 from ..utils import normalize_timestamp
 import threading
 
@@ -115,13 +116,19 @@ def reload_queue():
                 datasets.append(dataset_id)
                 task_id = task_row['task_id']
                 project_identifier = task_id.split()[0]
-                generate_scope = get_generate_scope_filepaths(task_id)
-                task = generate_task.delay(dataset_id, project_identifier, list(generate_scope))
-                update_task_id(task_id, task.id)
-                update_task_status(task.id, 'PENDING')
+                generate_scope = list(iter_generate_scope_filepaths(task_id))
+                # The task is queued with its permanent task id, so that the status recorded by the
+                # worker updates the existing task record; the task is marked as pending before it is
+                # queued so that the worker cannot record a later status which would be overwritten
+                update_task_status(task_id, 'PENDING')
+                try:
+                    generate_task.apply_async((dataset_id, project_identifier, generate_scope), task_id=task_id)
+                except BaseException:
+                    update_task_status(task_id, 'NEW')
+                    raise
                 added_tasks.append({
                     "id": task_row['id'],
-                    "task_id": task.id,
+                    "task_id": task_id,
                     "dataset_id": task_row['dataset_id'],
                     "is_partial": task_row['is_partial'],
                     "status": "PENDING",
@@ -134,9 +141,10 @@ def reload_queue():
 
 def task_rows_to_json(task_rows):
     tasks = []
+    request_scopes = get_request_scopes_for_tasks(task_row['task_id'] for task_row in task_rows)
     for task_row in task_rows:
         task_scope = set()
-        for scope in get_request_scopes(task_row['task_id']):
+        for scope in request_scopes.get(task_row['task_id'], []):
             for path in scope:
                 task_scope.add(path)
         task_scope = sorted(list(task_scope))
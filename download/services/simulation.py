@@ -0,0 +1,245 @@
+"""
+    download.simulation
+    ~~~~~~~~~~~~~~~~~~~
+
+    Cache simulation module for Fairdata Download Service.
+
+    Replays historical package download traffic through the cache eviction policies of the cache module, in
+    order to evaluate cache volume limits and eviction policies without experimenting in production. The
+    traffic is loaded either from a snapshot of the service database, including any archived download records,
+    or from legacy metrics event files.
+
+    Each download of a package is a request for the package, identified by its dataset and scope, so that the
+    successive packages generated for the same dataset and scope are considered the same package. A request
+    for a package in the simulated cache is a hit. A request for any other package is a miss, after which the
+    package is generated by a single simulated generator processing its queue in order, and added to the cache,
+    removing packages selected by the eviction policy if the cache volume exceeds the purge threshold, as
+    before each package generation by the service.
+
+    The traffic is loaded into compact arrays of request times and interned package keys, sorted once by time,
+    so that replaying years of traffic only takes seconds.
+"""
+import os
+import json
+import gzip
+import sqlite3
+import calendar
+import time
+from array import array
+from typing import NamedTuple
+from jwt import decode, DecodeError
+from ..dto import Package
+from .cache import get_eviction_policy, CostAwarePolicy
+
+
+class Trace(NamedTuple):
+    # Package requests in the order of their times, with the requested packages as indexes to the package keys,
+    # sizes in bytes and generation times in seconds, if measured, of the distinct packages requested
+    times: array
+    packages: array
+    keys: list
+    sizes: list
+    generation_seconds: list
+
+
+def parse_epoch(timestamp):
+    """Returns the specified UTC timestamp, in ISO 8601 or SQLite format, as epoch seconds."""
+    return calendar.timegm(time.strptime(timestamp[:19].replace('T', ' '), '%Y-%m-%d %H:%M:%S'))
+
+
+def build_trace(requests, sizes, generation_seconds, package_size):
+    """Builds a trace from the specified requests.
+
+    :param requests: Iterable of (time, key) tuples of package requests, with times as epoch seconds
+    :param sizes: Dict of the known sizes in bytes of packages, by key
+    :param generation_seconds: Dict of the measured generation times in seconds of packages, by key
+    :param package_size: Size in bytes assumed for packages of unknown size
+    """
+    requests = sorted(requests, key=lambda request: request[0])
+    indexes = {}
+    keys = []
+    times = array('d')
+    packages = array('l')
+    for request_time, key in requests:
+        index = indexes.get(key)
+        if index is None:
+            index = indexes[key] = len(keys)
+            keys.append(key)
+        times.append(request_time)
+        packages.append(index)
+    return Trace(
+        times,
+        packages,
+        keys,
+        [sizes.get(key) or package_size for key in keys],
+        [generation_seconds.get(key) for key in keys])
+
+
+def load_database_trace(database_file, package_size):
+    """Loads the package download history recorded in a snapshot of the service database, including archived
+    download records. The snapshot is opened read-only, and may be of any schema version.
+
+    :param database_file: Pathname of the SQLite database snapshot
+    :param package_size: Size in bytes assumed for packages no longer in the database
+    """
+    db_conn = sqlite3.connect('file:%s?mode=ro' % database_file, uri=True)
+    db_conn.row_factory = sqlite3.Row
+
+    def columns(table):
+        return set(row['name'] for row in db_conn.execute('PRAGMA table_info(%s)' % table))
+
+    task_columns = columns('generate_task')
+    tasks = {}
+    for row in db_conn.execute(
+            'SELECT task_id, dataset_id, is_partial, %s AS scope_hash FROM generate_task'
+            % ('scope_hash' if 'scope_hash' in task_columns else 'NULL')):
+        # Partial packages of the same scope are only known to be the same package if their scope hash is recorded
+        if not row['is_partial']:
+            key = (row['dataset_id'], None)
+        else:
+            key = (row['dataset_id'], row['scope_hash'] or row['task_id'])
+        tasks[row['task_id']] = key
+
+    package_columns = columns('package')
+    package_tasks = {}
+    sizes = {}
+    generation_seconds = {}
+    for row in db_conn.execute(
+            'SELECT filename, size_bytes, generated_by, %s AS generation_seconds FROM package'
+            % ('generation_seconds' if 'generation_seconds' in package_columns else 'NULL')):
+        package_tasks[row['filename']] = row['generated_by']
+        key = tasks.get(row['generated_by'], row['filename'])
+        sizes[key] = row['size_bytes']
+        if row['generation_seconds']:
+            generation_seconds[key] = row['generation_seconds']
+
+    def get_key(filename, claims):
+        task_id = package_tasks.get(filename) or (claims or {}).get('generated_by')
+        return tasks.get(task_id, filename)
+
+    requests = []
+
+    # Downloads of single files, whose filenames are pathnames, are not served from the cache
+    for row in db_conn.execute(
+            "SELECT token, filename, started FROM download "
+            "WHERE status = 'SUCCESSFUL' AND filename NOT LIKE '/%'"):
+        claims = None
+        if row['filename'] not in package_tasks:
+            try:
+                claims = decode(row['token'], options={'verify_signature': False, 'verify_exp': False})
+            except DecodeError:
+                pass
+        requests.append((parse_epoch(row['started']), get_key(row['filename'], claims)))
+
+    if db_conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'download_archive'").fetchone()[0] > 0:
+        for row in db_conn.execute('SELECT records FROM download_archive ORDER BY first_id'):
+            for line in gzip.decompress(bytes(row['records'])).decode('utf-8').split('\n'):
+                record = json.loads(line)
+                if record['status'] == 'SUCCESSFUL' and not record['filename'].startswith('/') and record['started']:
+                    requests.append((parse_epoch(record['started']), get_key(record['filename'], record['claims'])))
+
+    db_conn.close()
+
+    return build_trace(requests, sizes, generation_seconds, package_size)
+
+
+def load_event_trace(pathnames, package_size):
+    """Loads the package download history recorded in legacy metrics event files. The events do not record the
+    sizes of the packages, so the specified size is assumed for all packages.
+
+    :param pathnames: Pathnames of the JSON files of download events
+    :param package_size: Size in bytes assumed for all packages
+    """
+    requests = []
+    for pathname in pathnames:
+        with open(pathname) as events_file:
+            for event in json.load(events_file):
+                # Downloads of single files are not served from the cache
+                if event.get('type') == 'FILE' or event.get('status') != 'SUCCESS':
+                    continue
+                if event['type'] == 'PARTIAL':
+                    key = (event['dataset'], tuple(sorted(event.get('scope', []))))
+                elif event['type'] == 'PACKAGE':
+                    key = (event['dataset'], event.get('package'))
+                else:
+                    key = (event['dataset'], None)
+                requests.append((parse_epoch(event['started']), key))
+    return build_trace(requests, {}, {}, package_size)
+
+
+def simulate(trace, policy_name, threshold, target):
+    """Replays a trace through the specified eviction policy with the specified cache volume limits.
+
+    Generation times not measured are estimated from the average generation time per byte of the packages
+    whose generation time was measured, as by the cost-aware eviction policy.
+
+    :param trace: Trace of package requests
+    :param policy_name: Name of the eviction policy
+    :param threshold: Cache volume in bytes above which packages are removed before a package is generated
+    :param target: Cache volume in bytes to which the cache is reduced when packages are removed
+    :returns: Dict of the hits, hit ratio, bytes regenerated, peak cache volume, and mean and maximum queue wait
+    """
+    policy = get_eviction_policy(policy_name)
+
+    measured = [i for i, seconds in enumerate(trace.generation_seconds) if seconds]
+    if len(measured) > 0:
+        seconds_per_byte = (
+            sum(trace.generation_seconds[i] for i in measured) / sum(trace.sizes[i] for i in measured))
+    else:
+        seconds_per_byte = CostAwarePolicy.DEFAULT_SECONDS_PER_BYTE
+
+    cached = {}
+    usage = 0
+    peak_usage = 0
+    hits = 0
+    bytes_regenerated = 0
+    generator_available = 0.0
+    total_wait = 0.0
+    max_wait = 0.0
+
+    for request_time, index in zip(trace.times, trace.packages):
+        package = cached.get(index)
+
+        if package is not None:
+            hits += 1
+            package.no_downloads += 1
+            package.last_downloaded = int(request_time)
+            continue
+
+        size = trace.sizes[index]
+        seconds = trace.generation_seconds[index] or size * seconds_per_byte
+
+        # As in the service, packages are removed before the generation of a package if the cache volume
+        # exceeds the purge threshold
+        if usage > threshold:
+            for removed in policy.select(usage - target, list(cached.values()), int(request_time)):
+                del cached[int(removed.filename)]
+                usage -= removed.size_bytes
+
+        start = max(request_time, generator_available)
+        generator_available = start + seconds
+        wait = start - request_time
+        total_wait += wait
+        max_wait = max(max_wait, wait)
+
+        cached[index] = Package(
+            str(index), size, 1, generated_at=int(generator_available), last_downloaded=int(generator_available),
+            generation_seconds=seconds)
+        usage += size
+        peak_usage = max(peak_usage, usage)
+        bytes_regenerated += size
+
+    requests = len(trace.times)
+
+    return {
+        'policy': policy.name,
+        'threshold': threshold,
+        'target': target,
+        'requests': requests,
+        'hits': hits,
+        'hit_ratio': round(hits / requests, 4) if requests else None,
+        'bytes_regenerated': bytes_regenerated,
+        'peak_usage_bytes': peak_usage,
+        'mean_queue_wait': round(total_wait / (requests - hits), 1) if requests > hits else 0.0,
+        'max_queue_wait': round(max_wait, 1)
+    }
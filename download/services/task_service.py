@@ -6,11 +6,13 @@
 """
 import os
 import time
+import uuid
 import dateutil.parser
 from datetime import datetime
+from flask import current_app
 from requests.exceptions import ConnectionError
 from .. import utils
-from . import db, metax, cache
+from . import db, metax, cache, mq
 from .metax import DatasetNotFound, MissingFieldsInResponse, NoMatchingFilesFound, UnexpectedStatusCode
 
 os.environ["TZ"] = "UTC"
@@ -66,15 +68,14 @@ def get_active_tasks(dataset_id):
     """
 
     # If a dataset id is specified, we will get the dataset modification timestamp from
-    # metax and use that in the query when retrieving active tasks for the dataset, else
-    # we will need to iterate over the returned tasks and retrieve the dataset modification
-    # timestamp and filter out those which were initiated after the dataset was modified.
-
-    dataset_modified = None
+    # metax and retrieve the tasks of that dataset only, else we will retrieve the tasks of
+    # all datasets and the modification timestamps of all their datasets with a single bulk
+    # lookup. In both cases, we then filter out those tasks which were not initiated after
+    # the dataset was last modified.
 
     if dataset_id:
         try:
-            dataset_modified = metax.get_dataset_modified_from_metax(dataset_id)
+            dataset_modified_timestamps = {dataset_id: metax.get_dataset_modified_from_metax(dataset_id)}
         except DatasetNotFound as err:
             raise
         except ConnectionError:
@@ -84,45 +85,19 @@ def get_active_tasks(dataset_id):
         except UnexpectedStatusCode:
             raise
 
-    # >>>
-    # Temp hack - if dataset specified, get tasks for all datasets, filtering by specified dataset afterwards (results should be equivalent)
-    temp_dataset_id = dataset_id
-    dataset_id = None
-    dataset_modified = None
-    # <<<
-
-    task_rows = db.get_task_rows(dataset_id, dataset_modified)
+    task_rows = db.get_task_rows(dataset_id, None)
 
-    # When no dataset specified, filter out tasks initiated earlier than last dataset modification timestamp
-    # (in this special case, if a dataset is not found in Metax, its tasks are excluded, but no exception is raised)
+    # When no dataset specified, if a dataset is not found in Metax, its tasks are excluded, but
+    # no exception is raised
     if not dataset_id:
-        task_rows_ok = []
-        dataset_modified_timestamps = {}
-        for row in task_rows:
-            try:
-                dataset_id = row['dataset_id']
-                dataset_modified = dataset_modified_timestamps.get(dataset_id)
-                if not dataset_modified:
-                    dataset_modified = metax.get_dataset_modified_from_metax(dataset_id)
-                    dataset_modified = utils.normalize_timestamp(dataset_modified)
-                    dataset_modified_timestamps[dataset_id] = dataset_modified
-                if utils.normalize_timestamp(row['initiated']) > dataset_modified:
-                    task_rows_ok.append(row)
-            except DatasetNotFound as err:
-                pass
-        dataset_id = None
-        task_rows = task_rows_ok
-
-    # >>>
-    # Temp hack - restrict results to any specified dataset
-    dataset_id = temp_dataset_id
-    if dataset_id:
-        temp_task_rows = []
-        for row in task_rows:
-            if row['dataset_id'] == dataset_id:
-                temp_task_rows.append(row)
-        task_rows = temp_task_rows
-    # <<<
+        dataset_modified_timestamps = metax.get_datasets_modified(row['dataset_id'] for row in task_rows)
+
+    task_rows_ok = []
+    for row in task_rows:
+        dataset_modified = dataset_modified_timestamps.get(row['dataset_id'])
+        if dataset_modified and utils.normalize_timestamp(row['initiated']) > dataset_modified:
+            task_rows_ok.append(row)
+    task_rows = task_rows_ok
 
     if len(task_rows) == 0:
         raise NoActiveTasksFound(dataset_id)
@@ -162,16 +137,45 @@ def get_active_task(dataset_id, request_scope=[]):
     except NoMatchingFilesFound as err:
         raise
 
-    # Check existing tasks in database
-    task_rows = db.get_task_rows(dataset_id, dataset_modified)
+    # Check existing tasks in database with a matching scope hash
+    scope_hash = db.get_scope_hash(generate_scope)
+    task_rows = db.get_task_rows(dataset_id, dataset_modified, scope_hash)
 
     for row in task_rows:
-        if db.get_generate_scope_filepaths(row['task_id']) == generate_scope:
+        if row['scope_hash'] == scope_hash:
+            return row, project_identifier, is_partial, generate_scope
+        # Tasks created before scope hashes were recorded are compared by their full scope,
+        # and their scope hash recorded for subsequent lookups
+        task_scope = db.get_generate_scope_filepaths(row['task_id'])
+        db.update_task_scope_hash(row['task_id'], db.get_scope_hash(task_scope))
+        if task_scope == generate_scope:
             return row, project_identifier, is_partial, generate_scope
 
     return None, project_identifier, is_partial, generate_scope
 
 
+def create_task(dataset_id, project_identifier, is_partial, generate_scope, request_scope=[]):
+    """Create a new package generation task, to be queued when the queue is next reloaded.
+
+    The task is recorded with a permanent task id combining the project identifier with a randomly
+    generated string, which is also used as the id of the task when it is queued.
+
+    :param dataset_id: ID of the dataset
+    :param project_identifier: Project identifier of the dataset files
+    :param is_partial: Boolean value specifying whether the package is partial
+    :param generate_scope: List of all the filepaths to be included in the package
+    :param request_scope: Scope of the package as specified in the API request
+    """
+    task_id = "%s %s" % (project_identifier, uuid.uuid4())
+
+    task_row = db.create_task_rows(dataset_id, task_id, is_partial, generate_scope)
+
+    if is_partial:
+        db.create_request_scope(task_id, request_scope)
+
+    return task_row
+
+
 def check_if_package_can_be_downloaded(dataset_id, package):
     """Get package generation task for specified dataset matching given request scope.
 
@@ -212,3 +216,84 @@ def check_if_package_can_be_downloaded(dataset_id, package):
         raise PackageOutdated(dataset_id, package)
 
     return True
+
+
+def invalidate_dataset(dataset_id, modified=None, regenerate=False):
+    """Invalidate the packages and not yet completed tasks of a dataset which predate the modification of the dataset,
+    as notified by a trusted service.
+
+    The modification timestamp is recorded as pushed, and is trusted for METAX_PUSH_TTL seconds, during which
+    the modification timestamp of the dataset is not requested from Metax API when checking packages and tasks.
+    Optionally, packages downloaded at least REGENERATE_MIN_DOWNLOADS times are requested to be regenerated.
+
+    :param dataset_id: ID of the dataset
+    :param modified: Modification timestamp of the dataset, retrieved from Metax API if not specified
+    :param regenerate: Whether popular invalidated packages are requested to be regenerated
+    :raises ConnectionError: Application is unable to connect to Metax API
+    :raises DatasetNotFound: Dataset was not found in Metax API
+    :raises MissingFieldsInResponse: Modification timestamp was not found in Metax API response
+    :raises UnexpectedStatusCode: Unexpected status code was received from Metax API
+    """
+    if modified:
+        modified = utils.normalize_timestamp(modified)
+    else:
+        modified = metax.fetch_dataset_modified(dataset_id)
+
+    message = "Invalidating packages and tasks of dataset %s predating modification at %s" % (dataset_id, modified)
+    current_app.logger.info(message)
+    status = message
+
+    db.push_dataset_modified_timestamp(dataset_id, modified, int(time.time()))
+
+    outdated_packages = [
+        package for package in db.get_active_packages(dataset_id)
+        if utils.normalize_timestamp(package.generated_at) < modified
+    ]
+
+    # Record the request scopes of popular outdated packages before their records are removed
+    regenerate_scopes = []
+    if regenerate:
+        min_downloads = int(current_app.config.get('REGENERATE_MIN_DOWNLOADS', 1))
+        for package in outdated_packages:
+            if package.no_downloads >= min_downloads:
+                task_row = db.get_task(package.filename)
+                if task_row is None:
+                    continue
+                if task_row['is_partial']:
+                    request_scopes = db.get_request_scopes(task_row['task_id'])
+                else:
+                    request_scopes = [set()]
+                for request_scope in request_scopes:
+                    if sorted(request_scope) not in regenerate_scopes:
+                        regenerate_scopes.append(sorted(request_scope))
+
+    if len(outdated_packages) > 0:
+        removed_packages = cache.remove_cache_files(outdated_packages)
+        message = "Outdated packages removed:\n   " + "\n   ".join(removed_packages)
+    else:
+        message = "No outdated packages found"
+    current_app.logger.info(message)
+    status = status + "\n" + message
+
+    message = "Outdated tasks: %d" % db.outdate_task_rows(dataset_id, modified)
+    current_app.logger.info(message)
+    status = status + "\n" + message
+
+    if regenerate:
+        created = 0
+        for request_scope in regenerate_scopes:
+            try:
+                task_row, project_identifier, is_partial, generate_scope = get_active_task(dataset_id, request_scope)
+            except NoMatchingFilesFound:
+                current_app.logger.info("No files of dataset %s match scope %s, not regenerated" % (dataset_id, request_scope))
+                continue
+            if task_row is None:
+                create_task(dataset_id, project_identifier, is_partial, generate_scope, request_scope)
+                created += 1
+        message = "Regeneration tasks created: %d" % created
+        current_app.logger.info(message)
+        status = status + "\n" + message
+        if created > 0:
+            mq.reload_queue()
+
+    return status
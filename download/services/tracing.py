@@ -0,0 +1,232 @@
+"""
+download.tracing
+~~~~~~~~~~~~~~~~
+
+Database query tracing for Fairdata Download Service.
+
+If DATABASE_QUERY_TRACING is defined, database connections are wrapped so that the duration, row count and caller
+of every statement are recorded. The durations are aggregated into histograms per query, named after the function
+which executed the statement, and exported by the metrics endpoint. Statements taking at least
+DATABASE_SLOW_QUERY_THRESHOLD seconds are written with their query plan to the slow query log DATABASE_SLOW_QUERY_LOG,
+or to the application log if no slow query log is defined.
+
+The histograms are kept in memory, and so are per process.
+"""
+import sys
+import time
+import threading
+from datetime import datetime
+from flask import current_app
+from .backends import get_backend
+
+# Upper bounds in seconds of the buckets of the query duration histograms
+QUERY_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Modules whose functions are never reported as the callers of statements
+TRACING_MODULES = (__name__, 'download.services.backends')
+
+# Query duration histograms, keyed by query name
+histograms = {}
+histograms_lock = threading.Lock()
+
+
+def tracing_enabled(app):
+    """Returns whether database query tracing is enabled for the specified application."""
+    return bool(app.config.get('DATABASE_QUERY_TRACING', False))
+
+
+def get_caller():
+    """Returns the name of the function which executed the statement being traced."""
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_globals.get('__name__') in TRACING_MODULES or frame.f_code.co_name.startswith('<')):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else 'unknown'
+
+
+def record_query(name, duration, rows):
+    """
+    Records the duration and row count of a statement in the histogram of the specified query.
+
+    :param name: Name of the query
+    :param duration: Duration of the statement in seconds
+    :param rows: Number of rows returned or modified by the statement
+    """
+    with histograms_lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = {'buckets': [0] * len(QUERY_DURATION_BUCKETS), 'sum': 0.0, 'count': 0, 'rows': 0}
+        for i, bound in enumerate(QUERY_DURATION_BUCKETS):
+            if duration <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += duration
+        histogram['count'] += 1
+        histogram['rows'] += max(rows, 0)
+
+
+def log_slow_query(db_conn, name, sql, parameters, duration, rows):
+    """
+    Writes a statement which took at least DATABASE_SLOW_QUERY_THRESHOLD seconds to the slow query log, with its
+    query plan. Parameter values are not logged, as they may include authentication tokens, and so are redacted from
+    query plans which include them, as those of PostgreSQL do.
+    """
+    try:
+        plan = get_backend().explain(db_conn, sql, parameters)
+    except Exception as error:
+        plan = ['Query plan not available: %s' % error]
+
+    for parameter in parameters or ():
+        if isinstance(parameter, str):
+            literal = "'%s'" % parameter.replace("'", "''")
+            plan = [line.replace(literal, '?') for line in plan]
+
+    entry = "%s Slow query %s took %.3f seconds for %d rows\n    %s\n    %s\n" % (
+        datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        name,
+        duration,
+        rows,
+        ' '.join(sql.split()),
+        '\n    '.join(plan))
+
+    slow_query_log = current_app.config.get('DATABASE_SLOW_QUERY_LOG')
+
+    if slow_query_log:
+        with open(slow_query_log, 'a') as log_file:
+            log_file.write(entry)
+    else:
+        current_app.logger.warning(entry.rstrip())
+
+
+def trace_query(db_conn, name, sql, parameters, duration, rows):
+    """Records a completed statement, and logs it if it was slow."""
+    record_query(name, duration, rows)
+
+    if duration >= float(current_app.config.get('DATABASE_SLOW_QUERY_THRESHOLD', 1)):
+        log_slow_query(db_conn, name, sql, parameters, duration, rows)
+
+
+def format_metrics():
+    """Returns the query duration histograms in the Prometheus text exposition format."""
+    lines = [
+        '# HELP download_db_query_duration_seconds Duration of database statements by query',
+        '# TYPE download_db_query_duration_seconds histogram'
+    ]
+
+    with histograms_lock:
+        snapshot = {name: dict(histogram, buckets=list(histogram['buckets'])) for name, histogram in histograms.items()}
+
+    for name in sorted(snapshot):
+        histogram = snapshot[name]
+        cumulative = 0
+        for bound, count in zip(QUERY_DURATION_BUCKETS, histogram['buckets']):
+            cumulative += count
+            lines.append('download_db_query_duration_seconds_bucket{query="%s",le="%s"} %d' % (name, bound, cumulative))
+        lines.append('download_db_query_duration_seconds_bucket{query="%s",le="+Inf"} %d' % (name, histogram['count']))
+        lines.append('download_db_query_duration_seconds_sum{query="%s"} %f' % (name, histogram['sum']))
+        lines.append('download_db_query_duration_seconds_count{query="%s"} %d' % (name, histogram['count']))
+
+    lines.append('# HELP download_db_query_rows_total Rows returned or modified by database statements by query')
+    lines.append('# TYPE download_db_query_rows_total counter')
+
+    for name in sorted(snapshot):
+        lines.append('download_db_query_rows_total{query="%s"} %d' % (name, snapshot[name]['rows']))
+
+    return '\n'.join(lines) + '\n'
+
+
+class TracedCursor:
+    """
+    Cursor of a traced connection. Statements returning no rows are recorded once executed, and statements
+    returning rows once their rows have been fetched, including the time spent fetching the rows.
+    """
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+        self.pending = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        caller = get_caller()
+        start = time.monotonic()
+        self.cursor.execute(sql, parameters)
+        self.started(caller, sql, parameters, time.monotonic() - start)
+        return self
+
+    def executemany(self, sql, parameters):
+        self.finish()
+        caller = get_caller()
+        start = time.monotonic()
+        self.cursor.executemany(sql, parameters)
+        trace_query(self.connection, caller, sql, None, time.monotonic() - start,
+                    self.cursor.rowcount)
+        return self
+
+    def started(self, caller, sql, parameters, duration):
+        # The results of server-side cursors are described only once their first rows are fetched
+        if self.cursor.description is None and getattr(self.cursor, 'name', None) is None:
+            trace_query(self.connection, caller, sql, parameters, duration, self.cursor.rowcount)
+        else:
+            self.pending = [caller, sql, parameters, duration, 0]
+
+    def fetched(self, duration, rows):
+        if self.pending is not None:
+            self.pending[3] += duration
+            self.pending[4] += rows
+
+    def finish(self):
+        if self.pending is not None:
+            caller, sql, parameters, duration, rows = self.pending
+            self.pending = None
+            trace_query(self.connection, caller, sql, parameters, duration, rows)
+
+    def fetchone(self):
+        start = time.monotonic()
+        row = self.cursor.fetchone()
+        self.fetched(time.monotonic() - start, 0 if row is None else 1)
+        self.finish()
+        return row
+
+    def fetchall(self):
+        start = time.monotonic()
+        rows = self.cursor.fetchall()
+        self.fetched(time.monotonic() - start, len(rows))
+        self.finish()
+        return rows
+
+    def __iter__(self):
+        iterator = iter(self.cursor)
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    self.fetched(time.monotonic() - start, 0)
+                    return
+                self.fetched(time.monotonic() - start, 1)
+                yield row
+        finally:
+            self.finish()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class TracedConnection:
+    """Database connection recording the duration, row count and caller of every statement executed."""
+
+    def __init__(self, connection):
+        self.wrapped = connection
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self.wrapped, self.wrapped.cursor(*args, **kwargs))
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
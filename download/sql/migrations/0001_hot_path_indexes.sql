@@ -0,0 +1,9 @@
+CREATE INDEX IF NOT EXISTS generate_task_dataset_id ON generate_task (dataset_id, initiated);
+CREATE INDEX IF NOT EXISTS generate_task_status ON generate_task (status);
+CREATE INDEX IF NOT EXISTS package_generated_by ON package (generated_by);
+CREATE INDEX IF NOT EXISTS download_filename ON download (filename, status);
+CREATE INDEX IF NOT EXISTS download_status ON download (status);
+CREATE INDEX IF NOT EXISTS generate_scope_task_id ON generate_scope (task_id);
+CREATE INDEX IF NOT EXISTS generate_request_task_id ON generate_request (task_id);
+CREATE INDEX IF NOT EXISTS generate_request_scope_request_id ON generate_request_scope (request_id);
+CREATE INDEX IF NOT EXISTS subscription_task_id ON subscription (task_id);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS dataset_modified (
+  dataset_id VARCHAR(155) NOT NULL PRIMARY KEY,
+  modified VARCHAR(20) NOT NULL,
+  checked INTEGER NOT NULL,
+  pushed INTEGER
+);
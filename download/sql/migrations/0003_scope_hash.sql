@@ -0,0 +1,2 @@
+ALTER TABLE generate_task ADD COLUMN scope_hash VARCHAR(64);
+CREATE INDEX IF NOT EXISTS generate_task_scope_hash ON generate_task (dataset_id, scope_hash);
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS generate_scope_compact (
+  task_id VARCHAR(155) NOT NULL PRIMARY KEY,
+  file_count INTEGER NOT NULL,
+  scope BLOB NOT NULL
+);
@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS used_token (
+  token_hash VARCHAR(64) NOT NULL PRIMARY KEY,
+  expires INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS used_token_expires ON used_token (expires);
+
+CREATE TABLE IF NOT EXISTS download_archive (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  archived DATETIME DEFAULT (datetime('now')),
+  first_id INTEGER NOT NULL,
+  last_id INTEGER NOT NULL,
+  row_count INTEGER NOT NULL,
+  records BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS download_finished ON download (finished);
@@ -0,0 +1,19 @@
+ALTER TABLE package ADD COLUMN generated INTEGER;
+
+UPDATE package SET generated = (
+  SELECT CAST(strftime('%s', t.date_done) AS INTEGER) FROM generate_task t WHERE t.task_id = package.generated_by
+);
+
+CREATE TABLE IF NOT EXISTS package_stats_epoch (
+  filename VARCHAR NOT NULL PRIMARY KEY,
+  no_downloads INTEGER NOT NULL DEFAULT 0,
+  last_downloaded INTEGER,
+  bytes_served INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO package_stats_epoch (filename, no_downloads, last_downloaded, bytes_served)
+SELECT filename, no_downloads, CAST(strftime('%s', last_downloaded) AS INTEGER), bytes_served FROM package_stats;
+
+DROP TABLE package_stats;
+
+ALTER TABLE package_stats_epoch RENAME TO package_stats;
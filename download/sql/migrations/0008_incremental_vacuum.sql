@@ -0,0 +1,4 @@
+-- Converting an existing database to incremental vacuuming rewrites the whole database while holding an exclusive
+-- lock on it, so it is no longer done by this migration but by the operator, with 'flask db maintain --convert-vacuum'
+-- (cli/db-cli maintain --convert-vacuum) during a service break. New databases use incremental vacuuming from the
+-- start, as set when connecting to the database.
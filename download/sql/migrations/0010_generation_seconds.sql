@@ -0,0 +1 @@
+ALTER TABLE package ADD COLUMN generation_seconds REAL;
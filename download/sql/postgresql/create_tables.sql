@@ -0,0 +1,99 @@
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER NOT NULL PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS package (
+  id SERIAL PRIMARY KEY,
+  filename VARCHAR UNIQUE,
+  size_bytes BIGINT,
+  checksum VARCHAR,
+  generated_by VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS download (
+  id SERIAL PRIMARY KEY,
+  token VARCHAR UNIQUE NOT NULL,
+  filename VARCHAR NOT NULL,
+  status VARCHAR DEFAULT ('ACTIVE'),
+  started TIMESTAMP DEFAULT (now() AT TIME ZONE 'UTC'),
+  finished TIMESTAMP
+);
+
+CREATE SEQUENCE IF NOT EXISTS task_id_sequence;
+
+CREATE TABLE IF NOT EXISTS generate_task (
+  id INTEGER NOT NULL PRIMARY KEY DEFAULT nextval('task_id_sequence'),
+  task_id VARCHAR(155),
+  dataset_id VARCHAR(155),
+  is_partial SMALLINT NOT NULL,
+  status VARCHAR(50),
+  initiated TIMESTAMP DEFAULT (now() AT TIME ZONE 'UTC'),
+  date_done TIMESTAMP,
+  result BYTEA,
+  traceback TEXT,
+  retries INTEGER,
+  scope_hash VARCHAR(64),
+  UNIQUE (task_id)
+);
+
+CREATE TABLE IF NOT EXISTS generate_scope (
+  id SERIAL PRIMARY KEY,
+  task_id VARCHAR(155) NOT NULL,
+  filepath VARCHAR(512) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS generate_scope_compact (
+  task_id VARCHAR(155) NOT NULL PRIMARY KEY,
+  file_count INTEGER NOT NULL,
+  scope BYTEA NOT NULL
+);
+
+CREATE SEQUENCE IF NOT EXISTS taskset_id_sequence;
+
+CREATE TABLE IF NOT EXISTS generate_taskgroup (
+  id INTEGER NOT NULL PRIMARY KEY DEFAULT nextval('taskset_id_sequence'),
+  taskset_id VARCHAR(155),
+  result BYTEA,
+  date_done TIMESTAMP,
+  UNIQUE (taskset_id)
+);
+
+CREATE TABLE IF NOT EXISTS generate_request (
+  id SERIAL PRIMARY KEY,
+  task_id VARCHAR(155) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS generate_request_scope (
+  id SERIAL PRIMARY KEY,
+  request_id INTEGER NOT NULL,
+  prefix VARCHAR(512) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS subscription (
+  id SERIAL PRIMARY KEY,
+  task_id VARCHAR(155),
+  notify_url VARCHAR,
+  subscription_data TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dataset_modified (
+  dataset_id VARCHAR(155) NOT NULL PRIMARY KEY,
+  modified VARCHAR(20) NOT NULL,
+  checked BIGINT NOT NULL,
+  pushed BIGINT
+);
+
+CREATE INDEX IF NOT EXISTS generate_task_dataset_id ON generate_task (dataset_id, initiated);
+CREATE INDEX IF NOT EXISTS generate_task_status ON generate_task (status);
+CREATE INDEX IF NOT EXISTS generate_task_scope_hash ON generate_task (dataset_id, scope_hash);
+CREATE INDEX IF NOT EXISTS package_generated_by ON package (generated_by);
+CREATE INDEX IF NOT EXISTS download_filename ON download (filename, status);
+CREATE INDEX IF NOT EXISTS download_status ON download (status);
+CREATE INDEX IF NOT EXISTS generate_scope_task_id ON generate_scope (task_id);
+CREATE INDEX IF NOT EXISTS generate_request_task_id ON generate_request (task_id);
+CREATE INDEX IF NOT EXISTS generate_request_scope_request_id ON generate_request_scope (request_id);
+CREATE INDEX IF NOT EXISTS subscription_task_id ON subscription (task_id);
+
+-- The schema created above includes all migrations up to and including version 4, which are shared with SQLite;
+-- later migrations are in the migrations directory
+INSERT INTO schema_version (version) VALUES (4) ON CONFLICT DO NOTHING;
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS package_stats (
+  filename VARCHAR NOT NULL PRIMARY KEY,
+  no_downloads INTEGER NOT NULL DEFAULT 0,
+  last_downloaded TIMESTAMP,
+  bytes_served BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO package_stats (filename, no_downloads, last_downloaded, bytes_served)
+SELECT p.filename, count(d.finished), max(d.finished), count(d.finished) * coalesce(p.size_bytes, 0)
+FROM package p
+JOIN download d ON p.filename = d.filename AND d.status = 'SUCCESSFUL'
+GROUP BY p.filename, p.size_bytes
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,7 @@
+ALTER TABLE package ADD COLUMN IF NOT EXISTS generated BIGINT;
+
+UPDATE package p SET generated = CAST(extract(epoch FROM t.date_done) AS BIGINT)
+FROM generate_task t WHERE t.task_id = p.generated_by;
+
+ALTER TABLE package_stats ALTER COLUMN last_downloaded TYPE BIGINT
+USING CAST(extract(epoch FROM last_downloaded) AS BIGINT);
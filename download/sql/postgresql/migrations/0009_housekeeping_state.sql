@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS housekeeping_state (
+  name VARCHAR NOT NULL PRIMARY KEY,
+  value VARCHAR,
+  updated BIGINT
+);
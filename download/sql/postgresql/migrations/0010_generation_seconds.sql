@@ -0,0 +1 @@
+ALTER TABLE package ADD COLUMN IF NOT EXISTS generation_seconds DOUBLE PRECISION;
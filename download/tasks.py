@@ -7,8 +7,10 @@
 import os
 import time
 from celery import Celery, Task
+from celery.signals import task_prerun, task_success, task_failure, task_retry
 from flask import current_app
 from . import create_flask_app
+from .services.db import update_task_status, update_task_done, update_task_retry
 from .services.generator import generate
 from .utils import ida_service_is_offline, normalize_logging
 
@@ -47,17 +49,17 @@ def create_celery_app(app=None):
         app.config['MQ_PASS'],
         app.config['MQ_HOST'],
         app.config['MQ_VHOST'])
-    celery_broker_backend = 'db+sqlite:///%s' % app.config['DATABASE_FILE']
+
+    # Task lifecycle is recorded in the service database by the signal handlers below, so no result backend
+    # is used unless a separate store is configured
+    celery_result_backend = app.config.get('CELERY_RESULT_BACKEND') or None
 
     celery = Celery('generator',
                     broker=celery_broker_url,
-                    backend=celery_broker_backend)
+                    backend=celery_result_backend)
 
-    celery.conf.database_table_names = {
-        'task': 'generate_task',
-        'group': 'generate_taskgroup'
-    }
     celery.Task = ContextTask
+    celery.flask_app = app
 
     return celery
 
@@ -72,3 +74,31 @@ def generate_task(self, dataset, project_identifier, scope):
     if ida_service_is_offline(current_app):
         raise self.retry(countdown=int(current_app.config.get('TASK_RETRY_DELAY', 60)), max_retries=None)
     return generate(dataset, project_identifier, scope, self.request.id)
+
+
+@task_prerun.connect(sender=generate_task)
+def record_task_started(task_id=None, **kwargs):
+    """Records the task as started when a worker begins executing it."""
+    with celery_app.flask_app.app_context():
+        update_task_status(task_id, 'STARTED')
+
+
+@task_retry.connect(sender=generate_task)
+def record_task_retry(request=None, **kwargs):
+    """Records the task as waiting to be retried."""
+    with celery_app.flask_app.app_context():
+        update_task_retry(request.id)
+
+
+@task_success.connect(sender=generate_task)
+def record_task_success(sender=None, **kwargs):
+    """Records the task as successfully completed."""
+    with celery_app.flask_app.app_context():
+        update_task_done(sender.request.id, 'SUCCESS')
+
+
+@task_failure.connect(sender=generate_task)
+def record_task_failure(task_id=None, einfo=None, **kwargs):
+    """Records the task as failed, with the traceback of the exception raised by the task."""
+    with celery_app.flask_app.app_context():
+        update_task_done(task_id, 'FAILURE', str(einfo) if einfo else None)
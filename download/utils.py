@@ -5,6 +5,7 @@
     Utility module for Fairdata Download Service.
 """
 import os
+import re
 import time
 import logging
 import requests
@@ -20,6 +21,10 @@ time.tzset()
 LOG_ENTRY_FORMAT = '%(asctime)s (%(process)d) %(levelname)s %(message)s'
 TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
+# Timestamps in UTC, either normalized or as recorded in the database, which are converted without the
+# considerably slower general timestamp parser
+UTC_TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(\.\d+)?Z?$')
+
 
 class BearerAuth(requests.auth.AuthBase):
     def __init__(self, token):
@@ -57,7 +62,13 @@ def normalize_timestamp(timestamp):
 
     # Sniff the input timestamp value and convert to a UTC datetime instance as needed
     if isinstance(timestamp, str):
-        timestamp = datetime.utcfromtimestamp(dateutil.parser.parse(timestamp).timestamp())
+        # Naive timestamps, as recorded in the database, are in UTC
+        if UTC_TIMESTAMP_PATTERN.match(timestamp):
+            timestamp = datetime(
+                int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]))
+        else:
+            timestamp = datetime.utcfromtimestamp(dateutil.parser.parse(timestamp).timestamp())
     elif isinstance(timestamp, float) or isinstance(timestamp, int):
         timestamp = datetime.utcfromtimestamp(timestamp)
     elif not isinstance(timestamp, datetime):
@@ -1,4 +1,5 @@
 import os
+import gzip
 import sqlite3
 import json
 import sys
@@ -51,19 +52,40 @@ def close_db(e=None):
 
 def get_download_records(limit = None):
     """
-    Returns rows from download table, up to the optionally specified limit, 
+    Returns download records from both the download table and the download_archive table, if any, as dicts with
+    the claims of their authentication tokens, most recently started first, up to the optionally specified limit.
+    Archived records retain the claims of their tokens, as the tokens themselves are not archived.
 
-    :param token: JWT encoded authentication token for which download row is fetched
+    :param limit: Maximum number of download records returned
     """
     db_conn = get_db()
     db_cursor = db_conn.cursor()
 
-    query = "SELECT * FROM download ORDER BY started DESC"
+    records = []
+
+    for row in db_cursor.execute("SELECT * FROM download").fetchall():
+        records.append({
+            "filename": row["filename"],
+            "status": row["status"],
+            "started": normalize_timestamp(row["started"]),
+            "finished": normalize_timestamp(row["finished"]),
+            "claims": decode_token(row["token"])
+        })
+
+    if db_cursor.execute("SELECT count(*) FROM sqlite_master WHERE name = 'download_archive'").fetchone()[0] > 0:
+        for row in db_cursor.execute("SELECT records FROM download_archive ORDER BY first_id").fetchall():
+            for line in gzip.decompress(bytes(row["records"])).decode("utf-8").split("\n"):
+                record = json.loads(line)
+                # Tokens which could not be decoded when archived are not valid, and so were never used for downloads
+                if record["claims"]:
+                    records.append(record)
+
+    records.sort(key=lambda record: record["started"] or "", reverse=True)
 
     if limit:
-        query = "%s LIMIT %s" % (query, str(limit))
+        records = records[:limit]
 
-    return db_cursor.execute(query).fetchall()
+    return records
 
 
 def normalize_timestamp(timestamp):
@@ -139,7 +161,7 @@ events = []
 
 for record in download_records:
     event = {}
-    token = decode_token(record["token"])
+    token = record["claims"]
     dataset = token["dataset"]
     event["dataset"] = dataset
     file = token.get("file")
@@ -164,8 +186,8 @@ for record in download_records:
         event["status"] = "SUCCESS"
     else:
         event["status"] = "FAILURE"
-    event["started"] = normalize_timestamp(record["started"])
-    event["finished"] = normalize_timestamp(record["finished"])
+    event["started"] = record["started"]
+    event["finished"] = record["finished"]
     events.append(event)
 
 print(json.dumps(events))
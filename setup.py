@@ -9,5 +9,8 @@ setup(
     install_requires=[
         'flask',
     ],
+    extras_require={
+        'postgresql': ['psycopg2-binary'],
+    },
 )
 
@@ -244,7 +244,7 @@ class TestHousekeeping(unittest.TestCase):
 
         print("Old package: %s" % old_package)
 
-        print("Request generation of new complete dataset package (triggers housekeeping, removing old package)")
+        print("Request generation of new complete dataset package")
         data = { "dataset": dataset_id_1 }
         response = requests.post("https://%s:4431/requests" % self.hostname, json=data, auth=self.token_auth)
         self.assertEqual(response.status_code, 200, "%s %s" % (response.status_code, response.content.decode(sys.stdout.encoding)[:1000]))
@@ -267,6 +267,10 @@ class TestHousekeeping(unittest.TestCase):
         result = os.system(cmd)
         self.assertEqual(result, 0)
 
+        print("Run housekeeping to purge outdated package")
+        response = requests.post("https://%s:4431/housekeep" % self.hostname, auth=self.token_auth)
+        self.assertEqual(response.status_code, 200, "%s %s" % (response.status_code, response.content.decode(sys.stdout.encoding)[:1000]))
+
         print("Verify outdated complete dataset package no longer exists in cache (removed by housekeeping)")
         cmd = "%s/utils/package-stats %s 2>/dev/null >/dev/null" % (os.environ["ROOT"], old_package)
         result = os.system(cmd)
@@ -1,6 +1,11 @@
 import os
 import time
 import pytest
+from datetime import datetime, timedelta
+from download.services.db import create_download_record, finalize_download_record, get_task_rows_for_status, \
+                                 get_db, create_task_rows, create_request_scope, archive_download_records, \
+                                 iter_archived_download_records, extract_download_event
+from testutils.misc import record_statements
 
 os.environ["TZ"] = "UTC"
 time.tzset()
@@ -103,6 +108,27 @@ class TestGetRequest:
         assert response.status_code == 200
 
 
+    def test_many_partial_requests(self, flask_app, authorized_client, mock_metax, success_task):
+        """Packages and request scopes of all tasks should be loaded with a constant number of queries."""
+        with flask_app.app_context():
+            for i in range(300):
+                task_id = '2009999 partial-%d' % i
+                create_task_rows(success_task['dataset_id'], task_id, 1, ['/test/dir_%d/file.txt' % i])
+                create_request_scope(task_id, ['/test/dir_%d' % i])
+            db_conn = get_db()
+
+        query_string = {
+            'dataset': success_task['dataset_id']
+        }
+        with record_statements(db_conn) as statements:
+            response = authorized_client.get(self.endpoint, query_string=query_string)
+
+        assert response.status_code == 200
+        assert response.json['package'] == success_task['package']
+        assert len(response.json['partial']) == 300
+        assert len(statements) < 10
+
+
     def test_dataset_has_to_be_specified_in_query(self, authorized_client, mock_metax, not_found_task):
         query_string = {}
         response = authorized_client.get(self.endpoint, query_string=query_string)
@@ -317,6 +343,23 @@ class TestPostRequest:
         assert 'Internal Server Error' in str(response.data)
 
 
+    def test_existing_task_matched_by_scope_hash(self, authorized_client, monkeypatch, mock_metax, not_found_task):
+        json = {
+            'dataset': not_found_task['dataset_id'],
+            'testing': True
+        }
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.get_json()['created'] is True
+
+        def fail_get_generate_scope_filepaths(task_id):
+            raise AssertionError("Task scope loaded for task with recorded scope hash")
+        monkeypatch.setattr('download.services.db.get_generate_scope_filepaths', fail_get_generate_scope_filepaths)
+
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.status_code == 200
+        assert response.get_json()['created'] is False
+
+
     def test_non_matching_scope(self, authorized_client, mock_metax):
         json = {
             'dataset': '1',
@@ -553,6 +596,34 @@ class TestGetDownload:
         assert response.status_code == 401
 
 
+    def test_used_token_archived(self, flask_app, client, recorder, success_task, valid_auth_token):
+        query_string = {
+            'token': valid_auth_token
+        }
+        response = client.get(self.endpoint, query_string=query_string)
+        assert response.status_code == 200
+        response.get_data()
+        response.close()
+
+        with flask_app.app_context():
+            assert archive_download_records(-1) == (1, 0)
+            assert get_db().execute('SELECT count(*) FROM download').fetchone()[0] == 0
+            records = list(iter_archived_download_records())
+
+        assert len(records) == 1
+        assert records[0]['status'] == 'SUCCESSFUL'
+        assert 'token' not in records[0]
+
+        with flask_app.app_context():
+            event = extract_download_event(records[0], records[0]['claims'])
+        assert event['dataset'] == success_task['dataset_id']
+        assert event['status'] == 'SUCCESS'
+
+        # The token remains single-use once its download record has been archived
+        response = client.get(self.endpoint, query_string=query_string)
+        assert response.status_code == 401
+
+
     def test_cannot_connect_to_metax(self, client, metax_cannot_connect, success_task, valid_auth_token):
         response = client.get(self.endpoint)
         query_string = {
@@ -638,3 +709,88 @@ class TestGetDownload:
         }
         response = client.get(self.endpoint, query_string=query_string)
         assert response.status_code == 401
+
+
+class TestPostInvalidate:
+
+    endpoint = '/invalidate'
+
+
+    def test_invalid_authorization_token(self, client, success_task):
+        client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer invalid_token'
+        response = client.post(self.endpoint, json={'dataset': success_task['dataset_id']})
+        assert response.status_code == 401
+
+
+    def test_invalid_modified_timestamp(self, authorized_client, success_task):
+        json = {
+            'dataset': success_task['dataset_id'],
+            'modified': 'invalid'
+        }
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.status_code == 400
+
+
+    def test_outdated_package_removed(self, authorized_client, flask_app, recorder, mock_metax, success_task):
+        json = {
+            'dataset': success_task['dataset_id'],
+            'modified': '2021-01-01T00:00:00Z'
+        }
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.status_code == 200
+        assert success_task['package'] in response.get_data(as_text=True)
+        assert not os.path.exists(os.path.join(flask_app.config['DOWNLOAD_CACHE_DIR'], 'datasets', success_task['package']))
+
+        # The pushed modification timestamp is trusted without requesting it from Metax
+        response = authorized_client.get('/requests', query_string={'dataset': success_task['dataset_id']})
+        assert response.status_code == 404
+        assert recorder.called is False
+
+
+    def test_package_not_outdated(self, authorized_client, flask_app, success_task):
+        json = {
+            'dataset': success_task['dataset_id'],
+            'modified': '2020-01-01T00:00:00Z'
+        }
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.status_code == 200
+        assert 'No outdated packages found' in response.get_data(as_text=True)
+        assert os.path.exists(os.path.join(flask_app.config['DOWNLOAD_CACHE_DIR'], 'datasets', success_task['package']))
+
+
+    def test_new_task_outdated(self, authorized_client, flask_app, mock_metax, not_found_task):
+        response = authorized_client.post('/requests', json={'dataset': not_found_task['dataset_id'], 'testing': True})
+        assert response.status_code == 200
+
+        json = {
+            'dataset': not_found_task['dataset_id'],
+            'modified': (datetime.utcnow() + timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        }
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.status_code == 200
+        assert 'Outdated tasks: 1' in response.get_data(as_text=True)
+
+        with flask_app.app_context():
+            assert len(get_task_rows_for_status('NEW')) == 0
+            assert len(get_task_rows_for_status('OUTDATED')) == 1
+
+
+    @pytest.mark.usefixtures("mock_celery")
+    def test_popular_package_regenerated(self, authorized_client, flask_app, recorder, mock_metax, success_task):
+        with flask_app.app_context():
+            finalize_download_record(create_download_record('token', success_task['package']))
+
+        json = {
+            'dataset': success_task['dataset_id'],
+            'modified': '2021-01-01T00:00:00Z',
+            'regenerate': True
+        }
+        response = authorized_client.post(self.endpoint, json=json)
+        assert response.status_code == 200
+        assert 'Regeneration tasks created: 1' in response.get_data(as_text=True)
+        assert recorder.called is True
+
+
+    def test_dataset_cannot_be_found_in_metax(self, authorized_client, metax_dataset_not_found, success_task):
+        response = authorized_client.post(self.endpoint, json={'dataset': success_task['dataset_id']})
+        assert response.status_code == 404
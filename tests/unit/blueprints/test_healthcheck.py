@@ -14,3 +14,13 @@ class TestGetHealthCheck:
     def test_not_found(self, client):
         response = client.get(self.endpoint)
         assert response.status_code == 200
+
+
+class TestGetMetrics:
+    endpoint = '/health/metrics'
+
+    def test_metrics(self, client):
+        response = client.get(self.endpoint)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert b'# TYPE download_db_query_duration_seconds histogram' in response.data
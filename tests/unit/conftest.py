@@ -9,7 +9,7 @@ from pika.spec import BasicProperties
 from requests.exceptions import ConnectionError
 from download import create_flask_app
 from download.services import mq
-from download.services.db import init_db, close_db, get_db
+from download.services.db import init_db, close_db, get_db, close_pooled_db
 from testutils.download import create_dataset
 from testutils.misc import CeleryTask, Recorder
 from testutils.metax import MetaxDatasetResponse, MetaxDatasetFilesResponse
@@ -17,6 +17,19 @@ from testutils.metax import MetaxDatasetResponse, MetaxDatasetFilesResponse
 os.environ["TZ"] = "UTC"
 time.tzset()
 
+# Database backend against which the tests are run, either 'sqlite' or 'postgresql', in which case the disposable
+# database defined by DOWNLOAD_TEST_DATABASE_URL is used, see docs/testing.md
+TEST_BACKEND = os.environ.get('DOWNLOAD_TEST_BACKEND', 'sqlite')
+
+
+def pytest_collection_modifyitems(config, items):
+    if TEST_BACKEND == 'sqlite':
+        return
+    skip_sqlite = pytest.mark.skip(reason='Test of the SQLite backend only')
+    for item in items:
+        if 'sqlite' in item.keywords:
+            item.add_marker(skip_sqlite)
+
 
 @pytest.fixture
 def ida_dir():
@@ -44,8 +57,12 @@ def db():
 
     yield db
 
+    close_pooled_db()
     os.close(db_fd)
     os.unlink(db)
+    for suffix in ['-wal', '-shm']:
+        if os.path.exists(db + suffix):
+            os.unlink(db + suffix)
 
 
 @pytest.fixture
@@ -57,6 +74,14 @@ def flask_app(cache_dir, ida_dir, db):
     flask_app.config['DATABASE_FILE'] = db
     flask_app.config['IDA_DATA_ROOT'] = ida_dir
 
+    if TEST_BACKEND == 'postgresql':
+        flask_app.config['DATABASE_URL'] = os.environ['DOWNLOAD_TEST_DATABASE_URL']
+        with flask_app.app_context():
+            db_conn = get_db()
+            db_conn.execute('DROP SCHEMA public CASCADE')
+            db_conn.execute('CREATE SCHEMA public')
+            db_conn.commit()
+
     with flask_app.app_context():
         init_db()
 
@@ -75,7 +100,7 @@ def celery_task():
 
 @pytest.fixture(autouse=True)
 def mock_requests_get(monkeypatch):
-    def skip_requesting_test(url):
+    def skip_requesting_test(url, **kwargs):
         pytest.skip("Test tried to request resource over network. This is not "
                     "acceptable and the requesting function should be mocked "
                     "instead.")
@@ -85,59 +110,60 @@ def mock_requests_get(monkeypatch):
 
 @pytest.fixture
 def mock_celery(monkeypatch, recorder, celery_task):
-    def mock_generate_task(dataset, project_identifier, scope):
+    def mock_generate_task(args=None, kwargs=None, task_id=None, **options):
         recorder.called = True
+        recorder.task_id = task_id
         return celery_task
 
     monkeypatch.setattr(
-        'download.tasks.generate_task.delay', mock_generate_task)
+        'download.tasks.generate_task.apply_async', mock_generate_task)
 
 
 @pytest.fixture
 def metax_dataset_available(monkeypatch):
-    def metax_get_available(url, auth={}, headers={}):
+    def metax_get_available(url, auth={}, headers={}, stream=False, timeout=None):
         return MetaxDatasetResponse("no-tasks", 200)
     monkeypatch.setattr('requests.get', metax_get_available)
 
 
 @pytest.fixture
 def metax_dataset_not_found(monkeypatch):
-    def metax_get_not_found(url, auth={}, headers={}):
+    def metax_get_not_found(url, auth={}, headers={}, stream=False, timeout=None):
         return MetaxDatasetResponse("not-found", 404)
     monkeypatch.setattr('requests.get', metax_get_not_found)
 
 
 @pytest.fixture
 def metax_cannot_connect(monkeypatch):
-    def metax_get_cannot_connect(url, auth={}, headers={}):
+    def metax_get_cannot_connect(url, auth={}, headers={}, stream=False, timeout=None):
         raise ConnectionError
     monkeypatch.setattr('requests.get', metax_get_cannot_connect)
 
 
 @pytest.fixture
 def metax_missing_fields(monkeypatch):
-    def metax_get_metax_missing_fields(url, auth={}, headers={}):
+    def metax_get_metax_missing_fields(url, auth={}, headers={}, stream=False, timeout=None):
         return MetaxDatasetResponse("missing-fields", 200)
     monkeypatch.setattr('requests.get', metax_get_metax_missing_fields)
 
 
 @pytest.fixture
 def metax_unexpected_status_code(monkeypatch):
-    def metax_get_unexpected_status_code(url, auth={}, headers={}):
+    def metax_get_unexpected_status_code(url, auth={}, headers={}, stream=False, timeout=None):
         return MetaxDatasetResponse("missing-fields", 521)
     monkeypatch.setattr('requests.get', metax_get_unexpected_status_code)
 
 
 @pytest.fixture
 def metax_dataset_files_available(monkeypatch):
-    def metax_get_files_available(url, auth={}, headers={}):
+    def metax_get_files_available(url, auth={}, headers={}, stream=False, timeout=None):
         return MetaxDatasetFilesResponse("no-tasks", 200)
     monkeypatch.setattr('requests.get', metax_get_files_available)
 
 
 @pytest.fixture
 def mock_metax(monkeypatch, recorder):
-    def mock_get_metax(url, auth={}, headers={}):
+    def mock_get_metax(url, auth={}, headers={}, stream=False, timeout=None):
         recorder.called = True
         if url.endswith('files') or url.endswith('files?pagination=false'):
             return MetaxDatasetFilesResponse("no-tasks", 200)
@@ -149,7 +175,7 @@ def mock_metax(monkeypatch, recorder):
 
 @pytest.fixture
 def mock_metax_modified(monkeypatch, recorder):
-    def mock_get_metax(url, auth={}, headers={}):
+    def mock_get_metax(url, auth={}, headers={}, stream=False, timeout=None):
         recorder.called = True
         if url.endswith('files'):
             return MetaxDatasetFilesResponse("success-modified", 200)
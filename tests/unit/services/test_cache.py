@@ -1,76 +1,84 @@
 import os
 import time
-import pendulum
+import types
+import pytest
+import collections
+from flask import Flask
 
 from download.dto import Package
-from download.services.cache import select_packages_to_be_removed
+from download.services.cache import select_packages_to_be_removed, validate_package_cache, get_datasets_dir, \
+                                    purge_ghost_files, remove_cache_files, empty_trash, get_trash_dir, \
+                                    identify_invalid_packages, get_eviction_policy, EVICTION_POLICIES, \
+                                    VALIDATION_POSITION, DAY, init_app
+from download.services.db import get_db, get_task, get_active_packages, get_housekeeping_state
+from testutils.misc import record_statements
 
 os.environ["TZ"] = "UTC"
 time.tzset()
 
 
 def test_select_packages():
-    today = pendulum.now()
+    today = int(time.time())
     gb = 1073741824
     packages = [
         Package(
             "ranked1",
             600,
             10,
-            generated_at=today.subtract(days=8),
-            last_downloaded=today.subtract(days=3),
+            generated_at=today - 8 * DAY,
+            last_downloaded=today - 3 * DAY,
         ),
         Package(
             "ranked2",
             600,
             20,
-            generated_at=today.subtract(days=8),
-            last_downloaded=today.subtract(days=3),
+            generated_at=today - 8 * DAY,
+            last_downloaded=today - 3 * DAY,
         ),
         Package(
             "ranked3",
             600,
             5,
-            generated_at=today.subtract(days=8),
-            last_downloaded=today.subtract(days=3),
+            generated_at=today - 8 * DAY,
+            last_downloaded=today - 3 * DAY,
         ),
         Package(
             "ranked4",
             40,
             5,
-            generated_at=today.subtract(days=8),
-            last_downloaded=today.subtract(days=3),
+            generated_at=today - 8 * DAY,
+            last_downloaded=today - 3 * DAY,
         ),
         Package(
             "ranked5",
             40,
             5,
-            generated_at=today.subtract(days=8),
-            last_downloaded=today.subtract(days=2),
+            generated_at=today - 8 * DAY,
+            last_downloaded=today - 2 * DAY,
         ),
         Package(
             "lt than gb",
             gb - 1,
             1,
-            generated_at=today.subtract(days=1),
-            last_downloaded=today.subtract(days=1),
+            generated_at=today - 1 * DAY,
+            last_downloaded=today - 1 * DAY,
         ),
         Package(
             "gt than gb",
             gb + 1,
             1,
-            generated_at=today.subtract(days=1),
-            last_downloaded=today.subtract(days=1),
+            generated_at=today - 1 * DAY,
+            last_downloaded=today - 1 * DAY,
         ),
         Package(
             "gt than 10 gb",
             gb * 10,
             1,
-            generated_at=today.subtract(days=1),
-            last_downloaded=today.subtract(days=1),
+            generated_at=today - 1 * DAY,
+            last_downloaded=today - 1 * DAY,
         ),
-        Package("expired1", 20, 0, generated_at=today.subtract(days=8)),
-        Package("expired2", 20, 0, generated_at=today.subtract(days=31)),
+        Package("expired1", 20, 0, generated_at=today - 8 * DAY),
+        Package("expired2", 20, 0, generated_at=today - 31 * DAY),
     ]
     rem, exp, ranked = select_packages_to_be_removed(300, packages)
 
@@ -85,3 +93,218 @@ def test_select_packages():
     )  # less than 10 GB should have higher rank than over 10 GB
     assert len(rem) == 3
     assert len(exp) == 2
+
+
+def test_incremental_validation(flask_app, success_task, monkeypatch):
+    monkeypatch.setattr('download.services.cache.VALIDATION_BATCH_SIZE', 2)
+    monkeypatch.setattr(
+        'download.services.metax.get_datasets_modified',
+        lambda dataset_ids: dict((dataset_id, '2000-01-01T00:00:00Z') for dataset_id in dataset_ids))
+
+    with flask_app.app_context():
+        db_conn = get_db()
+        task_id = get_task(success_task['package'])['task_id']
+        for i in range(4):
+            filename = '%s_extra%d.zip' % (success_task['dataset_id'], i)
+            with open(os.path.join(get_datasets_dir(), filename), 'w') as package_file:
+                package_file.write('package')
+            db_conn.execute(
+                'INSERT INTO package (filename, checksum, size_bytes, generated_by, generated) VALUES (?, ?, ?, ?, ?)',
+                (filename, 'sha256:test', 7, task_id, int(time.time())))
+        # The package file of the last package is missing, so the package is invalid
+        os.remove(os.path.join(get_datasets_dir(), filename))
+        db_conn.commit()
+
+        filenames = [package.filename for package in get_active_packages()]
+        assert len(filenames) == 5
+
+        # With the time limit reached after the first batch, validation resumes from where it stopped
+        validate_package_cache(time.monotonic())
+        assert get_housekeeping_state(VALIDATION_POSITION) == sorted(filenames)[1]
+        validate_package_cache(time.monotonic())
+        assert get_housekeeping_state(VALIDATION_POSITION) == sorted(filenames)[3]
+        assert filename in [package.filename for package in get_active_packages()]
+        validate_package_cache(time.monotonic())
+        assert get_housekeeping_state(VALIDATION_POSITION) is None
+        assert filename not in [package.filename for package in get_active_packages()]
+        assert len(get_active_packages()) == 4
+
+
+def test_purge_ghost_files(flask_app, success_task):
+    with flask_app.app_context():
+        datasets_dir = get_datasets_dir()
+        old = time.time() - 2 * 3600
+        for name in ['ghost.zip', 'failed.zip.part', 'new.zip', 'writing.zip.part']:
+            with open(os.path.join(datasets_dir, name), 'w') as ghost_file:
+                ghost_file.write('ghost')
+            if name in ['ghost.zip', 'failed.zip.part']:
+                os.utime(os.path.join(datasets_dir, name), (old, old))
+        os.mkdir(os.path.join(datasets_dir, 'subdirectory'))
+
+        status = purge_ghost_files()
+
+        assert 'Removed 2 ghost files' in status
+        assert sorted(os.listdir(datasets_dir)) == sorted([success_task['package'], 'new.zip', 'writing.zip.part', 'subdirectory'])
+
+
+@pytest.mark.parametrize("trash", [False, True])
+def test_remove_cache_files(flask_app, success_task, monkeypatch, trash):
+    monkeypatch.setitem(flask_app.config, 'CACHE_TRASH', trash)
+
+    with flask_app.app_context():
+        packages = get_active_packages()
+        missing = Package('missing.zip', 1, 0, generated_at=int(time.time()))
+
+        assert remove_cache_files(packages + [missing]) == [success_task['package'], 'missing.zip']
+
+        assert get_active_packages() == []
+        assert not os.path.exists(os.path.join(get_datasets_dir(), success_task['package']))
+
+        if trash:
+            empty_trash(get_trash_dir())
+            assert os.listdir(get_trash_dir()) == []
+
+
+def record_file_system_calls(monkeypatch, file_system_calls):
+    """Counts the directory listings and the file status lookups made by the cache module, without affecting the
+    file system calls made by any other module."""
+    def recording(name, function):
+        def record(*args, **kwargs):
+            file_system_calls[name] += 1
+            return function(*args, **kwargs)
+        return record
+
+    path = types.SimpleNamespace(**vars(os.path))
+    for name in ['exists', 'getsize', 'getmtime']:
+        setattr(path, name, recording('path.' + name, getattr(os.path, name)))
+    recording_os = types.SimpleNamespace(**vars(os))
+    recording_os.path = path
+    for name in ['scandir', 'listdir', 'stat']:
+        setattr(recording_os, name, recording(name, getattr(os, name)))
+    monkeypatch.setattr('download.services.cache.os', recording_os)
+
+
+def test_identify_invalid_packages_performance(flask_app, success_task, monkeypatch):
+    lookups = []
+
+    def get_datasets_modified(dataset_ids):
+        lookups.append(list(dataset_ids))
+        return dict((dataset_id, '2000-01-01T00:00:00Z') for dataset_id in lookups[-1])
+
+    monkeypatch.setattr('download.services.metax.get_datasets_modified', get_datasets_modified)
+
+    file_system_calls = collections.Counter()
+    record_file_system_calls(monkeypatch, file_system_calls)
+
+    def identify(package_count):
+        """Identifies the invalid packages among package_count new packages, of which the last one is missing its
+        package file, returning the invalid packages, the file system calls and the database statements made."""
+        task_id = get_task(success_task['package'])['task_id']
+        filenames = ['%s_%d_package%d.zip' % (success_task['dataset_id'], package_count, i)
+                     for i in range(package_count)]
+        for filename in filenames[:-1]:
+            with open(os.path.join(get_datasets_dir(), filename), 'w') as package_file:
+                package_file.write('package')
+        db_conn = get_db()
+        db_conn.executemany(
+            'INSERT INTO package (filename, checksum, size_bytes, generated_by, generated) VALUES (?, ?, ?, ?, ?)',
+            ((filename, 'sha256:test', 7, task_id, int(time.time())) for filename in filenames))
+        db_conn.commit()
+        active_packages = [package for package in get_active_packages() if package.filename in filenames]
+
+        lookups.clear()
+        file_system_calls.clear()
+        with record_statements(db_conn) as statements:
+            invalid_packages = identify_invalid_packages(active_packages)
+
+        assert [package.filename for package in invalid_packages] == [filenames[-1]]
+        return dict(file_system_calls), statements
+
+    with flask_app.app_context():
+        few_calls, few_statements = identify(10)
+        many_calls, many_statements = identify(5000)
+
+    # A single bulk lookup of dataset modification timestamps and a single listing of the cache directory,
+    # without any database queries or file status lookups per package
+    assert lookups == [[success_task['dataset_id']]]
+    assert many_calls['scandir'] == 1
+    assert many_calls == few_calls
+    assert many_statements == few_statements == []
+
+
+def get_policy_packages(today):
+    return [
+        # Large, popular and slow to generate
+        Package("large", 1000, 10, generated_at=today - 20 * DAY, last_downloaded=today - 1 * DAY,
+                generation_seconds=100),
+        # Small, unpopular and recently used
+        Package("small", 10, 1, generated_at=today - 10 * DAY, last_downloaded=today),
+        # Medium sized, never downloaded and quick to generate
+        Package("medium", 100, 0, generated_at=today - 5 * DAY, generation_seconds=0.1),
+    ]
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("lru", ["medium", "large", "small"]),
+    ("lfu", ["medium", "small", "large"]),
+    ("gdsf", ["medium", "large", "small"]),
+    ("cost", ["medium", "small", "large"]),
+])
+def test_eviction_policies(name, expected):
+    today = int(time.time())
+    policy = EVICTION_POLICIES[name]()
+
+    # Packages are selected in the order of their removal until enough space is cleared
+    assert [package.filename for package in policy.select(1110, get_policy_packages(today), today)] == expected
+    assert [package.filename for package in policy.select(50, get_policy_packages(today), today)] == expected[:1]
+
+
+def test_heuristic_eviction_policy(flask_app):
+    today = int(time.time())
+
+    with flask_app.app_context():
+        policy = get_eviction_policy()
+    assert policy.name == "heuristic"
+
+    # The medium package has expired, being older than 7 days with no downloads
+    packages = get_policy_packages(today)
+    packages[2].generated_at = today - 8 * DAY
+    assert [package.filename for package in policy.select(50, packages, today)] == ["medium"]
+
+
+def test_get_eviction_policy(flask_app, monkeypatch):
+    monkeypatch.setitem(flask_app.config, "CACHE_EVICTION_POLICY", "GDSF")
+
+    with flask_app.app_context():
+        assert get_eviction_policy().name == "gdsf"
+        assert get_eviction_policy("cost").name == "cost"
+        with pytest.raises(ValueError):
+            get_eviction_policy("fifo")
+
+
+def test_persistent_gdsf_inflation(flask_app):
+    today = int(time.time())
+
+    with flask_app.app_context():
+        packages = get_policy_packages(today - 2 * DAY)
+        assert [package.filename for package in
+                get_eviction_policy("gdsf", persistent=True).select(50, packages, today - DAY)] == ["medium"]
+        assert get_housekeeping_state("gdsf_inflation") is not None
+
+        # A new instance of the policy, as for each cache cleanup, ages the package not accessed since the
+        # previous cleanup relative to the package accessed since, despite its higher priority without aging
+        packages = [
+            Package("old", 100, 1, generated_at=today - 3 * DAY, last_downloaded=today - 2 * DAY),
+            Package("new", 80, 0, generated_at=today, last_downloaded=today),
+        ]
+        assert [package.filename for package in
+                get_eviction_policy("gdsf", persistent=True).select(50, packages, today)] == ["old"]
+        assert [package.filename for package in get_eviction_policy("gdsf").select(50, packages, today)] == ["new"]
+
+
+def test_unknown_eviction_policy_at_start():
+    app = Flask(__name__)
+    app.config["CACHE_EVICTION_POLICY"] = "fifo"
+
+    with pytest.raises(ValueError):
+        init_app(app)
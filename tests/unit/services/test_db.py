@@ -2,16 +2,36 @@ import os
 import time
 import pytest
 import sqlite3
-from download.services.db import get_db
+import threading
+from download.services.db import get_db, close_pooled_db, create_download_record, finalize_download_record, \
+                                 get_download_record_by_token, get_active_packages, get_migrations, migrate_db, \
+                                 get_scope_hash, get_task, create_task_rows, iter_generate_scope_filepaths, \
+                                 get_generate_scope_filepaths, create_request_scope, get_request_scopes, \
+                                 delete_package_rows, get_request_scopes_for_tasks, get_packages_for_tasks, \
+                                 get_task_with_scope, maintain_db, cache_dataset_modified_timestamps, \
+                                 get_cached_dataset_modified_timestamps
+from testutils.misc import record_statements
 
 os.environ["TZ"] = "UTC"
 time.tzset()
 
 
+@pytest.mark.sqlite
 def test_close(flask_app):
     with flask_app.app_context():
         db_conn = get_db()
         assert db_conn is get_db()
+        db_conn.execute("INSERT INTO download (token, filename) VALUES ('token', 'file.zip')")
+        assert db_conn.in_transaction
+
+    # The connection is returned to the pool of the thread, with any uncommitted transaction rolled back
+    assert not db_conn.in_transaction
+
+    with flask_app.app_context():
+        assert get_db() is db_conn
+        assert db_conn.execute('SELECT count(*) FROM download').fetchone()[0] == 0
+
+    close_pooled_db()
 
     with pytest.raises(sqlite3.ProgrammingError) as programming_error:
         db_conn.execute('SELECT 1')
@@ -19,9 +39,411 @@ def test_close(flask_app):
     assert 'closed' in str(programming_error.value)
 
 
+@pytest.mark.sqlite
+def test_connection_per_thread(flask_app):
+    connections = []
+
+    def connect():
+        with flask_app.app_context():
+            connections.append(get_db())
+
+    thread = threading.Thread(target=connect)
+    thread.start()
+    thread.join()
+    connect()
+
+    assert len(connections) == 2
+    assert connections[0] is not connections[1]
+
+    with flask_app.app_context():
+        assert get_db().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert get_db().execute('PRAGMA synchronous').fetchone()[0] == 1
+
+
+def test_concurrent_access(flask_app):
+    thread_count = 8
+    operation_count = 50
+    errors = []
+
+    def access(thread_number):
+        try:
+            for i in range(operation_count):
+                with flask_app.app_context():
+                    token = 'token-%d-%d' % (thread_number, i)
+                    download_id = create_download_record(token, 'file.zip')
+                    finalize_download_record(download_id)
+                    assert get_download_record_by_token(token)['status'] == 'SUCCESSFUL'
+                    get_active_packages()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=access, args=(i,)) for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    with flask_app.app_context():
+        assert get_db().execute('SELECT count(*) FROM download').fetchone()[0] == thread_count * operation_count
+
+
 def test_init_command(runner, mock_init_db, recorder):
     result = runner.invoke(args=['db', 'init'])
 
     assert not result.exception
     assert 'Initialized' in result.output
     assert recorder.called
+
+
+@pytest.mark.sqlite
+def test_migrate(flask_app):
+    with flask_app.app_context():
+        migrations = get_migrations()
+        assert len(migrations) > 0
+        assert get_db().execute('PRAGMA user_version').fetchone()[0] == migrations[-1][0]
+        assert migrate_db() == []
+
+
+@pytest.mark.sqlite
+def test_migrate_creates_dataset_modified(flask_app, monkeypatch):
+    with flask_app.app_context():
+        migrations = get_migrations()
+        db_conn = get_db()
+
+        # A database created before the dataset modification timestamp cache existed
+        db_conn.execute('DROP TABLE dataset_modified')
+        db_conn.execute('PRAGMA user_version = 1')
+        db_conn.commit()
+        monkeypatch.setattr('download.services.db.get_migrations', lambda: migrations[:2])
+
+        assert migrate_db() == [migrations[1][1]]
+
+        cache_dataset_modified_timestamps({'1': '2020-01-01T00:00:00Z'}, 100)
+        assert get_cached_dataset_modified_timestamps(['1', '2'], 0) == {'1': '2020-01-01T00:00:00Z'}
+
+
+@pytest.mark.sqlite
+def test_concurrent_migrate(flask_app, monkeypatch):
+    with flask_app.app_context():
+        migrations = get_migrations()
+        db_conn = get_db()
+
+        # A database pending the creation of the dataset modification timestamp cache
+        db_conn.execute('DROP TABLE dataset_modified')
+        db_conn.execute('PRAGMA user_version = 1')
+        db_conn.commit()
+        monkeypatch.setattr('download.services.db.get_migrations', lambda: migrations[:2])
+
+    thread_count = 4
+    barrier = threading.Barrier(thread_count, timeout=10)
+    applied = []
+    errors = []
+
+    # All processes find the migration pending, and read it, before any of them begins to apply it
+    open_resource = flask_app.open_resource
+
+    def open_resource_together(resource, *args, **kwargs):
+        if 'migrations' in resource:
+            barrier.wait()
+        return open_resource(resource, *args, **kwargs)
+
+    monkeypatch.setattr(flask_app, 'open_resource', open_resource_together)
+
+    def migrate():
+        try:
+            with flask_app.app_context():
+                applied.extend(migrate_db())
+        except Exception as error:
+            errors.append(error)
+        finally:
+            close_pooled_db()
+
+    threads = [threading.Thread(target=migrate) for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert applied == [migrations[1][1]]
+
+
+def test_migrate_command(runner):
+    result = runner.invoke(args=['db', 'migrate'])
+
+    assert not result.exception
+    assert 'Database schema is at version' in result.output
+
+
+@pytest.mark.sqlite
+def test_maintain(flask_app):
+    with flask_app.app_context():
+        db_conn = get_db()
+        assert db_conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+        db_conn.executemany(
+            "INSERT INTO download (token, filename) VALUES (?, 'file.zip')",
+            (('token-%d-%s' % (i, 'x' * 1000),) for i in range(5000)))
+        db_conn.commit()
+        db_conn.execute('DELETE FROM download')
+        db_conn.commit()
+        assert db_conn.execute('PRAGMA freelist_count').fetchone()[0] > 0
+
+        completed = dict(maintain_db(60))
+        assert list(completed) == ['analyze', 'auto_vacuum', 'vacuum', 'checkpoint', 'check']
+        assert completed['auto_vacuum'] == 'incremental'
+        assert completed['check'] == 'ok'
+        assert db_conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+        assert db_conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()[0] == 1
+
+        # Maintenance reaching the time limit is interrupted without completing any further steps
+        assert maintain_db(0) == []
+        assert not db_conn.in_transaction
+
+
+@pytest.mark.sqlite
+def test_maintain_command(runner):
+    result = runner.invoke(args=['db', 'maintain', '--time-limit', '60'])
+
+    assert not result.exception
+    assert 'check: ok' in result.output
+
+
+@pytest.mark.sqlite
+def test_maintain_convert_vacuum(runner, flask_app, monkeypatch):
+    with flask_app.app_context():
+        migrations = get_migrations()
+        db_conn = get_db()
+        # A database created before incremental vacuuming was enabled for new databases
+        db_conn.execute('PRAGMA auto_vacuum = NONE')
+        db_conn.execute('VACUUM')
+        assert db_conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+
+        # Migrations never convert the database
+        db_conn.execute('PRAGMA user_version = 7')
+        monkeypatch.setattr('download.services.db.get_migrations', lambda: migrations[:8])
+        assert migrate_db() == ['0008_incremental_vacuum.sql']
+        assert db_conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+
+        assert dict(maintain_db(60))['auto_vacuum'] == 'none'
+
+    result = runner.invoke(args=['db', 'maintain', '--convert-vacuum'])
+
+    assert not result.exception
+    assert 'convert_vacuum: converted to incremental' in result.output
+    assert 'auto_vacuum: incremental' in result.output
+
+    with flask_app.app_context():
+        assert get_db().execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def test_archive_command(runner, flask_app):
+    with flask_app.app_context():
+        db_conn = get_db()
+        db_conn.execute("INSERT INTO used_token (token_hash, expires) VALUES ('expired', 1)")
+        db_conn.execute(
+            "INSERT INTO download (token, filename, status, started, finished) "
+            "VALUES ('token', 'file.zip', 'SUCCESSFUL', '2020-01-01 00:00:00', '2020-01-01 00:00:10')")
+        download_id = create_download_record('recent-token', 'file.zip')
+        finalize_download_record(download_id)
+
+    result = runner.invoke(args=['db', 'archive'])
+
+    assert not result.exception
+    assert 'Archived 1 download records and removed 1 expired token hashes.' in result.output
+
+    with flask_app.app_context():
+        db_conn = get_db()
+        assert [row['token'] for row in db_conn.execute('SELECT token FROM download')] == ['recent-token']
+        # The archived token could not be decoded, and so can never be used, so its hash is not recorded
+        assert db_conn.execute('SELECT count(*) FROM used_token').fetchone()[0] == 0
+
+
+@pytest.mark.sqlite
+@pytest.mark.parametrize('query, index', [
+    ('SELECT * FROM generate_task WHERE dataset_id = ? AND initiated > ?', 'generate_task_dataset_id'),
+    ('SELECT * FROM generate_task WHERE status is ?', 'generate_task_status'),
+    ('SELECT * FROM generate_task WHERE dataset_id = ? AND scope_hash = ?', 'generate_task_scope_hash'),
+    ('SELECT * FROM package WHERE generated_by = ?', 'package_generated_by'),
+    ('SELECT * FROM download WHERE finished < ?', 'download_finished'),
+    ('DELETE FROM used_token WHERE expires <= ?', 'used_token_expires'),
+    ('SELECT * FROM generate_scope WHERE task_id = ?', 'generate_scope_task_id'),
+    ('SELECT id FROM generate_request WHERE task_id = ?', 'generate_request_task_id'),
+    ('SELECT prefix FROM generate_request_scope WHERE request_id = ?', 'generate_request_scope_request_id'),
+    ('SELECT * FROM subscription WHERE task_id = ?', 'subscription_task_id'),
+    ("SELECT count(*) FROM download WHERE filename = ? AND status = 'SUCCESSFUL'", 'download_filename'),
+])
+def test_query_uses_index(flask_app, query, index):
+    with flask_app.app_context():
+        plan = get_db().execute('EXPLAIN QUERY PLAN ' + query, (None,) * query.count('?')).fetchall()
+
+    details = ' '.join(row['detail'] for row in plan)
+    assert 'USING INDEX %s' % index in details or 'USING COVERING INDEX %s' % index in details, details
+
+
+@pytest.mark.sqlite
+def test_active_packages_query_uses_indexes(flask_app):
+    with flask_app.app_context():
+        plan = get_db().execute(
+            "EXPLAIN QUERY PLAN "
+            "SELECT p.filename, s.no_downloads "
+            "FROM package p "
+            "JOIN generate_task t ON p.generated_by = t.task_id "
+            "LEFT JOIN package_stats s ON p.filename = s.filename "
+            "WHERE ? IS NULL OR t.dataset_id = ?",
+            (None, None)
+        ).fetchall()
+
+    details = ' '.join(row['detail'] for row in plan)
+    assert 'SEARCH s USING INDEX' in details, details
+    assert 'download' not in details, details
+    assert 'AUTOMATIC' not in details, details
+
+
+def test_package_stats(flask_app, success_task):
+    with flask_app.app_context():
+        for i, successful in enumerate([True, False, True]):
+            download_id = create_download_record('token-%d' % i, success_task['package'])
+            finalize_download_record(download_id, successful)
+        finalize_download_record(create_download_record('token-file', '/test/file.txt'))
+
+        db_conn = get_db()
+        stats = db_conn.execute('SELECT * FROM package_stats').fetchall()
+        assert len(stats) == 1
+        assert stats[0]['filename'] == success_task['package']
+        assert stats[0]['no_downloads'] == 2
+        package = db_conn.execute('SELECT size_bytes FROM package WHERE filename = ?', (success_task['package'],)).fetchone()
+        assert stats[0]['bytes_served'] == 2 * package['size_bytes']
+
+        packages = get_active_packages()
+        assert len(packages) == 1
+        assert packages[0].no_downloads == 2
+        assert packages[0].last_downloaded is not None
+
+        delete_package_rows([success_task['package']])
+        assert db_conn.execute('SELECT count(*) FROM package_stats').fetchone()[0] == 0
+
+
+def test_active_packages_performance(flask_app):
+    package_count = 10000
+    now = int(time.time())
+
+    with flask_app.app_context():
+        db_conn = get_db()
+        db_conn.executemany(
+            "INSERT INTO generate_task (task_id, dataset_id, is_partial, status, date_done) "
+            "VALUES (?, ?, 0, 'SUCCESS', '2020-08-07 12:00:00.123456')",
+            [('task-%d' % i, str(i % 100)) for i in range(package_count)])
+        db_conn.executemany(
+            "INSERT INTO package (filename, size_bytes, checksum, generated_by, generated) VALUES (?, 1024, '', ?, ?)",
+            [('%d.zip' % i, 'task-%d' % i, now if i % 2 else None) for i in range(package_count)])
+        db_conn.executemany(
+            "INSERT INTO package_stats (filename, no_downloads, last_downloaded) VALUES (?, 1, ?)",
+            [('%d.zip' % i, now) for i in range(0, package_count, 3)])
+        db_conn.commit()
+
+        with record_statements(db_conn) as statements:
+            packages = get_active_packages()
+
+    # All packages are loaded with their statistics by a single query
+    assert len(statements) == 1
+    assert len(packages) == package_count
+    assert packages[0].generated_at == 1596801600
+    assert packages[0].last_downloaded == now and packages[0].no_downloads == 1
+    assert packages[1].generated_at == now
+    assert packages[1].last_downloaded is None and packages[1].no_downloads == 0
+
+
+def test_scope_hash():
+    assert get_scope_hash(['/a', '/b']) == get_scope_hash({'/b', '/a'})
+    assert get_scope_hash(['/a', '/b']) != get_scope_hash(['/a'])
+    assert get_scope_hash(['/a,/b']) != get_scope_hash(['/a', '/b'])
+
+
+def test_compact_generate_scope(flask_app):
+    generate_scope = set('/test/dir_%d/file_%d.txt' % (i % 100, i) for i in range(20000))
+
+    with flask_app.app_context():
+        create_task_rows('1', '2009999 task-id', 1, generate_scope)
+        db_conn = get_db()
+        assert db_conn.execute('SELECT count(*) FROM generate_scope').fetchone()[0] == 0
+        assert db_conn.execute('SELECT file_count FROM generate_scope_compact').fetchone()[0] == len(generate_scope)
+
+        assert list(iter_generate_scope_filepaths('2009999 task-id')) == sorted(generate_scope)
+        assert get_generate_scope_filepaths('2009999 other-task-id') == set()
+
+
+def test_create_task_rows_large_scope(flask_app):
+    request_scope = ['/test/dir_%d' % i for i in range(1000)]
+
+    with flask_app.app_context():
+        db_conn = get_db()
+
+        def create_task(task_id, file_count):
+            with record_statements(db_conn) as statements:
+                create_task_rows('1', task_id, 1, ['/test/dir_%d/file_%d.txt' % (i % 1000, i) for i in range(file_count)])
+            return statements
+
+        # The generate scope is stored as a single compressed row, with the same statements for any number of files
+        assert len(create_task('2009999 small-task-id', 10)) == len(create_task('2009999 task-id', 10000))
+        create_request_scope('2009999 task-id', request_scope)
+
+        assert tuple(db_conn.execute(
+            "SELECT count(*), sum(file_count) FROM generate_scope_compact WHERE task_id = '2009999 task-id'"
+        ).fetchone()) == (1, 10000)
+        assert db_conn.execute('SELECT count(*) FROM generate_scope').fetchone()[0] == 0
+        assert get_request_scopes('2009999 task-id') == [set(request_scope)]
+
+
+def test_delete_package_rows(flask_app):
+    filenames = ['%d_package.zip' % i for i in range(1200)]
+
+    with flask_app.app_context():
+        db_conn = get_db()
+        db_conn.executemany(
+            "INSERT INTO package (filename, size_bytes, checksum, generated_by) VALUES (?, 1, 'sha256:0', 'task')",
+            [(filename,) for filename in filenames])
+        db_conn.commit()
+
+        delete_package_rows(filenames[:1100])
+
+        assert [row['filename'] for row in db_conn.execute('SELECT filename FROM package ORDER BY id')] == \
+            filenames[1100:]
+
+
+def test_batched_loaders(flask_app, success_task):
+    with flask_app.app_context():
+        create_task_rows('1', 'task-1', 1, ['/a/b.txt', '/c/d.txt'])
+        create_request_scope('task-1', ['/a'])
+        create_request_scope('task-1', ['/a/b.txt', '/c'])
+        create_task_rows('1', 'task-2', 1, ['/e/f.txt'])
+        create_request_scope('task-2', [])
+        task_id = get_task(success_task['package'])['task_id']
+
+        assert get_request_scopes_for_tasks(['task-1', 'task-2', 'task-3']) == {
+            'task-1': [{'/a'}, {'/a/b.txt', '/c'}],
+            'task-2': [set()]
+        }
+        assert get_request_scopes('task-1') == [{'/a'}, {'/a/b.txt', '/c'}]
+
+        packages = get_packages_for_tasks([task_id, 'task-1'])
+        assert list(packages.keys()) == [task_id]
+        assert packages[task_id]['filename'] == success_task['package']
+
+        task_row, scope = get_task_with_scope(None, 'task-1')
+        assert task_row['task_id'] == 'task-1'
+        assert sorted(scope) == ['/a/b.txt', '/c']
+
+        task_row, scope = get_task_with_scope(success_task['package'])
+        assert task_row['task_id'] == task_id
+        assert scope is None
+
+        assert get_task_with_scope('unknown.zip') is None
+
+
+def test_legacy_generate_scope(flask_app, success_task):
+    with flask_app.app_context():
+        task_id = get_task(success_task['package'])['task_id']
+        assert get_generate_scope_filepaths(task_id) == set(success_task['files'])
@@ -1,5 +1,9 @@
 import os
 import time
+from download.services.cache import perform_housekeeping
+from download.services.db import get_db, get_task_rows_for_status, outdate_task_rows, \
+                                 push_dataset_modified_timestamp, update_task_done
+from download.services.generator import generate
 
 os.environ["TZ"] = "UTC"
 time.tzset()
@@ -27,3 +31,64 @@ def test_generate_pending_task(runner, pending_task):
         ])
 
     assert not result.exception
+
+
+def test_generate_outdated_task(flask_app, started_task):
+    with flask_app.app_context():
+        task_id = get_db().execute(
+            'SELECT task_id FROM generate_task WHERE dataset_id = ?', (started_task['dataset_id'],)).fetchone()[0]
+
+        # The dataset is modified while the package is being generated
+        assert outdate_task_rows(started_task['dataset_id'], '2100-01-01T00:00:00Z') == 1
+
+        generate(started_task['dataset_id'], started_task['project_identifier'], started_task['files'], task_id)
+        # The completion of the task is reported by the generator, without overwriting its outdated status
+        update_task_done(task_id, 'SUCCESS')
+
+        assert get_db().execute('SELECT count(*) FROM package WHERE generated_by = ?', (task_id,)).fetchone()[0] == 0
+        assert [task_row['task_id'] for task_row in get_task_rows_for_status('OUTDATED')] == [task_id]
+
+    datasets_dir = os.path.join(flask_app.config['DOWNLOAD_CACHE_DIR'], 'datasets')
+    assert not any(filename.startswith(started_task['dataset_id'] + '_') for filename in os.listdir(datasets_dir))
+
+
+def test_generate_task_outdated_by_push(flask_app, started_task):
+    with flask_app.app_context():
+        task_id = get_db().execute(
+            'SELECT task_id FROM generate_task WHERE dataset_id = ?', (started_task['dataset_id'],)).fetchone()[0]
+
+        # The modification of the dataset is pushed while the package is being generated, and the status of the
+        # outdated task is overwritten as the task is started
+        push_dataset_modified_timestamp(started_task['dataset_id'], '2100-01-01T00:00:00Z', int(time.time()))
+        assert outdate_task_rows(started_task['dataset_id'], '2100-01-01T00:00:00Z') == 1
+        get_db().execute("UPDATE generate_task SET status = 'STARTED' WHERE task_id = ?", (task_id,))
+        get_db().commit()
+
+        generate(started_task['dataset_id'], started_task['project_identifier'], started_task['files'], task_id)
+
+        assert get_db().execute('SELECT count(*) FROM package WHERE generated_by = ?', (task_id,)).fetchone()[0] == 0
+
+
+def test_housekeeping_during_generation(flask_app, pending_task, metax_dataset_available, monkeypatch):
+    housekeeping_runs = []
+
+    def housekeep(*args):
+        housekeeping_runs.append(perform_housekeeping())
+        return False
+
+    # Periodic housekeeping runs both before the package file is written and once it is written but not yet
+    # recorded in the database
+    monkeypatch.setattr('download.services.generator.cleanup_package_cache', housekeep)
+    monkeypatch.setattr('download.services.generator.ida_service_is_offline', housekeep)
+
+    with flask_app.app_context():
+        task_id = get_db().execute(
+            'SELECT task_id FROM generate_task WHERE dataset_id = ?', (pending_task['dataset_id'],)).fetchone()[0]
+
+        generate(pending_task['dataset_id'], pending_task['project_identifier'], pending_task['files'], task_id)
+
+        filename = get_db().execute('SELECT filename FROM package WHERE generated_by = ?', (task_id,)).fetchone()[0]
+
+    assert len(housekeeping_runs) == 2
+    assert all('No ghost files found' in status for status in housekeeping_runs)
+    assert os.listdir(os.path.join(flask_app.config['DOWNLOAD_CACHE_DIR'], 'datasets')) == [filename]
@@ -0,0 +1,371 @@
+import os
+import time
+import json
+import fcntl
+import hashlib
+import threading
+import pytest
+import requests
+from download.dto import DatasetFile
+from download.services import metax
+from download.services.metax import iter_json_array, get_dataset, get_dataset_files, get_datasets_modified, \
+                                    get_dataset_modified_from_metax, \
+                                    get_matching_dataset_files_from_metax, sweep_coalesce_dir, \
+                                    IncompleteFileListing, NoMatchingFilesFound
+from testutils.metax import MetaxDatasetResponse, MetaxDatasetFilesResponse
+from testutils.metax_stub import MetaxStubServer
+
+os.environ["TZ"] = "UTC"
+time.tzset()
+
+# Retained before the network access guard fixture replaces it, for tests using a local Metax stub server
+REQUESTS_GET = requests.get
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_iter_json_array_chunked():
+    records = [{"pathname": "/a/%d" % i, "size": i, "nested": {"list": [1, 2, 3]}} for i in range(50)]
+    text = json.dumps(records, indent=2)
+    for size in [1, 7, 64, len(text)]:
+        assert list(iter_json_array(chunked(text, size))) == records
+
+
+def test_iter_json_array_scalars_and_empty():
+    assert list(iter_json_array(chunked('[1, 22, 333, "x,]"]', 1))) == [1, 22, 333, "x,]"]
+    assert list(iter_json_array(['[', ' ]'])) == []
+
+
+def test_iter_json_array_invalid():
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"results": []}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[{"a": 1}, ']))
+
+
+def test_get_dataset_files(flask_app, metax_dataset_files_available):
+    with flask_app.app_context():
+        dataset_files = list(get_dataset_files('1'))
+
+    assert len(dataset_files) > 0
+    assert all(isinstance(dataset_file, DatasetFile) for dataset_file in dataset_files)
+    assert dataset_files[0].pathname == '/test1/file1.txt'
+    assert dataset_files[0].project == '2009999'
+    assert dataset_files[0].size == 237157
+    assert dataset_files[0].checksum.startswith('sha256:')
+
+
+def test_get_matching_dataset_files(flask_app, metax_dataset_files_available):
+    with flask_app.app_context():
+        generate_scope, project_identifier, is_partial = get_matching_dataset_files_from_metax('1', ['/test2'])
+        assert project_identifier == '2009999'
+        assert is_partial == 1
+        assert all(filepath.startswith('/test2/') for filepath in generate_scope)
+
+        generate_scope, project_identifier, is_partial = get_matching_dataset_files_from_metax('1', [])
+        assert is_partial == 0
+
+        with pytest.raises(NoMatchingFilesFound):
+            get_matching_dataset_files_from_metax('1', ['/no_such_directory'])
+
+
+@pytest.fixture
+def metax_stub_app(flask_app, monkeypatch):
+    monkeypatch.setattr('requests.get', REQUESTS_GET)
+    monkeypatch.setitem(flask_app.config, 'METAX_VERSION', 3)
+    monkeypatch.setitem(flask_app.config, 'METAX_URL', flask_app.config['METAX_URL'])
+    monkeypatch.setitem(flask_app.config, 'METAX_V3_FILES_PAGE_SIZE', 0)
+    monkeypatch.setitem(flask_app.config, 'METAX_FILES_PARALLEL_REQUESTS', 4)
+    return flask_app
+
+
+def test_get_dataset_files_paginated(metax_stub_app):
+    with MetaxStubServer(1050) as stub:
+        metax_stub_app.config['METAX_URL'] = stub.url
+        metax_stub_app.config['METAX_V3_FILES_PAGE_SIZE'] = 100
+        with metax_stub_app.app_context():
+            dataset_files = list(get_dataset_files('1'))
+
+    assert stub.requests == 11
+    assert [dataset_file.pathname for dataset_file in dataset_files] == [f["pathname"] for f in stub.files]
+
+
+def test_get_dataset_files_paginated_concurrently(metax_stub_app):
+    with MetaxStubServer(600, 0.1) as stub:
+        metax_stub_app.config['METAX_URL'] = stub.url
+        metax_stub_app.config['METAX_V3_FILES_PAGE_SIZE'] = 100
+        metax_stub_app.config['METAX_FILES_PARALLEL_REQUESTS'] = 3
+        with metax_stub_app.app_context():
+            dataset_files = list(get_dataset_files('1'))
+
+    assert len(dataset_files) == 600
+    # The five pages following the first page are requested concurrently, at most three at a time
+    assert stub.requests == 6
+    assert 1 < stub.max_in_flight <= 3
+
+
+def test_get_dataset_files_paginated_capped_limit(metax_stub_app):
+    with MetaxStubServer(1050, max_limit=30) as stub:
+        metax_stub_app.config['METAX_URL'] = stub.url
+        metax_stub_app.config['METAX_V3_FILES_PAGE_SIZE'] = 100
+        with metax_stub_app.app_context():
+            dataset_files = list(get_dataset_files('1'))
+
+    assert stub.requests == 35
+    assert [dataset_file.pathname for dataset_file in dataset_files] == [f["pathname"] for f in stub.files]
+
+
+def test_get_dataset_files_paginated_incomplete(metax_stub_app):
+    with MetaxStubServer(250, count=300) as stub:
+        metax_stub_app.config['METAX_URL'] = stub.url
+        metax_stub_app.config['METAX_V3_FILES_PAGE_SIZE'] = 100
+        with metax_stub_app.app_context():
+            with pytest.raises(IncompleteFileListing):
+                list(get_dataset_files('1'))
+
+
+@pytest.fixture
+def slow_metax(monkeypatch, recorder):
+    recorder.calls = 0
+    recorder.in_flight = 0
+    recorder.max_in_flight = 0
+    lock = threading.Lock()
+
+    def mock_get_metax(url, auth={}, headers={}, stream=False, timeout=None):
+        with lock:
+            recorder.calls += 1
+            recorder.in_flight += 1
+            recorder.max_in_flight = max(recorder.max_in_flight, recorder.in_flight)
+        time.sleep(0.2)
+        with lock:
+            recorder.in_flight -= 1
+        if 'files' in url:
+            return MetaxDatasetFilesResponse("no-tasks", 200)
+        return MetaxDatasetResponse("no-tasks", 200)
+
+    monkeypatch.setattr('requests.get', mock_get_metax)
+
+
+def run_concurrently(flask_app, function, count):
+    results = [None] * count
+
+    def run(i):
+        with flask_app.app_context():
+            results[i] = function()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_dataset_fetches_are_coalesced(flask_app, slow_metax, recorder):
+    results = run_concurrently(flask_app, lambda: get_dataset('1'), 10)
+
+    assert recorder.calls == 1
+    assert all(result == results[0] for result in results)
+
+    results = run_concurrently(flask_app, lambda: list(get_dataset_files('1')), 10)
+
+    assert recorder.calls == 2
+    assert all(result == results[0] for result in results)
+
+
+def test_dataset_fetch_coalesced_across_processes(flask_app, slow_metax, recorder, cache_dir, monkeypatch):
+    coalesce_dir = os.path.join(cache_dir, 'metax')
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_DIR', coalesce_dir)
+    os.makedirs(coalesce_dir)
+
+    basename = hashlib.sha256('datasets/1'.encode('utf-8')).hexdigest()
+    results = []
+
+    # Hold the lock file as if another process was fetching the same dataset
+    with open(os.path.join(coalesce_dir, '%s.lock' % basename), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        thread = threading.Thread(target=lambda: results.extend(run_concurrently(flask_app, lambda: get_dataset('1'), 1)))
+        thread.start()
+        time.sleep(0.1)
+        with open(os.path.join(coalesce_dir, '%s.json' % basename), 'w') as result_file:
+            json.dump({"id": "1", "modified": "2020-01-01T00:00:00Z"}, result_file)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        thread.join()
+
+    assert recorder.calls == 0
+    assert results == [{"id": "1", "modified": "2020-01-01T00:00:00Z"}]
+
+    with flask_app.app_context():
+        get_dataset('1')
+
+    assert recorder.calls == 1
+
+
+def test_coalesced_fetch_wait_is_bounded(flask_app, slow_metax, recorder, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_TIMEOUT', 0.1)
+    stalled = threading.Event()
+    results = []
+
+    # A fetch of the same dataset is in flight in this process, and stalls
+    def stalled_fetch():
+        stalled.wait(10)
+        return {"id": "1", "stalled": True}
+
+    thread = threading.Thread(target=lambda: results.extend(
+        run_concurrently(flask_app, lambda: metax.coalesce('datasets/1', stalled_fetch, False), 1)))
+    thread.start()
+    time.sleep(0.1)
+
+    try:
+        with flask_app.app_context():
+            start = time.monotonic()
+            dataset = get_dataset('1')
+            elapsed = time.monotonic() - start
+    finally:
+        stalled.set()
+        thread.join()
+
+    # The waiting fetch gives up on the stalled fetch and fetches the dataset independently
+    assert recorder.calls == 1
+    assert 'stalled' not in dataset
+    assert elapsed < 5
+    assert results == [{"id": "1", "stalled": True}]
+
+
+def test_coalesced_lock_wait_is_bounded(flask_app, slow_metax, recorder, cache_dir, monkeypatch):
+    coalesce_dir = os.path.join(cache_dir, 'metax')
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_DIR', coalesce_dir)
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_TIMEOUT', 0.1)
+    os.makedirs(coalesce_dir)
+
+    basename = hashlib.sha256('datasets/1'.encode('utf-8')).hexdigest()
+
+    # Hold the lock file as if another process was stalled fetching the same dataset
+    with open(os.path.join(coalesce_dir, '%s.lock' % basename), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with flask_app.app_context():
+            dataset = get_dataset('1')
+
+    # The dataset is fetched without waiting for the lock any longer
+    assert recorder.calls == 1
+    assert not os.path.exists(os.path.join(coalesce_dir, '%s.json' % basename))
+
+
+def test_metax_requests_time_out(flask_app, monkeypatch, recorder):
+    recorder.timeouts = []
+
+    def mock_get_metax(url, auth={}, headers={}, stream=False, timeout=None):
+        recorder.timeouts.append(timeout)
+        return MetaxDatasetResponse("no-tasks", 200)
+
+    monkeypatch.setattr('requests.get', mock_get_metax)
+
+    with flask_app.app_context():
+        get_dataset('1')
+        monkeypatch.setitem(flask_app.config, 'METAX_TIMEOUT', 5)
+        get_dataset('2')
+        monkeypatch.setitem(flask_app.config, 'METAX_TIMEOUT', 0)
+        get_dataset('3')
+
+    assert recorder.timeouts == [60, 5, None]
+
+
+def test_large_dataset_file_listings_are_not_shared(flask_app, slow_metax, recorder, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_MAX_FILES', 1)
+
+    results = run_concurrently(flask_app, lambda: list(get_dataset_files('1')), 5)
+
+    # The listing is retrieved once by the fetching requestor, and once more by each of the waiting requestors
+    assert recorder.calls == 1 + 4
+    assert len(results[0]) > 1
+    assert all(result == results[0] for result in results)
+
+
+def test_dataset_file_listings_are_not_coalesced_across_processes(flask_app, slow_metax, cache_dir, monkeypatch):
+    coalesce_dir = os.path.join(cache_dir, 'metax')
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_DIR', coalesce_dir)
+
+    with flask_app.app_context():
+        list(get_dataset_files('1'))
+
+    assert not os.path.exists(coalesce_dir)
+
+
+def test_sweep_coalesce_dir(flask_app, cache_dir, monkeypatch):
+    coalesce_dir = os.path.join(cache_dir, 'metax')
+    os.makedirs(coalesce_dir)
+    monkeypatch.setitem(flask_app.config, 'METAX_COALESCE_TTL', 60)
+    monkeypatch.setattr(metax, 'coalesce_dir_swept', 0)
+
+    def create(name, age):
+        pathname = os.path.join(coalesce_dir, name)
+        open(pathname, 'w').close()
+        os.utime(pathname, (time.time() - age, time.time() - age))
+        return pathname
+
+    expired = [create(name, 120) for name in ['a.lock', 'a.json', 'b.json.123']]
+    recent = [create(name, 0) for name in ['c.lock', 'c.json']]
+    locked = create('d.lock', 120)
+
+    with open(locked, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with flask_app.app_context():
+            sweep_coalesce_dir(coalesce_dir)
+            # Swept at most once per TTL
+            create('e.json', 120)
+            sweep_coalesce_dir(coalesce_dir)
+
+    assert not any(os.path.exists(pathname) for pathname in expired)
+    assert all(os.path.exists(pathname) for pathname in recent + [locked])
+    assert os.path.exists(os.path.join(coalesce_dir, 'e.json'))
+
+
+def test_get_datasets_modified(flask_app, slow_metax, recorder):
+    with flask_app.app_context():
+        dataset_modified_timestamps = get_datasets_modified(['1', '2', '3', '2'])
+
+    # One request per distinct dataset, requested concurrently
+    assert recorder.calls == 3
+    assert 1 < recorder.max_in_flight <= 3
+    assert sorted(dataset_modified_timestamps.keys()) == ['1', '2', '3']
+    assert len(set(dataset_modified_timestamps.values())) == 1
+
+
+def test_get_datasets_modified_not_found(flask_app, metax_dataset_not_found):
+    with flask_app.app_context():
+        assert get_datasets_modified(['1']) == {'1': None}
+
+
+def test_get_datasets_modified_cached(flask_app, slow_metax, recorder, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'METAX_CACHE_TTL', 60)
+
+    with flask_app.app_context():
+        dataset_modified_timestamps = get_datasets_modified(['1', '2'])
+        assert recorder.calls == 2
+        assert get_datasets_modified(['1', '2']) == dataset_modified_timestamps
+        assert get_dataset_modified_from_metax('1') == dataset_modified_timestamps['1']
+        assert recorder.calls == 2
+
+
+def test_get_datasets_modified_list_query(flask_app, monkeypatch, recorder):
+    monkeypatch.setitem(flask_app.config, 'METAX_DATASETS_LIST_QUERY', True)
+    recorder.posted = []
+
+    def mock_post_metax(url, auth={}, **kwargs):
+        dataset_ids = kwargs['json']
+        recorder.posted.append(dataset_ids)
+        body = [{"identifier": dataset_id, "date_modified": "2020-07-04T18:06:24+03:00"}
+                for dataset_id in dataset_ids if dataset_id != '2']
+        response = MetaxDatasetResponse("no-tasks", 200)
+        response.body = json.dumps(body)
+        return response
+
+    monkeypatch.setattr('requests.post', mock_post_metax)
+
+    with flask_app.app_context():
+        dataset_modified_timestamps = get_datasets_modified(['1', '2', '3'])
+
+    assert recorder.posted == [['1', '2', '3']]
+    assert dataset_modified_timestamps == {'1': '2020-07-04T15:06:24Z', '2': None, '3': '2020-07-04T15:06:24Z'}
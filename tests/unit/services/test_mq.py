@@ -2,7 +2,8 @@ import os
 import time
 import click
 import pytest
-from download.services.mq import get_mq, init_mq
+from download.services.db import create_task_rows, get_task_rows_for_status
+from download.services.mq import get_mq, init_mq, reload_queue
 
 os.environ["TZ"] = "UTC"
 time.tzset()
@@ -24,3 +25,29 @@ def test_init_command_unconfirm(runner, mock_init_mq, recorder):
     assert 'Do you want to continue?' in result.output
     assert 'Initialized' not in result.output
     assert not recorder.called
+
+
+def test_reload_queue(flask_app, mock_celery, recorder):
+    with flask_app.app_context():
+        create_task_rows('1', '2009999 task-id', 0, ['/test/file.txt'])
+
+        added_tasks = reload_queue()
+
+        assert recorder.task_id == '2009999 task-id'
+        assert [task['task_id'] for task in added_tasks] == ['2009999 task-id']
+        assert [row['task_id'] for row in get_task_rows_for_status('PENDING')] == ['2009999 task-id']
+
+
+def test_reload_queue_failure(flask_app, monkeypatch):
+    def fail_apply_async(args=None, kwargs=None, task_id=None, **options):
+        raise ConnectionError
+
+    monkeypatch.setattr('download.tasks.generate_task.apply_async', fail_apply_async)
+
+    with flask_app.app_context():
+        create_task_rows('1', '2009999 task-id', 0, ['/test/file.txt'])
+
+        with pytest.raises(ConnectionError):
+            reload_queue()
+
+        assert [row['task_id'] for row in get_task_rows_for_status('NEW')] == ['2009999 task-id']
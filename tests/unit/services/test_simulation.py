@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import pytest
+from download.services.db import get_db, create_download_record, finalize_download_record
+from download.services.simulation import load_event_trace, load_database_trace, simulate, parse_epoch
+
+os.environ["TZ"] = "UTC"
+time.tzset()
+
+
+@pytest.fixture
+def events_file(tmp_path):
+    events = []
+    for minute, dataset in enumerate(['A', 'B', 'A', 'C', 'D', 'A']):
+        events.append({
+            "dataset": dataset,
+            "type": "COMPLETE",
+            "status": "SUCCESS",
+            "started": "2022-11-11T10:%02d:00Z" % minute,
+            "finished": "2022-11-11T10:%02d:30Z" % minute
+        })
+    events.append({
+        "dataset": "A",
+        "type": "FILE",
+        "file": "/test/file.txt",
+        "status": "SUCCESS",
+        "started": "2022-11-11T11:00:00Z",
+        "finished": "2022-11-11T11:00:01Z"
+    })
+    pathname = tmp_path / 'events.json'
+    pathname.write_text(json.dumps(events))
+    return str(pathname)
+
+
+def test_parse_epoch():
+    assert parse_epoch('2022-11-11T10:00:00Z') == parse_epoch('2022-11-11 10:00:00.123456') == 1668160800
+
+
+@pytest.mark.parametrize("policy, hits", [("lru", 1), ("lfu", 2)])
+def test_simulate_events(events_file, policy, hits):
+    trace = load_event_trace([events_file], 10)
+    assert len(trace.times) == 6
+    assert len(trace.keys) == 4
+
+    result = simulate(trace, policy, 25, 15)
+
+    assert result['requests'] == 6
+    assert result['hits'] == hits
+    assert result['bytes_regenerated'] == (6 - hits) * 10
+    assert result['peak_usage_bytes'] == 30
+
+
+@pytest.mark.sqlite
+def test_simulate_database(flask_app, success_task):
+    with flask_app.app_context():
+        for i in range(3):
+            finalize_download_record(create_download_record('token-%d' % i, success_task['package']))
+        finalize_download_record(create_download_record('token-file', '/test/file.txt'))
+        size = get_db().execute(
+            'SELECT size_bytes FROM package WHERE filename = ?', (success_task['package'],)).fetchone()[0]
+
+    trace = load_database_trace(flask_app.config['DATABASE_FILE'], 1)
+    assert len(trace.times) == 3
+    assert trace.sizes == [size]
+
+    result = simulate(trace, 'heuristic', 0, 0)
+    assert result['hits'] == 2
+    assert result['bytes_regenerated'] == size
+
+
+def test_simulate_command(flask_app, events_file):
+    runner = flask_app.test_cli_runner()
+    result = runner.invoke(args=[
+        'cache', 'simulate', '--events', events_file, '--package-size', '10', '--threshold', '25', '--target', '15'])
+
+    assert not result.exception, result.output
+    assert 'Replayed 6 requests for 4 packages' in result.output
+    for policy in ['heuristic', 'lru', 'lfu', 'gdsf', 'cost']:
+        assert policy in result.output
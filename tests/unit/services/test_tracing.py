@@ -0,0 +1,63 @@
+import os
+import time
+import pytest
+from download.services import tracing
+from download.services.db import get_db, close_pooled_db, get_active_packages, get_task
+from download.services.tracing import TracedConnection, format_metrics
+
+os.environ["TZ"] = "UTC"
+time.tzset()
+
+
+@pytest.fixture
+def traced_app(flask_app, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'DATABASE_QUERY_TRACING', 'true')
+    monkeypatch.setattr(tracing, 'histograms', {})
+    close_pooled_db()
+
+    yield flask_app
+
+    close_pooled_db()
+
+
+def test_tracing_disabled(flask_app):
+    with flask_app.app_context():
+        assert not isinstance(get_db(), TracedConnection)
+
+
+def test_query_histograms(traced_app, success_task):
+    with traced_app.app_context():
+        assert isinstance(get_db(), TracedConnection)
+
+        packages = get_active_packages()
+        assert len(packages) == 1
+        get_task(success_task['package'])
+
+    histogram = tracing.histograms['get_active_packages']
+    assert histogram['count'] == 1
+    assert histogram['rows'] == 1
+    assert sum(histogram['buckets']) == 1
+    assert tracing.histograms['get_task']['count'] == 1
+
+    metrics = format_metrics()
+    assert '# TYPE download_db_query_duration_seconds histogram' in metrics
+    assert 'download_db_query_duration_seconds_bucket{query="get_active_packages",le="+Inf"} 1' in metrics
+    assert 'download_db_query_duration_seconds_count{query="get_task"} 1' in metrics
+    assert 'download_db_query_rows_total{query="get_active_packages"} 1' in metrics
+
+
+def test_slow_query_log(traced_app, success_task, monkeypatch, tmp_path):
+    slow_query_log = tmp_path / 'slow-queries.log'
+    monkeypatch.setitem(traced_app.config, 'DATABASE_SLOW_QUERY_THRESHOLD', '0')
+    monkeypatch.setitem(traced_app.config, 'DATABASE_SLOW_QUERY_LOG', str(slow_query_log))
+
+    with traced_app.app_context():
+        get_task(success_task['package'])
+
+    entries = slow_query_log.read_text()
+    assert 'Slow query get_task' in entries
+    # The query plan is logged after the statement
+    assert len(entries.splitlines()) > 2
+    assert 'Query plan not available' not in entries
+    # Parameter values are never logged
+    assert success_task['package'] not in entries
@@ -1,6 +1,8 @@
 import os
 import time
-from download.tasks import generate_task
+from celery.signals import task_prerun, task_success, task_failure, task_retry
+from download.tasks import celery_app, generate_task
+from download.services.db import get_db
 
 os.environ["TZ"] = "UTC"
 time.tzset()
@@ -9,3 +11,37 @@ time.tzset()
 def test_generate_task(mock_celery, pending_task):
     task = generate_task.delay(pending_task['dataset_id'], '2009999', pending_task['files'])
     assert task
+
+
+def test_result_backend_disabled():
+    assert celery_app.conf.result_backend is None
+
+
+def test_task_lifecycle_signals(flask_app, pending_task):
+    with flask_app.app_context():
+        task_id = get_db().execute(
+            'SELECT task_id FROM generate_task WHERE dataset_id = ?', (pending_task['dataset_id'],)).fetchone()[0]
+
+    def get_task_row():
+        with flask_app.app_context():
+            return get_db().execute('SELECT * FROM generate_task WHERE task_id = ?', (task_id,)).fetchone()
+
+    task_prerun.send(sender=generate_task, task_id=task_id, task=generate_task, args=(), kwargs={})
+    assert get_task_row()['status'] == 'STARTED'
+
+    generate_task.push_request(id=task_id)
+    try:
+        task_retry.send(sender=generate_task, request=generate_task.request, reason='offline', einfo=None)
+        assert get_task_row()['status'] == 'RETRY'
+        assert get_task_row()['retries'] == 1
+
+        task_success.send(sender=generate_task, result=None)
+    finally:
+        generate_task.pop_request()
+    assert get_task_row()['status'] == 'SUCCESS'
+    assert get_task_row()['date_done'] is not None
+
+    task_failure.send(sender=generate_task, task_id=task_id, exception=Exception(), args=(), kwargs={},
+                      traceback=None, einfo='Traceback')
+    assert get_task_row()['status'] == 'FAILURE'
+    assert get_task_row()['traceback'] == 'Traceback'
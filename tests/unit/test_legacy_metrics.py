@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import time
+import pytest
+import subprocess
+from datetime import datetime, timedelta
+from jwt import encode
+from download.services.db import get_db, archive_download_records, close_pooled_db
+
+os.environ["TZ"] = "UTC"
+time.tzset()
+
+EXTRACT_EVENTS = os.path.join(os.path.dirname(__file__), '..', '..', 'legacy-metrics', 'lib', 'extract-events.py')
+
+
+def create_token(flask_app, claims):
+    claims['exp'] = datetime.utcnow() + timedelta(hours=flask_app.config['JWT_TTL'])
+    return encode(claims, flask_app.config['JWT_SECRET'], algorithm=flask_app.config['JWT_ALGORITHM']).decode()
+
+
+@pytest.mark.sqlite
+def test_extract_events_includes_archived_downloads(flask_app, success_task):
+    package_token = create_token(flask_app, {'dataset': success_task['dataset_id'], 'package': success_task['package']})
+    file_token = create_token(flask_app, {'dataset': success_task['dataset_id'], 'file': '/test/file.txt'})
+
+    with flask_app.app_context():
+        db_conn = get_db()
+        db_conn.execute(
+            "INSERT INTO download (token, filename, status, started, finished) "
+            "VALUES (?, ?, 'SUCCESSFUL', '2020-01-01 00:00:00', '2020-01-01 00:00:10')",
+            (package_token, success_task['package']))
+        db_conn.execute(
+            "INSERT INTO download (token, filename, status, started, finished) "
+            "VALUES (?, '/test/file.txt', 'FAILED', datetime('now'), datetime('now'))",
+            (file_token,))
+        db_conn.commit()
+        assert archive_download_records(30) == (1, 0)
+
+    close_pooled_db()
+
+    environment = dict(os.environ, DATABASE_SNAPSHOT_FILE=flask_app.config['DATABASE_FILE'], JWT_SECRET='')
+    result = subprocess.run(
+        [sys.executable, EXTRACT_EVENTS], env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+    events = json.loads(result.stdout.decode('utf-8'))
+
+    assert [(event['type'], event['status']) for event in events] == [('FILE', 'FAILURE'), ('COMPLETE', 'SUCCESS')]
+    assert events[1]['dataset'] == success_task['dataset_id']
+    assert events[1]['started'] == '2020-01-01T00:00:00Z'
+    assert events[1]['finished'] == '2020-01-01T00:00:10Z'
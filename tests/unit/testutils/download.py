@@ -1,6 +1,7 @@
 import json
 import os
 from download.services import db
+from download.services.backends import get_backend
 
 
 def create_dataset(flask_app, descriptor):
@@ -18,6 +19,11 @@ def get_test_data(table_name, descriptor):
     return None
 
 
+def nullable(value):
+    """Returns the specified test data value, or None for an empty value, which is not valid in typed columns."""
+    return None if value == '' else value
+
+
 def inject_database_records(flask_app, descriptor):
     dataset = {}
     dataset['csc_project'] = '2009999'
@@ -25,13 +31,13 @@ def inject_database_records(flask_app, descriptor):
     with flask_app.app_context():
         db_conn = db.get_db()
         db_cursor = db_conn.cursor()
+        backend = get_backend()
 
         # Inject generate_task database row
         generate_task = get_test_data('generate_task', descriptor)
         if generate_task:
             db_cursor.execute(
                 "INSERT INTO generate_task ( "
-                "  id, "
                 "  task_id, "
                 "  dataset_id, "
                 "  is_partial, "
@@ -41,17 +47,16 @@ def inject_database_records(flask_app, descriptor):
                 "  result, "
                 "  traceback, "
                 "  retries"
-                ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
-                    generate_task['id'],
+                ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
                     generate_task['task_id'],
                     generate_task['dataset_id'],
                     generate_task['is_partial'],
                     generate_task['status'],
                     generate_task['initiated'],
-                    generate_task['date_done'],
-                    generate_task['result'],
-                    generate_task['traceback'],
-                    generate_task['retries']
+                    nullable(generate_task['date_done']),
+                    nullable(generate_task['result']),
+                    nullable(generate_task['traceback']),
+                    nullable(generate_task['retries'])
                 )
             )
             dataset['dataset_id'] = generate_task['dataset_id']
@@ -61,9 +66,8 @@ def inject_database_records(flask_app, descriptor):
         if generate_scopes:
             for generate_scope in generate_scopes:
                 db_cursor.execute(
-                    "INSERT INTO generate_scope (id, task_id, filepath) "
-                    "VALUES (?, ?, ?)", (
-                        generate_scope['id'],
+                    "INSERT INTO generate_scope (task_id, filepath) "
+                    "VALUES (?, ?)", (
                         generate_scope['task_id'],
                         generate_scope['filepath']
                     )
@@ -73,14 +77,16 @@ def inject_database_records(flask_app, descriptor):
                 generate_scopes
             ))
 
-        # Inject generate_request database rows
+        # Inject generate_request database rows, with the ids generated by the database, as the ids of the test data
+        # would not be accounted for by the id sequences of all database backends
+        request_ids = {}
         generate_request = get_test_data('generate_request', descriptor)
         if generate_request:
-            db_cursor.execute(
-                "INSERT INTO generate_request (id, task_id) "
-                "VALUES (?, ?)", (
-                    generate_request['id'],
-                    generate_request['task_id']
+            request_ids[generate_request['id']] = backend.insert(
+                db_cursor,
+                "INSERT INTO generate_request (task_id) "
+                "VALUES (?)", (
+                    generate_request['task_id'],
                 )
             )
 
@@ -90,12 +96,10 @@ def inject_database_records(flask_app, descriptor):
             for generate_request_scope in generate_request_scopes:
                 db_cursor.execute(
                     "INSERT INTO generate_request_scope ( "
-                    "  id, "
                     "  request_id, "
                     "  prefix "
-                    ") VALUES (?, ?, ?)", (
-                        generate_request_scope['id'],
-                        generate_request_scope['request_id'],
+                    ") VALUES (?, ?)", (
+                        request_ids[generate_request_scope['request_id']],
                         generate_request_scope['prefix']
                     )
                 )
@@ -105,13 +109,11 @@ def inject_database_records(flask_app, descriptor):
         if package:
             db_cursor.execute(
                 "INSERT INTO package ( "
-                "  id, "
                 "  filename, "
                 "  size_bytes, "
                 "  checksum, "
                 "  generated_by "
-                ") VALUES (?, ?, ?, ?, ?)", (
-                    package['id'],
+                ") VALUES (?, ?, ?, ?)", (
                     package['filename'],
                     package['size_bytes'],
                     package['checksum'],
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class MetaxStubServer(object):
+    """Local stub of the Metax API dataset files endpoint, serving a generated file listing either
+    in a single response or in pages of at most max_limit records, with an artificial latency per request.
+    The maximum number of requests observed in flight at a time is recorded."""
+
+    def __init__(self, file_count, latency=0.0, project='2009999', max_limit=None, count=None):
+        self.files = [
+            {"pathname": "/test/file%d.txt" % i, "csc_project": project, "size": i, "checksum": "sha256:%d" % i}
+            for i in range(file_count)
+        ]
+        self.latency = latency
+        self.max_limit = max_limit
+        self.count = len(self.files) if count is None else count
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                time.sleep(stub.latency)
+                with stub.lock:
+                    stub.in_flight -= 1
+                query = parse_qs(urlparse(self.path).query)
+                if query.get('pagination', ['false'])[0] == 'true':
+                    offset = int(query.get('offset', ['0'])[0])
+                    limit = int(query.get('limit', ['100'])[0])
+                    if stub.max_limit is not None:
+                        limit = min(limit, stub.max_limit)
+                    body = {"count": stub.count, "results": stub.files[offset:offset + limit]}
+                else:
+                    body = stub.files
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/v3/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
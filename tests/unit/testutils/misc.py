@@ -1,4 +1,6 @@
 import json
+from contextlib import contextmanager
+from download.services.backends import PostgreSQLCursor
 
 class Recorder(object):
     called = False
@@ -18,3 +20,42 @@ class ResponseMock(object):
 
     def json(self):
         return json.loads(self.body)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        body = self.body.encode('utf-8')
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def record_statements(db_conn):
+    """Records the statements executed on the specified database connection, of either database backend, in the
+    list yielded. The statements of PostgreSQL connections are recorded once for each execute or executemany."""
+    statements = []
+
+    if hasattr(db_conn, 'set_trace_callback'):
+        db_conn.set_trace_callback(statements.append)
+        try:
+            yield statements
+        finally:
+            db_conn.set_trace_callback(None)
+        return
+
+    execute, executemany = PostgreSQLCursor.execute, PostgreSQLCursor.executemany
+
+    def record_execute(cursor, sql, *args):
+        statements.append(sql)
+        return execute(cursor, sql, *args)
+
+    def record_executemany(cursor, sql, *args):
+        statements.append(sql)
+        return executemany(cursor, sql, *args)
+
+    PostgreSQLCursor.execute, PostgreSQLCursor.executemany = record_execute, record_executemany
+    try:
+        yield statements
+    finally:
+        PostgreSQLCursor.execute, PostgreSQLCursor.executemany = execute, executemany